@@ -0,0 +1,132 @@
+# admission control: bounded number of requests in processing, a bounded priority queue in front of them,
+# deadlines and load shedding, so bursts of motion events do not pile up stale frames
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from config import config
+import metrics
+
+queue_depth = metrics.registry.register(metrics.Gauge(
+    'hailo_admission_queue_depth', 'Requests waiting for admission.'))
+active_requests = metrics.registry.register(metrics.Gauge(
+    'hailo_admission_active_requests', 'Requests admitted and being processed.'))
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Lets up to max_active requests be processed at the same time, up to max_queued more wait in priority order
+    (lower number first, FIFO within a priority). A request that does not get a slot before its deadline is dropped.
+    When the queue is full, the newest waiter of a lower priority is shed to make room, otherwise the new request
+    is rejected.
+    """
+    def __init__(self, max_active: int, max_queued: int):
+        self.max_active = max(1, max_active)
+        self.max_queued = max_queued
+        self.active = 0
+        self._waiters = []  # heap of (priority, sequence number, future)
+        self._sequence = itertools.count()
+
+    def _update_metrics(self):
+        queue_depth.set(value=len(self._waiters))
+        active_requests.set(value=self.active)
+
+    async def admit(self, priority: int, deadline: float):
+        """
+        Wait for a processing slot.
+
+        Args:
+            priority (int): Priority class, lower is served first.
+            deadline (float): time.perf_counter() time after which the request is useless to the client.
+
+        Raises:
+            Rejected: The queue is full, the request was shed or its deadline passed.
+        """
+        if self.active < self.max_active and not self._waiters:
+            self.active += 1
+            self._update_metrics()
+            return
+        if len(self._waiters) >= self.max_queued:
+            worst = max(self._waiters, default=None)
+            if worst is None or worst[0] <= priority:
+                raise Rejected('queue_full', 'Server is busy, request queue is full')
+            self._remove(worst)
+            worst[2].set_exception(Rejected('shed', 'Server is busy, request was shed for a higher priority one'))
+
+        waiter = (priority, next(self._sequence), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, waiter)
+        self._update_metrics()
+        try:
+            await asyncio.wait_for(waiter[2], timeout=max(0.0, deadline - time.perf_counter()))
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            raise Rejected('deadline', 'Request deadline passed while waiting in the queue')
+        except asyncio.CancelledError:
+            # client went away
+            self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter: tuple):
+        future = waiter[2]
+        if future.done() and not future.cancelled() and future.exception() is None:
+            # a slot was handed over at the same moment, it goes to the next waiter
+            self.release()
+        else:
+            self._remove(waiter)
+
+    def _remove(self, waiter: tuple):
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+            heapq.heapify(self._waiters)
+            self._update_metrics()
+
+    def release(self):
+        # the slot is handed to the next waiter directly, so it can not be taken by a newcomer in between
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                self._update_metrics()
+                return
+        self.active -= 1
+        self._update_metrics()
+
+    @asynccontextmanager
+    async def slot(self, priority: int, deadline: float):
+        await self.admit(priority, deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+admission = AdmissionController(max_active=config.max_active_requests, max_queued=config.max_queued_requests)
+
+
+def get_priority(endpoint: str) -> int:
+    return config.endpoint_priorities.get(endpoint, max(config.endpoint_priorities.values(), default=0))
+
+
+def get_deadline(headers, start_time: float) -> float:
+    """
+    Request deadline as a time.perf_counter() time, from the config.deadline_header header in ms or the default.
+    """
+    timeout_ms: Optional[float] = None
+    value = headers.get(config.deadline_header)
+    if value:
+        try:
+            timeout_ms = float(value)
+        except ValueError:
+            pass
+    if timeout_ms is None or timeout_ms <= 0:
+        timeout_ms = config.default_deadline_ms
+    return start_time + timeout_ms / 1000
@@ -0,0 +1,217 @@
+import asyncio
+import functools
+import time
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+from config import config, logger
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class BatchJob:
+    def __init__(self, model_name: str, frames: np.ndarray, deadline: Optional[float] = None):
+        self.model_name = model_name
+        self.frames = frames
+        self.deadline = deadline
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.outputs: Optional[list] = None
+        self.batch_size = 0
+        self.enqueue_time = time.perf_counter()
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def queue_ms(self):
+        return int((self.start_time - self.enqueue_time) * 1000)
+
+    @property
+    def inference_ms(self):
+        return int((self.end_time - self.start_time) * 1000)
+
+
+async def wait_for_frames(frames: Awaitable[np.ndarray], release: Optional[Callable[[], None]]) -> np.ndarray:
+    # frames that are ready when the caller is cancelled are released, nobody else gets them
+    frames = asyncio.ensure_future(frames)
+    try:
+        return await frames
+    except asyncio.CancelledError:
+        if release is not None and frames.done() and not frames.cancelled() and frames.exception() is None:
+            release()
+        raise
+
+
+def release_when_done(future: asyncio.Future, release: Callable[[], None]):
+    if not future.cancelled():
+        # retrieved, nobody else waits for it
+        future.exception()
+    release()
+
+
+class RequestBatcher:
+    """
+    Collects frames of concurrent requests and sends them to the device as one batch.
+
+    A batch is sent when it has batch_size frames, when batch_window_ms passed since its oldest frame arrived, or
+    as soon as no other request is still preprocessing its frame - so a lone request is never held for the window.
+    Frames arriving while the device is busy are naturally collected for the next batch.
+    Up to max_in_flight batches are run at the same time, more than one makes sense for the async backend only.
+    """
+    def __init__(self,
+                 run_batch: Callable[[str, np.ndarray], Awaitable[list]],
+                 batch_size: int = config.batch_size,
+                 batch_window_ms: float = config.batch_window_ms,
+                 max_in_flight: int = 1):
+        self.run_batch = run_batch
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window_ms / 1000
+        self.max_in_flight = max(1, max_in_flight)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._running: set[asyncio.Task] = set()
+        self._pending: list[BatchJob] = []
+        self._incoming = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    async def infer(self, model_name: str, frames: Awaitable[np.ndarray], deadline: Optional[float] = None,
+                    release: Optional[Callable[[], None]] = None) -> BatchJob:
+        """
+        Wait for the preprocessed frames, then queue them for the device.
+
+        Args:
+            model_name (str): Model to run the frames on; only frames of the same model are batched together.
+            frames (Awaitable[np.ndarray]): Preprocessed frames with shape (N, H, W, C).
+            deadline (float): time.perf_counter() time, the frames are dropped if they are not sent to the device
+                by then.
+            release (Callable): Gives the frames back, called if the caller is cancelled once the frames are ready:
+                right away if they were not sent to the device yet, otherwise when the device is done with them.
+                In every other case the caller releases the frames itself.
+
+        Returns:
+            BatchJob: Finished job, raw outputs for the frames are in job.outputs.
+
+        Raises:
+            DeadlineExceeded: The deadline passed before the frames were sent to the device.
+        """
+        self._incoming += 1
+        try:
+            frames = await wait_for_frames(frames, release)
+        finally:
+            self._incoming -= 1
+            self._notify()
+        if deadline is not None and time.perf_counter() > deadline:
+            raise DeadlineExceeded()
+        job = BatchJob(model_name, frames, deadline)
+        self._pending.append(job)
+        self._notify()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            # shielded: a cancelled caller does not take the job away from a batch that is on the device
+            await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            if job in self._pending:
+                self._pending.remove(job)
+                job.future.cancel()
+                if release is not None:
+                    release()
+            elif release is not None:
+                job.future.add_done_callback(functools.partial(release_when_done, release=release))
+            raise
+        return job
+
+    def _notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _pending_frames(self, model_name: str):
+        return sum(len(job.frames) for job in self._pending if job.model_name == model_name)
+
+    async def _wait_for_batch(self):
+        oldest = self._pending[0]
+        deadline = oldest.enqueue_time + self.batch_window
+        while self._incoming > 0 and self._pending_frames(oldest.model_name) < self.batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            self._wakeup = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+            finally:
+                self._wakeup = None
+
+    def _drop_expired(self):
+        now = time.perf_counter()
+        expired = [job for job in self._pending if job.deadline is not None and job.deadline < now]
+        if expired:
+            self._pending = [job for job in self._pending if job not in expired]
+            logger.debug('Dropped %d frames past their deadline', len(expired))
+            for job in expired:
+                if not job.future.done():
+                    job.future.set_exception(DeadlineExceeded())
+
+    def _take_batch(self) -> list[BatchJob]:
+        model_name = self._pending[0].model_name
+        batch, rest, num_frames = [], [], 0
+        for job in self._pending:
+            if job.model_name == model_name and (not batch or num_frames + len(job.frames) <= self.batch_size):
+                batch.append(job)
+                num_frames += len(job.frames)
+            else:
+                rest.append(job)
+        self._pending = rest
+        return batch
+
+    async def _dispatch(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+        while self._pending:
+            # frames keep collecting while all the slots are busy
+            await self._slots.acquire()
+            if not self._pending:
+                self._slots.release()
+                break
+            await self._wait_for_batch()
+            # stale frames never reach the device
+            self._drop_expired()
+            if not self._pending:
+                self._slots.release()
+                break
+            task = asyncio.create_task(self._run(self._take_batch()))
+            self._running.add(task)
+            task.add_done_callback(self._batch_done)
+
+    def _batch_done(self, task: asyncio.Task):
+        self._running.discard(task)
+        self._slots.release()
+
+    async def _run(self, batch: list[BatchJob]):
+        model_name = batch[0].model_name
+        frames = batch[0].frames if len(batch) == 1 else np.concatenate([job.frames for job in batch])
+        start_time = time.perf_counter()
+        for job in batch:
+            job.start_time = start_time
+            job.batch_size = len(frames)
+        logger.debug('Running batch of %d frames from %d requests on %s', len(frames), len(batch), model_name)
+        try:
+            outputs = await self.run_batch(model_name, frames)
+        except Exception as e:
+            end_time = time.perf_counter()
+            for job in batch:
+                job.end_time = end_time
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+        end_time = time.perf_counter()
+        offset = 0
+        for job in batch:
+            job.end_time = end_time
+            job.outputs = outputs[offset:offset + len(job.frames)]
+            offset += len(job.frames)
+            if not job.future.done():
+                job.future.set_result(job)
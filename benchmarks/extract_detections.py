@@ -0,0 +1,79 @@
+# micro-benchmark of NMS output parsing: the vectorized extract_detections against the former per row loop
+# run from the repo root: python -m benchmarks.extract_detections
+# (config.py sends stdout to debug log, so results are logged)
+import timeit
+
+import numpy as np
+
+from config import logger
+from detections import extract_detections
+
+NUM_CLASSES = 80
+
+
+def extract_detections_loop(input_data, threshold):
+    # the former implementation, kept here for comparison
+    boxes, scores, classes = [], [], []
+    num_detections = 0
+
+    for i, detection in enumerate(input_data):
+        if len(detection) == 0:
+            continue
+
+        for det in detection:
+            bbox, score = det[:4], det[4]
+
+            if score >= threshold:
+                boxes.append(bbox)
+                scores.append(score)
+                classes.append(i)
+                num_detections += 1
+
+    return {
+        'detection_boxes': boxes,
+        'detection_classes': classes,
+        'detection_scores': scores,
+        'num_detections': num_detections
+    }
+
+
+def make_nms_output(num_boxes: int, num_busy_classes: int, rng: np.random.Generator):
+    output = [np.empty((0, 5), dtype=np.float32) for _ in range(NUM_CLASSES)]
+    busy_classes = rng.choice(NUM_CLASSES, size=num_busy_classes, replace=False)
+    for cls in busy_classes:
+        n = num_boxes // num_busy_classes
+        rows = rng.uniform(0, 1, size=(n, 5)).astype(np.float32)
+        rows[:, 4] = np.sort(rows[:, 4])[::-1]  # NMS output is sorted by score
+        output[cls] = rows
+    return output
+
+
+def check_same_result(input_data, threshold):
+    expected = extract_detections_loop(input_data, threshold)
+    actual = extract_detections(input_data, threshold, class_thresholds=np.zeros(NUM_CLASSES), top_k=None,
+                                allowed_classes=list(range(NUM_CLASSES)))
+    assert expected['num_detections'] == actual['num_detections']
+    assert expected['detection_classes'] == actual['detection_classes'].tolist()
+    assert np.allclose(np.array(expected['detection_scores']), actual['detection_scores'])
+    assert np.allclose(np.array(expected['detection_boxes']).reshape(-1, 4), actual['detection_boxes'])
+
+
+def main():
+    rng = np.random.default_rng(0)
+    threshold = 0.4
+    logger.info(f'{"scene":>28} {"loop, us":>10} {"numpy, us":>10} {"speedup":>8}')
+    for num_boxes, num_busy_classes, scene in [(0, 1, 'empty'),
+                                               (5, 3, 'few objects'),
+                                               (50, 10, 'street'),
+                                               (300, 20, 'crowded'),
+                                               (1000, 40, 'very crowded')]:
+        input_data = make_nms_output(num_boxes, num_busy_classes, rng)
+        check_same_result(input_data, threshold)
+        number = 200
+        loop_us = timeit.timeit(lambda: extract_detections_loop(input_data, threshold), number=number) / number * 1e6
+        numpy_us = timeit.timeit(lambda: extract_detections(input_data, threshold), number=number) / number * 1e6
+        logger.info(f'{f"{scene} ({num_boxes} boxes)":>28} {loop_us:>10.1f} {numpy_us:>10.1f} {loop_us / numpy_us:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# load generator and latency benchmark for the detection API
+# replays images against the server the way Blue Iris and Frigate do (multipart 'image' + 'min_confidence') either
+# at a fixed rate or with N concurrent clients, and reports throughput and latency percentiles.
+#
+# against a running server:
+#   python -m benchmarks.load_test --url http://127.0.0.1:8080 --images ~/snapshots --concurrency 8 --requests 500
+# without a card - the server is started in this process on fake_hailo_platform with synthetic device latency:
+#   python -m benchmarks.load_test --stub --stub-latency-ms 25 --rate 40 --duration 30
+import argparse
+import asyncio
+import io
+import os
+import time
+from pathlib import Path
+
+import aiohttp
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+STUB_PORT = 8091
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test for the object detection endpoints')
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help='server URL, ignored with --stub')
+    parser.add_argument('--endpoint', default='/v1/vision/detection')
+    parser.add_argument('--images', help='directory with images to replay, synthetic snapshots if not set')
+    parser.add_argument('--min-confidence', type=float, default=0.4)
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument('--concurrency', type=int, default=4, help='number of clients sending back-to-back requests')
+    load.add_argument('--rate', type=float, help='fixed request rate per second (open loop)')
+    parser.add_argument('--requests', type=int, default=200, help='total requests, ignored if --duration is set')
+    parser.add_argument('--duration', type=float, help='test duration in seconds')
+    parser.add_argument('--stub', action='store_true', help='start the server in-process on the fake Hailo device')
+    parser.add_argument('--stub-latency-ms', type=float, default=20.0, help='synthetic device time per frame')
+    return parser.parse_args()
+
+
+def load_images(images_dir):
+    if images_dir:
+        paths = sorted(p for p in Path(images_dir).expanduser().iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+        if not paths:
+            raise SystemExit(f'No images found in {images_dir}')
+        return [(p.name, p.read_bytes()) for p in paths]
+    # camera-like snapshots: smooth gradients with noise, at usual camera resolutions
+    rng = np.random.default_rng(0)
+    images = []
+    for i, (width, height) in enumerate([(1280, 720), (1920, 1080), (2560, 1440), (3840, 2160)]):
+        y, x = np.mgrid[0:height, 0:width]
+        image = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+        image = np.clip(image + rng.normal(0, 8, size=image.shape), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(image).save(buffer, 'JPEG', quality=85)
+        images.append((f'synthetic_{i}.jpg', buffer.getvalue()))
+    return images
+
+
+class Results:
+    def __init__(self):
+        self.client_ms = []
+        self.server = {'analysisRoundTripMs': [], 'processMs': [], 'inferenceMs': []}
+        self.statuses = {}
+        self.errors = 0
+
+    def add(self, status, client_ms, response):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status != 200 or response is None:
+            self.errors += 1
+            return
+        self.client_ms.append(client_ms)
+        for key, values in self.server.items():
+            if key in response:
+                values.append(response[key])
+
+
+async def send_request(session, url, image, min_confidence, results: Results):
+    filename, content = image
+    form = aiohttp.FormData()
+    form.add_field('image', content, filename=filename, content_type='image/jpeg')
+    form.add_field('min_confidence', str(min_confidence))
+    start = time.perf_counter()
+    try:
+        async with session.post(url, data=form) as response:
+            body = await response.json(content_type=None) if response.status == 200 else None
+            results.add(response.status, (time.perf_counter() - start) * 1000, body)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        results.add('failed', (time.perf_counter() - start) * 1000, None)
+
+
+async def run_concurrent(session, url, images, args, results):
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    counter = iter(range(args.requests)) if not deadline else None
+
+    async def client():
+        while True:
+            if deadline:
+                if time.perf_counter() >= deadline:
+                    return
+                i = len(results.client_ms) + results.errors
+            else:
+                i = next(counter, None)
+                if i is None:
+                    return
+            await send_request(session, url, images[i % len(images)], args.min_confidence, results)
+
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+
+
+async def run_fixed_rate(session, url, images, args, results):
+    total = int(args.duration * args.rate) if args.duration else args.requests
+    start = time.perf_counter()
+    tasks = []
+    for i in range(total):
+        # open loop: requests are sent on schedule whether or not the previous ones are done
+        delay = start + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send_request(session, url, images[i % len(images)],
+                                                      args.min_confidence, results)))
+    await asyncio.gather(*tasks)
+
+
+def report(logger, results: Results, elapsed: float, args):
+    mode = f'fixed rate {args.rate}/s' if args.rate else f'{args.concurrency} concurrent clients'
+    total = len(results.client_ms) + results.errors
+    logger.info('%s, %d requests in %.1f s: %.1f req/s, %d errors, statuses %s',
+                mode, total, elapsed, len(results.client_ms) / elapsed, results.errors, results.statuses)
+    logger.info(f'{"ms":>20} {"p50":>8} {"p95":>8} {"p99":>8} {"max":>8}')
+    for name, values in [('client roundtrip', results.client_ms)] + list(results.server.items()):
+        if values:
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            logger.info(f'{name:>20} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f} {max(values):>8.1f}')
+
+
+async def main(args):
+    runner = None
+    url = args.url
+    if args.stub:
+        # must be set before config.py and fake_hailo_platform.py are imported
+        os.environ['HAILO_FAKE'] = '1'
+        os.environ['HAILO_FAKE_LATENCY_MS'] = str(args.stub_latency_ms)
+    from config import logger
+    if args.stub:
+        from aiohttp import web
+        from web_server import create_app
+        from startup import readiness
+        runner = web.AppRunner(create_app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', STUB_PORT).start()
+        await readiness.wait(time.perf_counter() + 60)
+        url = f'http://127.0.0.1:{STUB_PORT}'
+        logger.info('Started stub server with %.1f ms synthetic device latency per frame', args.stub_latency_ms)
+
+    images = load_images(args.images)
+    results = Results()
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+            start = time.perf_counter()
+            if args.rate:
+                await run_fixed_rate(session, url + args.endpoint, images, args, results)
+            else:
+                await run_concurrent(session, url + args.endpoint, images, args, results)
+            elapsed = time.perf_counter() - start
+    finally:
+        if runner:
+            await runner.cleanup()
+    report(logger, results, elapsed, args)
+
+
+if __name__ == '__main__':
+    # arguments are parsed before config.py is imported, it redirects stdout to the debug log
+    asyncio.run(main(parse_args()))
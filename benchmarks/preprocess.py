@@ -0,0 +1,67 @@
+# benchmark of letterbox preprocessing: the current engine (draft decoding, configured filter, pooled buffer)
+# against the former full decode + BICUBIC resize + Image.new + paste + np.array path
+# run from the repo root: python -m benchmarks.preprocess
+import io
+import timeit
+
+import numpy as np
+from PIL import Image
+
+from config import config, logger
+from inference_image import InferenceImage
+
+MODEL_SIZE = (640, 640)
+CAMERA_RESOLUTIONS = [(1280, 720), (1920, 1080), (2560, 1440), (3840, 2160)]
+
+
+def preprocess_legacy(image_bytes: bytes, model_w: int, model_h: int):
+    # the former InferenceImage.preprocess, kept here for comparison
+    image = Image.open(io.BytesIO(image_bytes))
+    img_w, img_h = image.size
+    scale = min(model_w / img_w, model_h / img_h)
+    new_img_w, new_img_h = int(img_w * scale), int(img_h * scale)
+    image_resized = image.resize((new_img_w, new_img_h), Image.Resampling.BICUBIC)
+    padded_image = Image.new('RGB', (model_w, model_h), config.padding_color)
+    pasted_w = (model_w - new_img_w) // 2
+    pasted_h = (model_h - new_img_h) // 2
+    padded_image.paste(image_resized, (pasted_w, pasted_h))
+    return np.array(padded_image)
+
+
+def preprocess_engine(image_bytes: bytes, model_w: int, model_h: int):
+    image = InferenceImage(io.BytesIO(image_bytes))
+    image.set_model_input_size(model_w, model_h)
+    frame = image.preprocess()
+    image.release_buffer()
+    return frame
+
+
+def make_camera_jpeg(width: int, height: int) -> bytes:
+    # smooth gradients with some noise compress like a real snapshot, unlike pure noise
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    image = np.clip(image + rng.normal(0, 8, size=image.shape), 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def main():
+    model_w, model_h = MODEL_SIZE
+    logger.info('Model input %dx%d, resample filter %s, JPEG draft %s',
+                model_w, model_h, config.resample_filter, config.jpeg_draft)
+    logger.info(f'{"resolution":>12} {"legacy, ms":>11} {"engine, ms":>11} {"speedup":>8} {"mean abs diff":>14}')
+    for width, height in CAMERA_RESOLUTIONS:
+        image_bytes = make_camera_jpeg(width, height)
+        number = 20
+        legacy_ms = timeit.timeit(lambda: preprocess_legacy(image_bytes, model_w, model_h), number=number) / number
+        engine_ms = timeit.timeit(lambda: preprocess_engine(image_bytes, model_w, model_h), number=number) / number
+        diff = np.abs(preprocess_legacy(image_bytes, model_w, model_h).astype(np.int16)
+                      - preprocess_engine(image_bytes, model_w, model_h).astype(np.int16)).mean()
+        logger.info(f'{f"{width}x{height}":>12} {legacy_ms * 1000:>11.1f} {engine_ms * 1000:>11.1f} '
+                    f'{legacy_ms / engine_ms:>7.1f}x {diff:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
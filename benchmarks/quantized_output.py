@@ -0,0 +1,188 @@
+# correctness check and micro-benchmark of quantized (UINT16) NMS outputs against FLOAT32 outputs, on the host side:
+# the FLOAT32 path, dequantizing the whole UINT16 output first, and extract_detections thresholding quantized scores
+# and dequantizing only the kept rows (config.py:Config:output_format = 'UINT16')
+#
+# record the outputs of a model in both formats once, on the card (or on fake_hailo_platform with HAILO_FAKE=1):
+#   python -m benchmarks.quantized_output --record outputs.npz --model yolov8m --images ~/snapshots
+# then compare and time them anywhere, no card needed:
+#   python -m benchmarks.quantized_output --recording outputs.npz
+# benchmarks/data/quantized_outputs.npz is used by default: synthetic outputs recorded on fake_hailo_platform (8 frames,
+# 3 random boxes each), quantized by the fake itself, so it checks the host side parsing, not tensors of a card;
+# with --recording '' synthetic outputs quantized the way the card does it are generated instead
+# (config.py sends stdout to debug log, so results are logged)
+import argparse
+import time
+import timeit
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.extract_detections import make_nms_output, NUM_CLASSES
+from config import config, logger
+from detections import extract_detections, dequantize
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+SYNTHETIC_QUANTIZATION = (1 / 65535, 0)
+DEFAULT_RECORDING = str(Path(__file__).parent / 'data' / 'quantized_outputs.npz')
+FAKE_SOURCE = 'fake_hailo_platform'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Quantized against float NMS outputs')
+    parser.add_argument('--recording', default=DEFAULT_RECORDING,
+                        help="outputs recorded with --record, '' for synthetic outputs")
+    parser.add_argument('--record', help='run the model in both output formats and save the outputs to this .npz')
+    parser.add_argument('--model', default=config.default_model_name, help='model to record')
+    parser.add_argument('--images', help='directory with images to record, synthetic frames if not set')
+    parser.add_argument('--frames', type=int, default=16, help='number of frames to record')
+    parser.add_argument('--threshold', type=float, default=0.4)
+    return parser.parse_args()
+
+
+def pack_outputs(outputs: list) -> tuple:
+    # per frame lists of per class (N, 5) arrays as one array of rows and a (frames, classes) array of counts
+    counts = np.array([[len(rows) for rows in output] for output in outputs], dtype=np.int64)
+    rows = np.concatenate([rows.reshape(-1, 5) for output in outputs for rows in output])
+    return rows, counts
+
+
+def unpack_outputs(rows: np.ndarray, counts: np.ndarray) -> list:
+    ends = np.cumsum(counts.ravel())
+    per_class = np.split(rows, ends[:-1])
+    num_classes = counts.shape[1]
+    return [per_class[i:i + num_classes] for i in range(0, len(per_class), num_classes)]
+
+
+def load_frames(model_name: str, images: str, num_frames: int) -> np.ndarray:
+    from hailo_infer import get_model_metadata
+    from inference_image import InferenceImage
+    model_h, model_w, _ = get_model_metadata(model_name)[0][0].shape
+    if not images:
+        rng = np.random.default_rng(0)
+        return rng.integers(0, 256, size=(num_frames, model_h, model_w, 3), dtype=np.uint8)
+    paths = sorted(p for p in Path(images).expanduser().iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+    frames = []
+    for path in paths[:num_frames]:
+        with open(path, 'rb') as f:
+            image = InferenceImage(f)
+            image.set_model_input_size(model_w, model_h)
+            frames.append(image.preprocess().copy())
+            image.release_buffer()
+    return np.stack(frames)
+
+
+def record(args):
+    from hailo_infer import get_output_quantization, get_model_metadata
+    from utils import HailoInference
+    frames = load_frames(args.model, args.images, args.frames)
+    recording = dict()
+    for output_format in ('FLOAT32', 'UINT16'):
+        hailo_inference = HailoInference(config.model_filename_dict[args.model], output_type=output_format)
+        try:
+            hailo_inference.open_session()
+            hailo_inference.run(frames[:1])
+            start_time = time.perf_counter()
+            outputs = [hailo_inference.run(frame[np.newaxis])[0] for frame in frames]
+            device_ms = (time.perf_counter() - start_time) / len(frames) * 1000
+        finally:
+            hailo_inference.release_device()
+        recording[f'{output_format}_rows'], recording[f'{output_format}_counts'] = pack_outputs(outputs)
+        logger.info(f'{output_format}: {device_ms:.2f} ms per frame on the device, output transfer included')
+    config.output_format = 'UINT16'
+    get_model_metadata(args.model)
+    recording['quantization'] = np.array(get_output_quantization(args.model), dtype=np.float64)
+    recording['source'] = np.array(FAKE_SOURCE if config.use_fake_hailo else 'device')
+    np.savez_compressed(args.record, **recording)
+    logger.info(f'{len(frames)} frames recorded to {args.record}')
+
+
+def load_recording(path: str):
+    """
+    Returns:
+        tuple: float outputs, quantized outputs, quantization and where they were recorded: 'device',
+            FAKE_SOURCE or 'unknown'.
+    """
+    recording = np.load(path)
+    float_outputs = unpack_outputs(recording['FLOAT32_rows'], recording['FLOAT32_counts'])
+    quantized_outputs = unpack_outputs(recording['UINT16_rows'], recording['UINT16_counts'])
+    source = str(recording['source']) if 'source' in recording.files else 'unknown'
+    return float_outputs, quantized_outputs, tuple(recording['quantization'].tolist()), source
+
+
+def make_synthetic_outputs():
+    rng = np.random.default_rng(0)
+    scale, zero_point = SYNTHETIC_QUANTIZATION
+    float_outputs, quantized_outputs = [], []
+    for num_boxes, num_busy_classes in [(0, 1), (5, 3), (50, 10), (300, 20), (1000, 40)]:
+        output = make_nms_output(num_boxes, num_busy_classes, rng)
+        float_outputs.append(output)
+        quantized_outputs.append([np.round(rows / scale + zero_point).astype(np.uint16) for rows in output])
+    return float_outputs, quantized_outputs, SYNTHETIC_QUANTIZATION
+
+
+def extract(output: list, threshold: float, quantization=None) -> dict:
+    num_classes = len(output)
+    return extract_detections(output, threshold, class_thresholds=np.zeros(num_classes, dtype=np.float32),
+                              top_k=None, allowed_classes=list(range(num_classes)), quantization=quantization)
+
+
+def dequantize_all(output: list, threshold: float, quantization: tuple) -> dict:
+    # the straightforward way: the whole output is converted to float, then parsed as a float output
+    return extract([dequantize(rows, quantization) for rows in output], threshold)
+
+
+def check_same_result(float_output: list, quantized_output: list, quantization: tuple, threshold: float) -> str:
+    # exactly what the card's float conversion of this output would give
+    expected = dequantize_all(quantized_output, threshold, quantization)
+    actual = extract(quantized_output, threshold, quantization)
+    assert expected['num_detections'] == actual['num_detections']
+    assert np.array_equal(expected['detection_classes'], actual['detection_classes'])
+    assert np.array_equal(expected['detection_scores'], actual['detection_scores'])
+    assert np.array_equal(expected['detection_boxes'], actual['detection_boxes'])
+    # against the float output of the card: boxes and scores are within one quantization step
+    reference = extract(float_output, threshold)
+    if reference['num_detections'] != actual['num_detections'] or \
+            not np.array_equal(reference['detection_classes'], actual['detection_classes']):
+        return f'{abs(reference["num_detections"] - actual["num_detections"])} at threshold'
+    if actual['num_detections'] == 0:
+        return 'same'
+    difference = max(np.abs(reference['detection_boxes'] - actual['detection_boxes']).max(),
+                     np.abs(reference['detection_scores'] - actual['detection_scores']).max())
+    return f'max diff {difference:.1e}'
+
+
+def main():
+    args = parse_args()
+    if args.record:
+        record(args)
+        return
+    if args.recording:
+        float_outputs, quantized_outputs, quantization, source = load_recording(args.recording)
+        if source == FAKE_SOURCE:
+            logger.info(f'{args.recording} is SYNTHETIC: recorded on fake_hailo_platform, float and quantized outputs '
+                        f'come from the fake, not from a card; record one on a card with --record for real tensors')
+        else:
+            logger.info(f'{args.recording} recorded on: {source}')
+    else:
+        float_outputs, quantized_outputs, quantization = make_synthetic_outputs()
+        logger.info('SYNTHETIC outputs generated here, see --recording')
+    num_classes = len(float_outputs[0]) if float_outputs else NUM_CLASSES
+    # the card sends a count and max_boxes rows per class, whatever the number of detections
+    logger.info(f'output per frame with 100 max boxes per class: FLOAT32 {num_classes * (1 + 500) * 4} bytes, '
+                f'UINT16 {num_classes * (1 + 500) * 2} bytes; quantization (scale, zero point) {quantization}')
+    logger.info(f'{"frame":>24} {"float32, us":>12} {"dequantize all, us":>19} {"fused, us":>10} {"vs float32":>18}')
+    for float_output, quantized_output in zip(float_outputs, quantized_outputs):
+        comparison = check_same_result(float_output, quantized_output, quantization, args.threshold)
+        number = 200
+        float_us = timeit.timeit(lambda: extract(float_output, args.threshold), number=number) / number * 1e6
+        all_us = timeit.timeit(lambda: dequantize_all(quantized_output, args.threshold, quantization),
+                               number=number) / number * 1e6
+        fused_us = timeit.timeit(lambda: extract(quantized_output, args.threshold, quantization),
+                                 number=number) / number * 1e6
+        num_boxes = sum(len(rows) for rows in float_output)
+        logger.info(f'{f"{num_boxes} boxes":>24} {float_us:>12.1f} {all_us:>19.1f} {fused_us:>10.1f} '
+                    f'{comparison:>18}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# micro-benchmark of building and encoding a detection response: the former format_detection_response with
+# json.dumps against responses.py with the stdlib json and with orjson (if installed)
+# run from the repo root: python -m benchmarks.responses
+# (config.py sends stdout to debug log, so results are logged)
+import json
+import timeit
+import uuid
+
+import numpy as np
+
+from config import config, logger
+from detections import build_predictions, labels
+import responses
+
+
+def get_common_response_former():
+    return dict({"requestId": str(uuid.uuid4()),
+                 "moduleId": config.get_api_module_id(),
+                 "moduleName": config.get_api_module_name(),
+                 "executionProvider": "TPU",
+                 "inferenceDevice": "TPU",
+                 "processedBy": "localhost",
+                 "canUseGPU": False})
+
+
+def format_detection_response_former(detection: dict, response_dict: dict):
+    # the former implementation, kept here for comparison
+    num_detections = detection['num_detections']
+    labels = detection["detection_labels"]
+    response_dict.update({"command": "detect",
+                          "count": num_detections,
+                          'inferenceMs': detection['inferenceMs'],
+                          'processMs': detection['processMs']})
+    if detection.get('success'):
+        response_dict.update({'success': detection.get('success')})
+    if num_detections == 0:
+        message = 'No objects found'
+    else:
+        deduped_labels = list(set(labels))
+        if len(deduped_labels) == 1:
+            message = f'Found {deduped_labels[0]}'
+        else:
+            message = f'Found {", ".join(deduped_labels)}'
+            message = message[:config.detect_msg_len]
+            comma_ind = message.rfind(',')
+            if comma_ind > config.detect_msg_len - 3:
+                message = message[:comma_ind]
+                comma_ind = message.rfind(',')
+                message = f'{message[:comma_ind]}...'
+    predictions = build_predictions(detection)
+    response_dict.update({'message': message, 'predictions': predictions})
+    return response_dict
+
+
+def respond_former(detection: dict) -> bytes:
+    # common response was built twice per request: at the start and again for the model fields
+    response = get_common_response_former()
+    updated = get_common_response_former()
+    response['moduleId'] = updated['moduleId']
+    response['moduleName'] = updated['moduleName']
+    return json.dumps(format_detection_response_former(detection, response)).encode()
+
+
+def respond(detection: dict) -> bytes:
+    return responses.encode(responses.build_detection_response(detection, responses.new_response()))
+
+
+def make_detection(num_detections: int, rng: np.random.Generator) -> dict:
+    classes = rng.integers(0, 20, size=num_detections)
+    return {'num_detections': num_detections,
+            'detection_scores': rng.uniform(0.4, 1, size=num_detections).astype(np.float32),
+            'detection_labels': [labels[i] for i in classes],
+            'absolute_boxes': rng.integers(0, 1920, size=(num_detections, 4)).astype(np.int32),
+            'inferenceMs': 12,
+            'processMs': 25,
+            'success': True}
+
+
+def check_message(expected: str, actual: str, labels: list):
+    # the former message had the labels in set order, the new one has them in the order of detection and as many as
+    # fit into config.detect_msg_len
+    unique_labels = list(dict.fromkeys(labels))
+    if len(unique_labels) <= 1:
+        assert expected == actual
+        return
+    assert actual.startswith('Found ')
+    shown = actual[len('Found '):].removesuffix('...').split(', ')
+    assert shown == unique_labels[:len(shown)]
+    if actual.endswith('...'):
+        assert len(f'Found {", ".join(unique_labels[:len(shown) + 1])}') > config.detect_msg_len
+    else:
+        assert shown == unique_labels
+        assert len(actual) <= config.detect_msg_len or len(shown) == 1
+
+
+def check_same_result(detection: dict):
+    expected = json.loads(respond_former(detection))
+    actual = json.loads(respond(detection))
+    assert expected['predictions'] == actual['predictions']
+    assert {key: value for key, value in expected.items() if key not in ('requestId', 'message')} == \
+           {key: value for key, value in actual.items() if key not in ('requestId', 'message')}
+    check_message(expected['message'], actual['message'], detection['detection_labels'])
+
+
+def main():
+    rng = np.random.default_rng(0)
+    backends = [('json', False)] + ([('orjson', True)] if responses.orjson is not None else [])
+    logger.info(f'{"scene":>28} {"former, us":>11} ' + ' '.join(f'{name + ", us":>11}' for name, _ in backends))
+    for num_detections, scene in [(0, 'empty'), (5, 'few objects'), (50, 'street'), (300, 'crowded')]:
+        detection = make_detection(num_detections, rng)
+        check_same_result(detection)
+        number = 500
+        former_us = timeit.timeit(lambda: respond_former(detection), number=number) / number * 1e6
+        results = []
+        for _, fast_json in backends:
+            config.fast_json = fast_json
+            results.append(timeit.timeit(lambda: respond(detection), number=number) / number * 1e6)
+        logger.info(f'{f"{scene} ({num_detections} boxes)":>28} {former_us:>11.1f} '
+                    + ' '.join(f'{us:>11.1f}' for us in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import logging
+import os
 import sys
-import uuid
 from os import listdir
 from os.path import isfile, join
 
@@ -37,14 +37,114 @@ class Config:
     def __init__(self):
         self.labels_filename = "models/coco.txt"
         self.output_images_path = "output_images"
-        self.batch_size = 1  # default to 1 then decide if we want to handle multiple (doubtful)
+        # visualization images are deleted above any of these limits, least recently used first
+        self.output_images_max_files = 200
+        self.output_images_max_bytes = 200 * 1024 * 1024
+        self.output_images_max_age_s = 60 * 60
+        self.visualization_max_pending = 16  # visualization requests get 503 while this many images wait for rendering
+        self.batch_size = 8  # max frames of concurrent requests sent to the device in one call
+        self.batch_window_ms = 5  # max time a frame waits for other frames that are still being preprocessed
         self.padding_color = (114, 114, 114)
+        # PIL resampling filter for letterboxing: NEAREST, BOX, BILINEAR, HAMMING, BICUBIC or LANCZOS
+        self.resample_filter = 'BILINEAR'
+        self.jpeg_draft = True  # decode JPEGs at reduced scale (1/2, 1/4, 1/8) when they are much bigger than the model
         self.default_confidence_score = 0.6
+        self.class_confidence_scores = dict()  # per label min confidence on top of the requested one, e.g. {'car': 0.7}
+        self.allowed_labels = None  # only these labels are reported if set, e.g. ['person', 'car', 'dog']
+        self.max_detections = None  # keep only this many detections with the highest scores if set
         self.model_folder = 'models'
         self.default_model_name = 'yolov7e6'
         self.current_model_name = None
         self.model_filename_dict = dict()
         self.detect_msg_len = 25
+        self.fast_json = True  # encode responses with orjson if it is installed
+        self.max_upload_bytes = 20 * 1024 * 1024  # bigger uploads are rejected with 413 before being read completely
+        self.upload_chunk_size = 64 * 1024  # uploads are read in chunks of this size into pooled buffers
+        # batch endpoint: images of one request read, preprocessed and inferred at the same time, each of them also
+        # takes an admission slot; zip and tar bodies are read whole, up to batch_max_upload_bytes
+        self.batch_max_in_flight = 2 * self.batch_size
+        self.batch_max_upload_bytes = 256 * 1024 * 1024
+        # WebSocket streams: frames of one connection in the pipeline at the same time; when all of them are busy,
+        # a new frame waits for its turn or, with dropping, replaces the frame that waits, which is reported as dropped
+        self.stream_max_in_flight = 4
+        self.stream_drop_frames = False  # default of the 'drop' query parameter
+        # models configured on the device at the same time, least recently used one is released above this limit
+        self.max_resident_models = 2
+        self.resident_models = []  # models to load at start in addition to the default one, e.g. ['yolov8m']
+        # keep vstreams built and the network group activated between requests instead of per inference call
+        self.persistent_session = True
+        # threads for image decoding, resizing and postprocessing; the device itself is always driven by one thread
+        self.cpu_workers = min(4, os.cpu_count() or 1)
+        # 'sync' - InferVStreams pipeline (utils.HailoInference);
+        # 'async' - HailoRT async API (utils.HailoAsyncInference), several frames are on the device at the same time
+        self.inference_backend = 'sync'
+        self.async_max_in_flight = 4  # max frames submitted to the device and not completed yet, 'async' backend only
+        # 'FLOAT32' - the card dequantizes the NMS output; 'UINT16' - the card sends its native quantized output,
+        # half the bytes over PCIe, and only detections above the threshold are dequantized on the host
+        self.output_format = 'FLOAT32'
+        # detections of identical uploads (same bytes, model and confidence bucket) are served from memory
+        self.result_cache = True
+        self.result_cache_ttl_s = 30
+        self.result_cache_max_entries = 512
+        self.result_cache_max_bytes = 16 * 1024 * 1024
+        # results are computed at the bucket's lower edge and filtered to the requested min_confidence
+        self.result_cache_confidence_step = 0.05
+        # per camera scene change gate: frames that barely differ from the last inferred frame of the same camera
+        # reuse its detections instead of running the model
+        self.scene_gate = False
+        # 'camera_id' - only requests with a 'camera_id' form field are gated;
+        # 'filename' - the uploaded file name is used if there is no 'camera_id' field, only safe if every camera
+        # uploads under a name of its own (not e.g. 'snapshot.jpg' from all of them)
+        self.scene_gate_key = 'camera_id'
+        self.scene_gate_threshold = 3.0  # mean abs difference of brightness normalized thumbnails, 0-255 gray levels
+        self.scene_gate_thumb_size = (32, 32)
+        self.scene_gate_max_cameras = 64
+        self.scene_gate_max_age_s = 30  # the scene is inferred again at least this often
+        # tiled mode for small distant objects: the original image is cut into overlapping tiles of the model input
+        # size, all of them go to the device as one batch; per request with a 'tiled' form field or per model
+        self.tiled_models = []  # models always run tiled, e.g. ['yolov8m']
+        self.tile_overlap = 0.2  # part of a tile shared with its neighbour
+        self.tile_full_frame = True  # the whole frame is inferred too, for objects bigger than a tile
+        self.tile_max_tiles = 6  # tiles are made bigger (and scaled down to the model input) to stay within this
+        self.tile_merge = 'nms'  # duplicates across tile seams: 'nms' keeps the best box, 'wbf' averages them
+        self.tile_merge_threshold = 0.6  # boxes of a class overlapping more (of the smaller box) are duplicates
+        # detection zones: polygons of [x, y] points as fractions of the frame width and height, per camera
+        # ('camera_id' form field or the uploaded file name) or per request with a 'zone' form field of the same JSON;
+        # only detections with the box center inside the zone are reported
+        self.camera_zones = dict()  # e.g. {'driveway': [[0.1, 0.5], [0.6, 0.4], [0.9, 1.0], [0.0, 1.0]]}
+        self.zone_crop = True  # the model sees only the bounding box of the zone, at a higher resolution
+        self.server_port = 8080
+        # the server answers right away while the cards are opened and every preloaded model is warmed up with
+        # warmup_frames synthetic snapshots of warmup_image_size, detection requests wait for that (up to their deadline)
+        self.warmup_frames = 4  # sent at the same time, so batching is warmed up too; 0 - no warm-up
+        self.warmup_image_size = (1920, 1080)
+        # HTTP worker processes sharing server_port (SO_REUSEPORT) that parse and preprocess requests and hand frames
+        # to this process, the only one that opens the cards, through shared memory; 0 - one process does everything
+        self.frontend_workers = 0
+        # shared memory per request, must fit a tiled request (tile_max_tiles tiles and the whole frame) of the biggest
+        # model input; None - computed from the models at startup
+        self.shm_slot_bytes = None
+        self.shm_acquire_timeout_s = 10  # a request waiting longer for a free slot fails instead of blocking a thread
+        self.device_ids = None  # ids of the Hailo cards to use, e.g. ['0000:01:00.0'], all found cards if None
+        # 'least_loaded' - a batch goes to the device with the fewest batches in flight; 'round_robin'
+        self.device_routing = 'least_loaded'
+        self.model_devices = dict()  # pins models to devices by index in device_ids, e.g. {'yolov8m': [1]}
+        # admission control: requests processed at the same time, more wait in a priority queue of a limited depth
+        self.max_active_requests = 2 * self.batch_size
+        self.max_queued_requests = 64
+        # lower number is served first, endpoints not listed get the lowest priority
+        self.endpoint_priorities = {'/v1/vision/detection': 0,
+                                    '/v1/vision/custom/{model_name}': 1,
+                                    '/v1/visualization/custom/{model_name}': 2,
+                                    '/v1/vision/detection/stream': 1,
+                                    '/v1/vision/custom/{model_name}/stream': 1,
+                                    '/v1/vision/detection/batch': 3,
+                                    '/v1/vision/custom/{model_name}/batch': 3}
+        self.deadline_header = 'X-Request-Timeout-Ms'  # client's time budget for a request, ms
+        self.default_deadline_ms = 10000  # requests not done by then are dropped before reaching the device
+        self.retry_after_s = 1  # Retry-After of 503 responses when the server is overloaded
+        # run against fake_hailo_platform instead of a real card, for development and testing without hardware
+        self.use_fake_hailo = os.environ.get('HAILO_FAKE', '0') == '1'
 
         self._collect_local_models()
 
@@ -57,12 +157,16 @@ class Config:
         model_files = [f for f in listdir(self.model_folder)
                        if isfile(join(self.model_folder, f)) and f.endswith('.hef')]
         self.model_filename_dict = {f[:-4].replace('.', '_'): f'{self.model_folder}/{f}' for f in model_files}
+        if self.use_fake_hailo:
+            # fake device does not read HEF files, so the default model is always available
+            self.model_filename_dict.setdefault(self.default_model_name,
+                                                f'{self.model_folder}/{self.default_model_name}.hef')
 
-    def get_api_module_name(self):
-        return f'Object Detection ({self.current_model_name})'
+    def get_api_module_name(self, model_name=None):
+        return f'Object Detection ({model_name or self.get_current_model_name()})'
 
-    def get_api_module_id(self):
-        return f'ObjectDetection{self.current_model_name.upper()}'
+    def get_api_module_id(self, model_name=None):
+        return f'ObjectDetection{(model_name or self.get_current_model_name()).upper()}'
 
     def get_model_filename(self):
         return self.model_filename_dict[self.current_model_name]
@@ -70,14 +174,5 @@ class Config:
     def get_model_list(self):
         return list(self.model_filename_dict.keys())
 
-    def get_common_response(self):
-        return dict({"requestId": str(uuid.uuid4()),
-                     "moduleId": self.get_api_module_id(),
-                     "moduleName": self.get_api_module_name(),
-                     "executionProvider": "TPU",
-                     "inferenceDevice": "TPU",
-                     "processedBy": "localhost",
-                     "canUseGPU": False})
-
 
 config = Config()
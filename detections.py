@@ -0,0 +1,332 @@
+# parsing of the model NMS output, kept apart from hailo_infer.py so it can be used without a device
+from typing import Optional
+
+import numpy as np
+
+from config import config
+
+
+def get_labels(labels_path: str) -> [str]:
+    """
+    Load labels from a file.
+
+    Args:
+        labels_path (str): Path to the labels file.
+
+    Returns:
+        list: List of class names.
+    """
+    with open(labels_path, 'r', encoding="utf-8") as f:
+        class_names = f.read().splitlines()
+    return class_names
+
+
+labels = get_labels(config.labels_filename)
+
+
+def get_class_ids(class_labels) -> [int]:
+    """
+    Convert class labels to class ids of the labels file, unknown labels are skipped.
+    """
+    return [labels.index(label) for label in class_labels if label in labels]
+
+
+def _build_class_filter(num_classes: int):
+    class_thresholds = np.zeros(num_classes, dtype=np.float32)
+    for label, score in config.class_confidence_scores.items():
+        if label in labels and labels.index(label) < num_classes:
+            class_thresholds[labels.index(label)] = score
+    allowed_classes = None
+    if config.allowed_labels is not None:
+        allowed_classes = [i for i in get_class_ids(config.allowed_labels) if i < num_classes]
+    return class_thresholds, allowed_classes
+
+
+_class_filters = dict()
+
+
+def get_class_filter(num_classes: int):
+    """
+    Per class thresholds and allowed class ids from config, built once per number of classes and config values,
+    so changes of config.class_confidence_scores and config.allowed_labels apply to the next call.
+
+    Returns:
+        tuple: (np.ndarray of per class min scores, 0 where not set; list of allowed class ids or None for all)
+    """
+    allowed_labels = None if config.allowed_labels is None else tuple(config.allowed_labels)
+    key = (num_classes, frozenset(config.class_confidence_scores.items()), allowed_labels)
+    class_filter = _class_filters.get(key)
+    if class_filter is None:
+        if len(_class_filters) >= 256:
+            _class_filters.clear()
+        class_filter = _build_class_filter(num_classes)
+        _class_filters[key] = class_filter
+    return class_filter
+
+
+def dequantize(values: np.ndarray, quantization: tuple) -> np.ndarray:
+    """
+    Float values of a quantized output, the same way the card converts them: (q - zero_point) * scale.
+
+    Args:
+        values (np.ndarray): Quantized values.
+        quantization (tuple): (scale, zero_point) of the output layer.
+
+    Returns:
+        np.ndarray: float32 values of the same shape.
+    """
+    scale, zero_point = quantization
+    return (values.astype(np.float32) - np.float32(zero_point)) * np.float32(scale)
+
+
+def quantize_thresholds(thresholds: np.ndarray, quantization: tuple) -> np.ndarray:
+    """
+    Smallest quantized scores that dequantize to at least the thresholds, so quantized scores are compared as they
+    are and keep exactly the detections the float scores would keep.
+
+    Args:
+        thresholds (np.ndarray): Float min scores.
+        quantization (tuple): (scale, zero_point) of the output layer.
+
+    Returns:
+        np.ndarray: float32 quantized min scores.
+    """
+    scale, zero_point = quantization
+    # float scores are compared in float32 too
+    thresholds = np.asarray(thresholds, dtype=np.float32)
+    quantized = np.ceil(thresholds.astype(np.float64) / scale + zero_point).astype(np.float32)
+    # float32 rounding of the dequantized value may move the edge by one step
+    quantized -= dequantize(quantized - 1, quantization) >= thresholds
+    quantized += dequantize(quantized, quantization) < thresholds
+    return quantized
+
+
+_quantized_thresholds = dict()
+
+
+def get_quantized_thresholds(threshold: float, class_thresholds: np.ndarray, quantization: tuple) -> np.ndarray:
+    """
+    Per class quantized min scores, built once per threshold, class thresholds and quantization.
+    """
+    key = (threshold, quantization, class_thresholds.tobytes())
+    min_scores = _quantized_thresholds.get(key)
+    if min_scores is None:
+        if len(_quantized_thresholds) >= 256:
+            _quantized_thresholds.clear()
+        min_scores = quantize_thresholds(np.maximum(class_thresholds, threshold), quantization)
+        _quantized_thresholds[key] = min_scores
+    return min_scores
+
+
+def extract_detections(input_data,
+                       threshold: Optional[float] = None,
+                       class_thresholds: Optional[np.ndarray] = None,
+                       top_k: Optional[int] = None,
+                       allowed_classes: Optional[list] = None,
+                       quantization: Optional[tuple] = None):
+    """
+    Extract detections from the input data.
+
+    Args:
+        input_data (list): Raw detections from the model, one (N, 5) array per class,
+            rows are [ymin, xmin, ymax, xmax, score].
+        threshold (float): Score threshold for filtering detections, config.default_confidence_score if None.
+        class_thresholds (np.ndarray): Per class score thresholds, the higher of it and threshold is used.
+            Taken from config.class_confidence_scores if None.
+        top_k (int): Keep only top_k detections with the highest scores, config.max_detections if None
+            (all if that is None too).
+        allowed_classes (list): Class ids to keep, others are dropped before any processing, ids the output
+            does not have are ignored. Taken from config.allowed_labels if None.
+        quantization (tuple): (scale, zero_point) if input_data is in the quantized format of the card;
+            scores are thresholded quantized and only the kept rows are dequantized.
+
+    Returns:
+        dict: Filtered detection results, boxes (N, 4), classes (N,) and scores (N,) as contiguous arrays.
+    """
+    num_classes = len(input_data)
+    # config is read per call, so it can be changed at runtime
+    if threshold is None:
+        threshold = config.default_confidence_score
+    if top_k is None:
+        top_k = config.max_detections
+    if class_thresholds is None or allowed_classes is None:
+        config_thresholds, config_allowed = get_class_filter(num_classes)
+        class_thresholds = config_thresholds if class_thresholds is None else class_thresholds
+        allowed_classes = config_allowed if allowed_classes is None else allowed_classes
+    class_ids = range(num_classes) if allowed_classes is None else [i for i in allowed_classes if 0 <= i < num_classes]
+
+    # concatenate non-empty per class outputs once
+    non_empty = [i for i in class_ids if len(input_data[i]) > 0]
+    if not non_empty:
+        return {
+            'detection_boxes': np.empty((0, 4), dtype=np.float32),
+            'detection_classes': np.empty(0, dtype=np.int64),
+            'detection_scores': np.empty(0, dtype=np.float32),
+            'num_detections': 0
+        }
+    per_class = [input_data[i] for i in non_empty]
+    classes = np.repeat(non_empty, [len(detection) for detection in per_class])
+
+    if quantization is None:
+        rows = np.concatenate(per_class, dtype=np.float32).reshape(-1, 5)
+        scores = rows[:, 4]
+        mask = (scores >= threshold) & (scores >= class_thresholds[classes])
+    else:
+        rows = np.concatenate(per_class).reshape(-1, 5)
+        mask = rows[:, 4] >= get_quantized_thresholds(threshold, class_thresholds, quantization)[classes]
+    rows = rows[mask]
+    classes = classes[mask]
+    if top_k is not None and len(rows) > top_k:
+        order = np.argsort(-rows[:, 4], kind='stable')[:top_k]
+        rows = rows[order]
+        classes = classes[order]
+    if quantization is not None:
+        rows = dequantize(rows, quantization)
+
+    return {
+        'detection_boxes': np.ascontiguousarray(rows[:, :4]),
+        'detection_classes': classes,
+        'detection_scores': np.ascontiguousarray(rows[:, 4]),
+        'num_detections': len(rows)
+    }
+
+
+def filter_detections(detection: dict, threshold: float) -> dict:
+    """
+    Keep detections with score at or above threshold, on already postprocessed and labelled results.
+
+    Args:
+        detection (dict): Detections as returned by do_inference.
+        threshold (float): Min score.
+
+    Returns:
+        dict: Shallow copy of detection with the arrays and labels filtered, the input is not modified.
+    """
+    return mask_detections(detection, np.asarray(detection['detection_scores']) >= threshold)
+
+
+def mask_detections(detection: dict, mask: np.ndarray) -> dict:
+    """
+    Keep detections where mask is True.
+
+    Args:
+        detection (dict): Detections with the arrays and, optionally, labels and absolute boxes.
+        mask (np.ndarray): (N,) bool.
+
+    Returns:
+        dict: Shallow copy of detection with the arrays and labels filtered, the input is not modified.
+    """
+    filtered = dict(detection)
+    if mask.all():
+        return filtered
+    for key in ('detection_boxes', 'detection_classes', 'detection_scores', 'absolute_boxes'):
+        if key in detection:
+            filtered[key] = np.asarray(detection[key])[mask]
+    if 'detection_labels' in detection:
+        filtered['detection_labels'] = [label for label, keep in zip(detection['detection_labels'], mask) if keep]
+    filtered['num_detections'] = int(mask.sum())
+    return filtered
+
+
+def points_in_polygon(points: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    """
+    Even-odd rule test of all points against all polygon edges at once.
+
+    Args:
+        points (np.ndarray): (N, 2) [x, y] points.
+        polygon (np.ndarray): (K, 2) [x, y] vertices.
+
+    Returns:
+        np.ndarray: (N,) bool, True for points inside the polygon.
+    """
+    x, y = points[:, :1], points[:, 1:]
+    x0, y0 = polygon[:, 0], polygon[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    # edges crossing the horizontal line through the point, and where they cross it
+    crosses = (y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing_x = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    return np.count_nonzero(crosses & (x < crossing_x), axis=1) % 2 == 1
+
+
+def get_overlaps(boxes: np.ndarray) -> np.ndarray:
+    """
+    Intersection over the smaller box for all pairs of boxes, so a box cut by a tile edge still overlaps
+    the whole box of the same object.
+
+    Args:
+        boxes (np.ndarray): (N, 4) boxes [ymin, xmin, ymax, xmax].
+
+    Returns:
+        np.ndarray: (N, N) overlaps, 0 to 1.
+    """
+    top_left = np.maximum(boxes[:, np.newaxis, :2], boxes[np.newaxis, :, :2])
+    bottom_right = np.minimum(boxes[:, np.newaxis, 2:], boxes[np.newaxis, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    areas = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    smaller = np.minimum(areas[:, np.newaxis], areas[np.newaxis, :])
+    return intersection / np.maximum(smaller, 1e-9)
+
+
+def merge_detections(boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray,
+                     threshold: Optional[float] = None, method: Optional[str] = None):
+    """
+    Merge duplicate detections of the same object, e.g. from overlapping tiles.
+
+    Args:
+        boxes (np.ndarray): (N, 4) boxes [ymin, xmin, ymax, xmax], all in the same coordinates.
+        scores (np.ndarray): (N,) scores.
+        classes (np.ndarray): (N,) class ids, only boxes of the same class are merged.
+        threshold (float): Boxes overlapping more than this (intersection over the smaller box) are duplicates,
+            config.tile_merge_threshold if None.
+        method (str): 'nms' - the highest score box of the duplicates is kept;
+            'wbf' - duplicates are fused into a box averaged with score weights and the highest score;
+            config.tile_merge if None.
+
+    Returns:
+        tuple: boxes, scores and classes of the merged detections, highest score first.
+    """
+    threshold = config.tile_merge_threshold if threshold is None else threshold
+    method = config.tile_merge if method is None else method
+    order = np.argsort(-scores, kind='stable')
+    boxes, scores, classes = boxes[order], scores[order], classes[order]
+    overlaps = get_overlaps(boxes)
+    duplicates = (overlaps > threshold) & (classes[:, np.newaxis] == classes[np.newaxis, :])
+    # greedy: each box not taken yet takes its lower score duplicates that are not taken yet
+    owner = np.full(len(boxes), -1)
+    for i in range(len(boxes)):
+        if owner[i] < 0:
+            owner[(owner < 0) & duplicates[i]] = i
+            owner[i] = i
+    kept = np.flatnonzero(owner == np.arange(len(boxes)))
+    if method == 'wbf':
+        weights = np.zeros((len(boxes), len(boxes)), dtype=np.float32)
+        weights[owner, np.arange(len(boxes))] = scores
+        fused = weights[kept] @ boxes / weights[kept].sum(axis=1, keepdims=True)
+        return fused.astype(boxes.dtype), scores[kept], classes[kept]
+    return boxes[kept], scores[kept], classes[kept]
+
+
+def add_labels(detection: dict):
+    detection.update({'detection_labels': [labels[dt] for dt in detection['detection_classes']]})
+
+
+def build_predictions(detection: dict) -> list:
+    """
+    Build CodeProject.AI 'predictions' straight from the detection arrays.
+
+    Args:
+        detection (dict): Detections with 'detection_scores', 'detection_labels' and 'absolute_boxes'.
+
+    Returns:
+        list: Prediction dicts with confidence, label and x_min, y_min, x_max, y_max.
+    """
+    scores = np.asarray(detection['detection_scores']).tolist()
+    boxes = np.asarray(detection['absolute_boxes']).reshape(-1, 4).tolist()
+    return [{"confidence": score,
+             "label": label,
+             "x_min": box[1],
+             "y_min": box[0],
+             "x_max": box[3],
+             "y_max": box[2]
+             } for score, label, box in zip(scores, detection['detection_labels'], boxes)]
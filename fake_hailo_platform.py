@@ -0,0 +1,350 @@
+# a minimal stand-in for the parts of hailo_platform used by this server, so the device lifecycle and the whole
+# request path can be exercised on a machine without a Hailo card. Enabled with HAILO_FAKE=1, see config.py
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from enum import Enum
+
+import numpy as np
+
+FAKE_INPUT_SHAPE = (640, 640, 3)
+FAKE_NUM_CLASSES = 80
+FAKE_DETECTIONS_PER_FRAME = 3
+FAKE_NMS_QUANTIZATION = (1 / 65535, 0)  # (scale, zero_point) of UINT16 NMS outputs, boxes and scores are 0 to 1
+FAKE_MAX_NETWORK_GROUPS = 3  # how many models fit on the fake card at the same time
+# synthetic device time per frame, to benchmark everything around the device on a machine without a card
+FAKE_LATENCY_MS = float(os.environ.get('HAILO_FAKE_LATENCY_MS', '0'))
+# number of fake cards found by Device.scan
+FAKE_DEVICES = int(os.environ.get('HAILO_FAKE_DEVICES', '1'))
+
+# lifecycle counters, handy to check that pipelines are not rebuilt per request
+stats = {'devices_created': 0,
+         'devices_released': 0,
+         'network_groups_configured': 0,
+         'network_groups_shutdown': 0,
+         'pipelines_opened': 0,
+         'pipelines_closed': 0,
+         'activations': 0,
+         'deactivations': 0,
+         'frames_inferred': 0,
+         'async_jobs': 0}
+
+
+class HailoRTException(Exception):
+    pass
+
+
+class FormatType(Enum):
+    AUTO = 'AUTO'
+    UINT8 = 'UINT8'
+    UINT16 = 'UINT16'
+    FLOAT32 = 'FLOAT32'
+
+
+class HailoStreamInterface(Enum):
+    PCIe = 'PCIe'
+
+
+class HailoSchedulingAlgorithm(Enum):
+    NONE = 'NONE'
+    ROUND_ROBIN = 'ROUND_ROBIN'
+
+
+class _Format:
+    def __init__(self, format_type):
+        self.type = format_type
+
+
+class _QuantInfo:
+    def __init__(self, qp_scale, qp_zp):
+        self.qp_scale = qp_scale
+        self.qp_zp = qp_zp
+
+
+class _VStreamInfo:
+    def __init__(self, name, shape, format_type, quant_info=None):
+        self.name = name
+        self.shape = shape
+        self.format = _Format(format_type)
+        self.quant_info = quant_info if quant_info else _QuantInfo(1.0, 0.0)
+
+
+class HEF:
+    def __init__(self, hef_path):
+        self.path = hef_path
+        self.name = hef_path.rsplit('/', 1)[-1][:-4]
+
+    def get_input_vstream_infos(self):
+        return [_VStreamInfo(f'{self.name}/input_layer1', FAKE_INPUT_SHAPE, FormatType.UINT8)]
+
+    def get_output_vstream_infos(self):
+        return [_VStreamInfo(f'{self.name}/yolov8_nms_postprocess', (FAKE_NUM_CLASSES, 5, 100), FormatType.FLOAT32,
+                             _QuantInfo(*FAKE_NMS_QUANTIZATION))]
+
+
+def fake_nms_output(frame: np.ndarray):
+    """
+    Build an NMS-by-class output for one frame: a list with one (N, 5) float32 array per class,
+    rows are [ymin, xmin, ymax, xmax, score] in normalized coordinates. Detections are derived from the frame content,
+    so the same frame always gives the same result.
+    """
+    rng = np.random.default_rng(int(frame[::64, ::64].sum()))
+    output = [np.empty((0, 5), dtype=np.float32) for _ in range(FAKE_NUM_CLASSES)]
+    for _ in range(FAKE_DETECTIONS_PER_FRAME):
+        cls = int(rng.integers(0, FAKE_NUM_CLASSES))
+        ymin, xmin = rng.uniform(0.0, 0.7, size=2)
+        h, w = rng.uniform(0.05, 0.3, size=2)
+        row = np.array([[ymin, xmin, ymin + h, xmin + w, rng.uniform(0.3, 1.0)]], dtype=np.float32)
+        output[cls] = np.concatenate([output[cls], row])
+    return output
+
+
+def fake_output(frame: np.ndarray, format_type):
+    """
+    NMS output of a frame in the requested format: float32, or quantized to uint16 with FAKE_NMS_QUANTIZATION
+    as the card does it. Like HailoRT, NMS outputs can not be UINT8.
+    """
+    output = fake_nms_output(frame)
+    if format_type in (None, FormatType.AUTO, FormatType.FLOAT32):
+        return output
+    if format_type != FormatType.UINT16:
+        raise HailoRTException(f'NMS output can not be {format_type.value}')
+    scale, zero_point = FAKE_NMS_QUANTIZATION
+    return [np.clip(np.round(rows / scale + zero_point), 0, 65535).astype(np.uint16) for rows in output]
+
+
+class ConfigureParams:
+    @staticmethod
+    def create_from_hef(hef, interface):
+        return {hef.name: {'interface': interface, 'batch_size': 1}}
+
+
+class InputVStreamParams:
+    @staticmethod
+    def make_from_network_group(network_group, format_type=None):
+        return {info.name: format_type for info in network_group.hef.get_input_vstream_infos()}
+
+
+class OutputVStreamParams:
+    @staticmethod
+    def make_from_network_group(network_group, format_type=None):
+        return {info.name: format_type for info in network_group.hef.get_output_vstream_infos()}
+
+
+class _NetworkGroup:
+    def __init__(self, device, hef, params):
+        self.device = device
+        self.hef = hef
+        self.params = params
+        self.is_active = False
+
+    def create_params(self):
+        return {}
+
+    def shutdown(self):
+        self.device.unconfigure(self)
+
+    @contextmanager
+    def activate(self, network_group_params=None):
+        if self.is_active:
+            raise HailoRTException('Network group is already activated')
+        self.is_active = True
+        stats['activations'] += 1
+        try:
+            yield self
+        finally:
+            self.is_active = False
+            stats['deactivations'] += 1
+
+
+class InferVStreams:
+    def __init__(self, network_group, input_vstreams_params, output_vstreams_params):
+        self.network_group = network_group
+        self.output_name = network_group.hef.get_output_vstream_infos()[0].name
+        self.output_format_type = output_vstreams_params[self.output_name]
+        self.is_open = False
+
+    def __enter__(self):
+        self.is_open = True
+        stats['pipelines_opened'] += 1
+        return self
+
+    def __exit__(self, *args):
+        self.is_open = False
+        stats['pipelines_closed'] += 1
+
+    def infer(self, input_data: dict):
+        if not self.is_open:
+            raise HailoRTException('Infer pipeline is not open')
+        if not (self.network_group.is_active or self.network_group.device.is_scheduled):
+            raise HailoRTException('Network group is not activated')
+        if self.network_group.device.is_released:
+            raise HailoRTException('Device was released')
+        frames = next(iter(input_data.values()))
+        time.sleep(FAKE_LATENCY_MS * len(frames) / 1000)
+        stats['frames_inferred'] += len(frames)
+        return {self.output_name: [fake_output(np.asarray(frame), self.output_format_type) for frame in frames]}
+
+
+class _InferStream:
+    def __init__(self, info):
+        self.name = info.name
+        self.shape = info.shape
+        self.format_type = info.format.type
+
+    def set_format_type(self, format_type):
+        self.format_type = format_type
+
+
+class _InferModel:
+    def __init__(self, device, hef):
+        self.device = device
+        self.hef = hef
+        self.batch_size = 1
+        self._input = _InferStream(hef.get_input_vstream_infos()[0])
+        self._outputs = {info.name: _InferStream(info) for info in hef.get_output_vstream_infos()}
+        self.output_names = list(self._outputs.keys())
+
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+
+    def input(self, name=None):
+        return self._input
+
+    def output(self, name=None):
+        return self._outputs[name] if name else next(iter(self._outputs.values()))
+
+    def configure(self):
+        configured_infer_model = _ConfiguredInferModel(self)
+        self.device.add_configured(configured_infer_model)
+        return configured_infer_model
+
+
+class _Buffer:
+    def __init__(self, buffer=None):
+        self.buffer = buffer
+
+    def set_buffer(self, buffer):
+        self.buffer = buffer
+
+    def get_buffer(self):
+        return self.buffer
+
+
+class _Bindings:
+    def __init__(self, output_buffers):
+        self._input = _Buffer()
+        self._output = _Buffer()
+        self.output_buffers = output_buffers
+
+    def input(self, name=None):
+        return self._input
+
+    def output(self, name=None):
+        return self._output
+
+
+class _CompletionInfo:
+    def __init__(self, exception=None):
+        self.exception = exception
+
+
+class _AsyncInferJob:
+    def __init__(self, future):
+        self.future = future
+
+    def wait(self, timeout_ms):
+        self.future.result(timeout=timeout_ms / 1000)
+
+
+class _ConfiguredInferModel:
+    def __init__(self, infer_model):
+        self.infer_model = infer_model
+        # completes jobs in submission order, like the device does
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fake-hailo')
+        self._lock = threading.Lock()
+
+    def create_bindings(self, output_buffers=None):
+        return _Bindings(output_buffers)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        self.infer_model.device.unconfigure(self)
+
+    def wait_for_async_ready(self, timeout_ms=1000):
+        pass
+
+    def _run_job(self, bindings_list, callback):
+        exception = None
+        try:
+            if self.infer_model.device.is_released:
+                raise HailoRTException('Device was released')
+            time.sleep(FAKE_LATENCY_MS * len(bindings_list) / 1000)
+            for bindings in bindings_list:
+                bindings.output().set_buffer(fake_output(np.asarray(bindings.input().get_buffer()),
+                                                         self.infer_model.output().format_type))
+            with self._lock:
+                stats['frames_inferred'] += len(bindings_list)
+                stats['async_jobs'] += 1
+        except Exception as e:
+            exception = e
+        callback(_CompletionInfo(exception))
+
+    def run_async(self, bindings_list, callback):
+        return _AsyncInferJob(self._executor.submit(self._run_job, bindings_list, callback))
+
+
+class Device:
+    @staticmethod
+    def scan():
+        return [f'0000:{i + 1:02x}:00.0' for i in range(FAKE_DEVICES)]
+
+
+class _VDeviceParams:
+    def __init__(self):
+        self.scheduling_algorithm = HailoSchedulingAlgorithm.NONE
+
+
+class VDevice:
+    def __init__(self, params=None, *, device_ids=None):
+        self.params = params if params else _VDeviceParams()
+        self.device_ids = device_ids if device_ids else Device.scan()[:1]
+        if any(device_id not in Device.scan() for device_id in self.device_ids):
+            raise HailoRTException(f'Device not found: {self.device_ids}')
+        self.is_scheduled = self.params.scheduling_algorithm != HailoSchedulingAlgorithm.NONE
+        self.is_released = False
+        self.configured = []
+        stats['devices_created'] += 1
+
+    @staticmethod
+    def create_params():
+        return _VDeviceParams()
+
+    def add_configured(self, network_group):
+        if self.is_released:
+            raise HailoRTException('Device was released')
+        if self.configured and not self.is_scheduled:
+            raise HailoRTException('Only one network group can be configured without the model scheduler')
+        if len(self.configured) >= FAKE_MAX_NETWORK_GROUPS:
+            raise HailoRTException('Out of physical resources')
+        self.configured.append(network_group)
+        stats['network_groups_configured'] += 1
+
+    def unconfigure(self, network_group):
+        if network_group in self.configured:
+            self.configured.remove(network_group)
+            stats['network_groups_shutdown'] += 1
+
+    def configure(self, hef, configure_params):
+        network_group = _NetworkGroup(self, hef, configure_params)
+        self.add_configured(network_group)
+        return [network_group]
+
+    def create_infer_model(self, hef_path):
+        return _InferModel(self, HEF(hef_path))
+
+    def release(self):
+        self.is_released = True
+        stats['devices_released'] += 1
@@ -1,139 +1,325 @@
 # most of the part is taken from https://github.com/hailo-ai/Hailo-Application-Code-Examples/blob/main/runtime/python/object_detection/object_detection.py
-import os
+import asyncio
+import functools
+import io
 import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Optional
-from PIL import Image
 
 import numpy as np
+from PIL import Image
 
 from config import config, logger
-from utils import HailoInference
+from utils import (HailoInference, HailoAsyncInference, HailoRTException, create_scheduled_vdevice, scan_devices,
+                   read_hef_metadata)
+from batcher import RequestBatcher, DeadlineExceeded
+import metrics
+from detections import add_labels
 from inference_image import InferenceImage
 from visualization import visualize
 
 
-def get_labels(labels_path: str) -> [str]:
-    """
-    Load labels from a file.
-
-    Args:
-        labels_path (str): Path to the labels file.
-
-    Returns:
-        list: List of class names.
+class HailoDevice:
     """
-    with open(labels_path, 'r', encoding="utf-8") as f:
-        class_names = f.read().splitlines()
-    return class_names
-
-
-labels = get_labels(config.labels_filename)
-
-
-def extract_detections(input_data, threshold:float = config.default_confidence_score):
+    Owns one scheduled VDevice with up to config.max_resident_models models configured on it at the same time.
+    The HailoRT model scheduler switches between them, so picking a model is a lookup, not a device restart.
+    Least recently used models are released when the limit is hit or the card runs out of resources.
+    All the calls go through self.executor, the only thread that ever touches this device.
     """
-    Extract detections from the input data.
-
-    Args:
-        input_data (list): Raw detections from the model.
-        threshold (float): Score threshold for filtering detections.
-
-    Returns:
-        dict: Filtered detection results.
-    """
-    boxes, scores, classes = [], [], []
-    num_detections = 0
-
-    for i, detection in enumerate(input_data):
-        if len(detection) == 0:
-            continue
-
-        for det in detection:
-            bbox, score = det[:4], det[4]
-
-            if score >= threshold:
-                boxes.append(bbox)
-                scores.append(score)
-                classes.append(i)
-                num_detections += 1
-
-    return {
-        'detection_boxes': boxes,
-        'detection_classes': classes,
-        'detection_scores': scores,
-        'num_detections': num_detections
-    }
-
-
-def add_labels(detection: dict):
-    detection.update({'detection_labels': [labels[dt] for dt in detection['detection_classes']]})
-
-
-class HailoDevice:
-    def __init__(self):
-        self.hailo_inference = None
+    def __init__(self, device_id: Optional[str] = None, index: int = 0):
+        self.device_id = device_id
+        self.index = index
+        self.name = device_id if device_id else str(index)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'hailo-device-{index}')
+        self.target = None
+        self.models = OrderedDict()
+        # model of the last batch on this device, for logs; the default model of requests is config's and never changes
+        self.current_model_name: Optional[str] = None
         self.is_initialized = False
+        # batches routed to this device and not finished yet, changed in the event loop only
+        self.queue_depth = 0
+        self.busy_since = None
 
     def start_device(self, model_name: Optional[str] = None):
         if not model_name:
             model_name = config.get_current_model_name()
-        logger.info('Starting Hailo device init with model %s', model_name)
-        config.current_model_name = model_name
-        self.hailo_inference = HailoInference(config.get_model_filename())
+        logger.info('Starting Hailo device %s init with model %s', self.name, model_name)
+        self.target = create_scheduled_vdevice(self.device_id)
         self.is_initialized = True
+        for resident_model_name in [model_name] + config.resident_models:
+            pinned = config.model_devices.get(resident_model_name)
+            if resident_model_name in config.model_filename_dict and (not pinned or self.index in pinned):
+                self.get_model(resident_model_name)
+        self.current_model_name = model_name
 
         logger.info('Finished Hailo device init')
 
-    async def change_model(self, model_name: str):
-        if model_name != config.get_current_model_name():
-            self.stop_device()
-            time.sleep(1)
-            self.start_device(model_name)
-            logger.info("Model was successfully changed to %s", model_name)
+    def _load_model(self, model_name: str):
+        if config.inference_backend == 'async':
+            hailo_inference = HailoAsyncInference(config.model_filename_dict[model_name],
+                                                  output_type=config.output_format,
+                                                  max_in_flight=config.async_max_in_flight,
+                                                  target=self.target)
+        else:
+            hailo_inference = HailoInference(config.model_filename_dict[model_name],
+                                             output_type=config.output_format, target=self.target)
+        if config.persistent_session:
+            hailo_inference.open_session()
+        return hailo_inference
+
+    def _evict_model(self):
+        model_name, hailo_inference = self.models.popitem(last=False)
+        hailo_inference.release_device()
+        metrics.model_swaps.inc(model_name, 'release')
+        logger.info('Model %s was released from the device', model_name)
+
+    def get_model(self, model_name: str):
+        if model_name in self.models:
+            self.models.move_to_end(model_name)
+            return self.models[model_name]
+        while len(self.models) >= max(1, config.max_resident_models):
+            self._evict_model()
+        while True:
+            try:
+                hailo_inference = self._load_model(model_name)
+                break
+            except HailoRTException:
+                if not self.models:
+                    raise
+                logger.warning('Not enough device resources to load %s', model_name)
+                self._evict_model()
+        self.models[model_name] = hailo_inference
+        metrics.model_swaps.inc(model_name, 'load')
+        logger.info('Model %s is loaded, resident models: %s', model_name, list(self.models.keys()))
+        return hailo_inference
+
+    def change_model(self, model_name: str):
+        hailo_inference = self.get_model(model_name)
+        self.current_model_name = model_name
+        return hailo_inference
+
+    def infer(self, model_name: str, infer_images: np.ndarray):
+        return self.change_model(model_name).run(infer_images)
+
+    def submit(self, model_name: str, infer_images: np.ndarray):
+        # 'async' backend only: returns one future per frame without waiting for the device
+        return self.change_model(model_name).submit(infer_images)
 
     def stop_device(self):
-        self.hailo_inference.release_device()
+        # closes persistent sessions, if any, before releasing the device
+        while self.models:
+            self._evict_model()
+        self.target.release()
         self.is_initialized = False
 
 
-hailo_device = HailoDevice()
-hailo_device.start_device()
+class DevicePool:
+    """
+    One HailoDevice with its own device thread per card, batches are routed to the least loaded device
+    (or round robin, see config.device_routing) among the devices the model may run on (config.model_devices).
+    """
+    def __init__(self):
+        self.devices: list[HailoDevice] = []
+        self._next = 0
+
+    @property
+    def is_initialized(self):
+        return any(device.is_initialized for device in self.devices)
+
+    def start(self, model_name: Optional[str] = None):
+        device_ids = config.device_ids if config.device_ids is not None else scan_devices()
+        logger.info('Hailo devices: %s', device_ids)
+        self.devices = [HailoDevice(device_id, index) for index, device_id in enumerate(device_ids or [None])]
+        # cards are initialized in parallel, each in its own thread
+        futures = [device.executor.submit(device.start_device, model_name) for device in self.devices]
+        for future in futures:
+            future.result()
+
+    def stop(self):
+        for device in self.devices:
+            if device.is_initialized:
+                device.executor.submit(device.stop_device).result()
+
+    def get_devices(self, model_name: str) -> list[HailoDevice]:
+        pinned = [self.devices[i] for i in config.model_devices.get(model_name, []) if i < len(self.devices)]
+        return pinned if pinned else self.devices
+
+    def pick_device(self, model_name: str) -> HailoDevice:
+        devices = self.get_devices(model_name)
+        # rotating the start makes ties of least loaded routing round robin too
+        start = self._next % len(devices)
+        self._next += 1
+        devices = devices[start:] + devices[:start]
+        if config.device_routing == 'round_robin':
+            return devices[0]
+        return min(devices, key=lambda device: device.queue_depth)
+
+    def _set_queue_depth(self, device: HailoDevice, delta: int):
+        device.queue_depth += delta
+        metrics.device_queue_depth.set(device.name, value=device.queue_depth)
+        # a device is busy while it has at least one batch, the rate of the counter is its utilization
+        if device.queue_depth == 1 and delta > 0:
+            device.busy_since = time.perf_counter()
+        elif device.queue_depth == 0:
+            metrics.device_busy_seconds.inc(device.name, amount=time.perf_counter() - device.busy_since)
+
+    async def run(self, model_name: str, infer_images: np.ndarray):
+        loop = asyncio.get_running_loop()
+        device = self.pick_device(model_name)
+        self._set_queue_depth(device, 1)
+        try:
+            if config.inference_backend == 'async':
+                # device thread is only busy while submitting, so the next batch can be submitted before this one
+                # is done
+                futures = await loop.run_in_executor(device.executor, device.submit, model_name, infer_images)
+                outputs = [await asyncio.wrap_future(future) for future in futures]
+            else:
+                outputs = await loop.run_in_executor(device.executor, device.infer, model_name, infer_images)
+        finally:
+            self._set_queue_depth(device, -1)
+        metrics.device_frames.inc(device.name, amount=len(infer_images))
+        return outputs
+
+
+# pre- and post-processing run in a pool, so decoding of the next request overlaps with inference of the current one
+cpu_executor = ThreadPoolExecutor(max_workers=config.cpu_workers, thread_name_prefix='cpu')
+
+# nothing touches the cards at import: in the process that owns them start_devices() sets up device_pool and batcher
+# (see startup.py), front-end worker processes replace both with a client of that process, see prefork.py
+device_pool = DevicePool()
+batcher: Optional[RequestBatcher] = None
+# model name -> (input layer infos, output layer infos), read from the HEF file without opening a device
+model_metadata = dict()
+
+
+async def run_batch(model_name: str, infer_images: np.ndarray):
+    metrics.batch_size.observe(len(infer_images), model_name)
+    return await device_pool.run(model_name, infer_images)
+
+
+def start_devices(model_name: Optional[str] = None):
+    global batcher
+    device_pool.start(model_name)
+    # enough batches in flight to keep every device busy
+    batcher = RequestBatcher(run_batch,
+                             max_in_flight=len(device_pool.devices) * (config.async_max_in_flight
+                                                                       if config.inference_backend == 'async' else 1))
+
+
+def use_remote_devices(client):
+    """
+    Send frames to the cards of another process: client has the device_pool (is_initialized, stop) and batcher (infer)
+    interfaces.
+    """
+    global device_pool, batcher
+    device_pool = client
+    batcher = client
+
+
+def get_model_metadata(model_name: str):
+    if model_name not in model_metadata:
+        input_infos, output_infos = read_hef_metadata(config.model_filename_dict[model_name])
+        for layer_info in input_infos + output_infos:
+            logger.info(f'{model_name} layer: {layer_info.name} {layer_info.shape} {layer_info.format.type}')
+        model_metadata[model_name] = input_infos, output_infos
+    return model_metadata[model_name]
 
 
-async def do_inference(image: InferenceImage,
-                       model_name: str,
-                       confidence_score: float = config.default_confidence_score,
-                       image_uuid: Optional[str] = None):
-    start_process_time = time.perf_counter()
-    await hailo_device.change_model(model_name)
+async def get_input_shape(model_name: str):
+    if model_name not in model_metadata:
+        await asyncio.get_running_loop().run_in_executor(cpu_executor, get_model_metadata, model_name)
+    input_infos, _ = model_metadata[model_name]
+    return tuple(input_infos[0].shape)  # models have one input
 
-    height, width, _ = hailo_device.hailo_inference.get_input_shape()
-    image.set_model_input_size(width, height)
 
-    logger.debug('Starting preprocess image')
-    infer_images = [image.preprocess()]
+def get_output_quantization(model_name: str) -> Optional[tuple]:
+    """
+    Returns:
+        tuple: (scale, zero_point) of the model output if the card sends it quantized (config.output_format),
+            None for float outputs.
+    """
+    if config.output_format == 'FLOAT32':
+        return None
+    quant_info = get_model_metadata(model_name)[1][0].quant_info
+    return quant_info.qp_scale, quant_info.qp_zp
 
-    logger.debug('Finished preprocess image; starting inference')
-    start_inference_time = time.perf_counter()
-    raw_detections = hailo_device.hailo_inference.run(np.array(infer_images))
-    logger.debug(raw_detections)
 
-    detections = extract_detections(raw_detections[0], confidence_score)
+def preprocess_image(image: InferenceImage, width: int, height: int):
+    image.set_model_input_size(width, height)
+    logger.debug('Starting preprocess image')
+    # a view of the pooled buffer, so the frames are not copied on the way to the device
+    infer_images = image.preprocess_batch()
+    logger.debug('Finished preprocess image')
+    return infer_images
 
-    inference_ms = int((time.perf_counter() - start_inference_time) * 1000)
 
+def postprocess_detections(image: InferenceImage, outputs: list, confidence_score: float,
+                           quantization: Optional[tuple] = None):
+    start_time = time.perf_counter()
+    detections = image.extract_detections(outputs, confidence_score, quantization)
+    extracted_time = time.perf_counter()
     logger.debug(detections)
     image.postprocess(detections)
     add_labels(detections)
+    image.timings['nms_extraction'] = extracted_time - start_time
+    image.timings['deletterbox'] = time.perf_counter() - extracted_time
+    return detections
 
-    detections.update({"processMs": int((time.perf_counter() - start_process_time) * 1000),
-                       "inferenceMs": inference_ms,
-                       "success": True})
 
-    if image_uuid:
-        image_path = os.path.join(config.output_images_path,f'{image_uuid}_{config.current_model_name}.jpg')
-        visualize(labels, detections, image.get_preprocessed_image(), image_path, width, height)
-        detections.update({'imagePath': f'{image_path}'})
+def visualize_detections(image_bytes: bytes, detections: dict, model_name: str, endpoint: str, image_path: str):
+    """
+    Draw detections on the original image and save it, runs in the background after the response is sent.
+    """
+    with metrics.stage_duration.time('visualization', model_name, endpoint):
+        visualize(detections, Image.open(io.BytesIO(image_bytes)), image_path)
 
-    return detections
 
+def release_when_preprocessed(future: Future, image: InferenceImage):
+    if not future.cancelled() and future.exception() is None:
+        image.release_buffer()
+
+
+async def do_inference(image: InferenceImage,
+                       model_name: str,
+                       confidence_score: float = config.default_confidence_score,
+                       endpoint: str = '',
+                       deadline: Optional[float] = None):
+    start_process_time = time.perf_counter()
+    loop = asyncio.get_running_loop()
+
+    height, width, _ = await get_input_shape(model_name)
+    preprocess_future = cpu_executor.submit(preprocess_image, image, width, height)
+    infer_images = asyncio.wrap_future(preprocess_future)
+
+    # frames of concurrent requests are collected by the batcher and sent to the device together
+    try:
+        job = await batcher.infer(model_name, infer_images, deadline, release=image.release_buffer)
+    except asyncio.CancelledError:
+        if infer_images.cancelled():
+            # the cpu thread may still be writing the frames into a buffer, it is released once it is done
+            preprocess_future.add_done_callback(functools.partial(release_when_preprocessed, image=image))
+        # otherwise the batcher has the frames and releases them once the device is done with them
+        raise
+    except BaseException:
+        # dropped before it was sent to the device, or the device failed: the buffer is free
+        image.release_buffer()
+        raise
+    logger.debug(job.outputs)
+    image.timings['device_queue_wait'] = job.start_time - job.enqueue_time
+    image.timings['device_inference'] = job.end_time - job.start_time
+
+    # the input buffer goes back to the pool only once the device is done with it
+    try:
+        detections = await loop.run_in_executor(cpu_executor, postprocess_detections,
+                                                image, job.outputs, confidence_score,
+                                                get_output_quantization(model_name))
+
+        detections.update({"processMs": int((time.perf_counter() - start_process_time) * 1000),
+                           "inferenceMs": job.inference_ms,
+                           "success": True})
+    finally:
+        image.release_buffer()
+
+    metrics.observe_stages(image.timings, model_name, endpoint)
+    return detections
@@ -1,14 +1,49 @@
 import io
+import json
+import math
+import time
+from typing import Optional
 from PIL import Image
 import numpy as np
 
+import preprocessing
 from config import config
+from detections import extract_detections, merge_detections, mask_detections, points_in_polygon
+from preprocessing import open_image, letterbox_into
+
+
+def parse_zone(points) -> np.ndarray:
+    """
+    Detection zone from a JSON string or a list of [x, y] points as fractions of the frame width and height.
+
+    Returns:
+        np.ndarray: (K, 2) float32 polygon.
+
+    Raises:
+        ValueError: Not a polygon of at least 3 points within the frame.
+    """
+    if isinstance(points, str):
+        points = json.loads(points)
+    zone = np.asarray(points, dtype=np.float32)
+    if zone.ndim != 2 or zone.shape[1] != 2 or len(zone) < 3 or zone.min() < 0 or zone.max() > 1:
+        raise ValueError('Zone must be a list of at least 3 [x, y] points with coordinates from 0 to 1')
+    return zone
 
 
 class InferenceImage:
-    def __init__(self, image_stream: io.BytesIO):
+    tiled = False
+
+    def __init__(self, image_stream: io.BytesIO, zone: Optional[np.ndarray] = None):
         self.image_stream = image_stream
+        self.zone = zone  # (K, 2) polygon as fractions of the frame, see parse_zone
         self.image = None
+        self.img_w = None
+        self.img_h = None
+        # part of the original image that is letterboxed: the bounding box of the zone or the whole image
+        self.crop_x = 0
+        self.crop_y = 0
+        self.crop_w = None
+        self.crop_h = None
         self.model_w = None
         self.model_h = None
         self.scale = None
@@ -17,59 +52,290 @@ class InferenceImage:
         self.pasted_w = None
         self.pasted_h = None
         self.padded_image = None
+        self.timings = dict()  # stage name -> seconds, see metrics.STAGES
 
     def set_model_input_size(self, model_w, model_h):
         self.model_w = model_w
         self.model_h = model_h
 
-    def preprocess(self):
+    def get_variant(self) -> str:
         """
-        Resize image with unchanged aspect ratio using padding.
+        Suffix of the model name for cached and gated results, images inferred differently do not share them.
+        """
+        variant = '/tiled' if self.tiled else ''
+        if self.zone is not None:
+            variant += '/zone' + ','.join(f'{value:g}' for value in self.zone.ravel())
+        return variant
 
-        Args:
-            image (PIL.Image.Image): Input image.
-            model_w (int): Model input width.
-            model_h (int): Model input height.
+    def get_crop_fractions(self) -> Optional[tuple]:
+        if self.zone is None or not config.zone_crop:
+            return None
+        (left, top), (right, bottom) = self.zone.min(axis=0), self.zone.max(axis=0)
+        return left, top, right, bottom
 
-        Returns:
-            PIL.Image.Image: Preprocessed and padded image.
+    def set_geometry(self, img_w, img_h):
+        """
+        Compute the crop, letterbox scale and padding for an original image size, the model input size must be set.
         """
-        self.image = Image.open(self.image_stream)
-        img_w, img_h = self.image.size
+        self.img_w, self.img_h = img_w, img_h
+        crop = self.get_crop_fractions()
+        if crop is None:
+            self.crop_x, self.crop_y, self.crop_w, self.crop_h = 0, 0, img_w, img_h
+        else:
+            left, top, right, bottom = crop
+            self.crop_x, self.crop_y = int(left * img_w), int(top * img_h)
+            self.crop_w = max(1, math.ceil(right * img_w) - self.crop_x)
+            self.crop_h = max(1, math.ceil(bottom * img_h) - self.crop_y)
         # Scale image
-        self.scale = min(self.model_w / img_w, self.model_h / img_h)
-        self.new_img_w, self.new_img_h = int(img_w * self.scale), int(img_h * self.scale)
-        image_resized = self.image.resize((self.new_img_w, self.new_img_h), Image.Resampling.BICUBIC)
-
-        # Create a new padded image
-        self.padded_image = Image.new('RGB', (self.model_w, self.model_h), config.padding_color)
+        self.scale = min(self.model_w / self.crop_w, self.model_h / self.crop_h)
+        self.new_img_w, self.new_img_h = int(self.crop_w * self.scale), int(self.crop_h * self.scale)
         self.pasted_w = (self.model_w - self.new_img_w) // 2
         self.pasted_h = (self.model_h - self.new_img_h) // 2
-        self.padded_image.paste(image_resized, (self.pasted_w, self.pasted_h))
-        return np.array(self.padded_image)
 
-    def get_preprocessed_image(self):
+    def preprocess(self):
+        """
+        Resize image with unchanged aspect ratio using padding, into a buffer from the pool.
+        The buffer belongs to this image until release_buffer is called.
+
+        Returns:
+            np.ndarray: Preprocessed and padded (model_h, model_w, 3) image.
+        """
+        start_time = time.perf_counter()
+        self.image, (img_w, img_h) = open_image(self.image_stream, self.model_w, self.model_h,
+                                                self.get_crop_fractions())
+        self.image.load()
+        decoded_time = time.perf_counter()
+        self.timings['decode'] = decoded_time - start_time
+        # draft mode may have reduced the decoded size, geometry is always relative to the original size
+        self.set_geometry(img_w, img_h)
+
+        self.padded_image = letterbox_into(self.get_crop(),
+                                           (self.new_img_w, self.new_img_h),
+                                           (self.pasted_w, self.pasted_h),
+                                           preprocessing.buffer_pool.acquire((self.model_h, self.model_w, 3)))
+        self.timings['letterbox'] = time.perf_counter() - decoded_time
         return self.padded_image
 
+    def get_crop(self) -> Image.Image:
+        # the decoded image may be smaller than the original one
+        if (self.crop_w, self.crop_h) == (self.img_w, self.img_h):
+            return self.image
+        ratio = self.image.width / self.img_w
+        return self.image.crop((round(self.crop_x * ratio), round(self.crop_y * ratio),
+                                round((self.crop_x + self.crop_w) * ratio), round((self.crop_y + self.crop_h) * ratio)))
+
+    def preprocess_batch(self):
+        """
+        Returns:
+            np.ndarray: (N, model_h, model_w, 3) frames to send to the device, a view of the pooled buffer.
+        """
+        return self.preprocess()[np.newaxis]
+
+    def extract_detections(self, outputs: list, threshold: float, quantization: Optional[tuple] = None) -> dict:
+        """
+        Detections from the raw outputs of the frames of preprocess_batch, boxes normalized to the letterboxed frame.
+        quantization is (scale, zero_point) of quantized outputs, see detections.extract_detections.
+        """
+        return extract_detections(outputs[0], threshold, quantization=quantization)
+
+    def release_buffer(self):
+        if self.padded_image is not None:
+            preprocessing.buffer_pool.release(self.padded_image)
+            self.padded_image = None
+
+    def get_preprocessed_image(self):
+        return Image.fromarray(self.padded_image)
+
     def postprocess(self, detection_results: dict):
-        # as of now just restore the original coordinates in the image
-        boxes = detection_results.get('detection_boxes')
-        absolute_boxes = []
-        for box in boxes:
-            abs_coords = []
-            for i, coord in enumerate(box):
-                if i % 2 == 0:
-                    # height (y) is first coming
-                    abs_coord = coord * self.model_h
-                    abs_coord -= self.pasted_h
-                else:
-                    # getting real coordinates first
-                    abs_coord = coord * self.model_w
-                    # get a coordinate without padding
-                    abs_coord -= self.pasted_w
-                # restore original coordinates
-                abs_coord /= self.scale
-                abs_coords.append(int(abs_coord))
-            absolute_boxes.append(abs_coords)
-
-        detection_results.update({'absolute_boxes': absolute_boxes})
+        """
+        Restore box coordinates in the original image: remove the padding, undo the scaling, add the crop offset
+        and clip to the crop bounds, all boxes at once. With a zone, detections centered outside of it are dropped.
+
+        Args:
+            detection_results (dict): Detections with normalized 'detection_boxes' [ymin, xmin, ymax, xmax],
+                gets 'absolute_boxes' as an (N, 4) int array in the same order.
+        """
+        boxes = np.asarray(detection_results.get('detection_boxes'), dtype=np.float32).reshape(-1, 4)
+        model_size = np.array([self.model_h, self.model_w, self.model_h, self.model_w], dtype=np.float32)
+        padding = np.array([self.pasted_h, self.pasted_w, self.pasted_h, self.pasted_w], dtype=np.float32)
+        crop_size = np.array([self.crop_h, self.crop_w, self.crop_h, self.crop_w], dtype=np.float32)
+        absolute_boxes = (boxes * model_size - padding) / self.scale
+        np.clip(absolute_boxes, 0, crop_size, out=absolute_boxes)
+        absolute_boxes += np.array([self.crop_y, self.crop_x, self.crop_y, self.crop_x], dtype=np.float32)
+
+        detection_results.update({'absolute_boxes': absolute_boxes.astype(np.int32)})
+        if self.zone is not None:
+            centers = np.stack([(absolute_boxes[:, 1] + absolute_boxes[:, 3]) / 2,
+                                (absolute_boxes[:, 0] + absolute_boxes[:, 2]) / 2], axis=1)
+            polygon = self.zone * np.array([self.img_w, self.img_h], dtype=np.float32)
+            detection_results.update(mask_detections(detection_results, points_in_polygon(centers, polygon)))
+
+
+class RawImage(InferenceImage):
+    """
+    Already decoded RGB frame, e.g. from a video pipeline. A frame of the model input size goes to the device
+    as it is, without a copy (copied into a shared memory slot in front-end workers, see prefork.py); any other size
+    is only letterboxed, there is nothing to decode.
+    """
+    def __init__(self, data, width: int, height: int, zone: Optional[np.ndarray] = None):
+        """
+        Args:
+            data: bytes-like object with width * height * 3 bytes, rows of RGB pixels.
+
+        Raises:
+            ValueError: The data is not width * height * 3 bytes.
+        """
+        if width <= 0 or height <= 0 or len(data) != width * height * 3:
+            raise ValueError(f'Raw frame of {len(data)} bytes is not a {width}x{height} RGB frame')
+        super().__init__(None, zone)
+        self.data = data
+        self.width = width
+        self.height = height
+        self.zero_copy = False
+
+    def preprocess(self):
+        start_time = time.perf_counter()
+        self.set_geometry(self.width, self.height)
+        if (self.crop_w, self.crop_h) == (self.width, self.height) == (self.model_w, self.model_h):
+            # scale 1 and no padding, so postprocess maps boxes back to the frame as they are
+            frame = np.frombuffer(self.data, dtype=np.uint8).reshape(self.model_h, self.model_w, 3)
+            if preprocessing.buffer_pool.shared:
+                # the device process only reads frames from the shared memory slots
+                self.padded_image = preprocessing.buffer_pool.acquire(frame.shape)
+                self.padded_image[...] = frame
+            else:
+                self.padded_image = frame
+                self.zero_copy = True
+        else:
+            self.image = Image.frombuffer('RGB', (self.width, self.height), self.data, 'raw', 'RGB', 0, 1)
+            self.padded_image = letterbox_into(self.get_crop(),
+                                               (self.new_img_w, self.new_img_h),
+                                               (self.pasted_w, self.pasted_h),
+                                               preprocessing.buffer_pool.acquire((self.model_h, self.model_w, 3)))
+        self.timings['letterbox'] = time.perf_counter() - start_time
+        return self.padded_image
+
+    def release_buffer(self):
+        if self.zero_copy:
+            # the frame is the client's data, not a pooled buffer
+            self.padded_image = None
+        super().release_buffer()
+
+
+def get_tile_positions(length: int, tile: int, overlap: float) -> list:
+    if tile >= length:
+        return [0]
+    count = math.ceil((length - tile) / (tile * (1 - overlap))) + 1
+    # evenly spread, the first and the last tiles are at the image edges
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def get_tiles(img_w: int, img_h: int, model_w: int, model_h: int, overlap: float, max_tiles: int) -> list:
+    """
+    Overlapping tiles covering the image, of the model input size or bigger if more than max_tiles are needed.
+
+    Returns:
+        list: (x, y, width, height) of the tiles in the original image.
+    """
+    scale = 1.0
+    while True:
+        tile_w, tile_h = min(img_w, round(model_w * scale)), min(img_h, round(model_h * scale))
+        xs = get_tile_positions(img_w, tile_w, overlap)
+        ys = get_tile_positions(img_h, tile_h, overlap)
+        if len(xs) * len(ys) <= max(1, max_tiles):
+            return [(x, y, tile_w, tile_h) for y in ys for x in xs]
+        scale *= 1.25
+
+
+class TiledImage(InferenceImage):
+    """
+    Image inferred as overlapping tiles at (close to) the original resolution plus, optionally, the whole frame,
+    so small distant objects are not lost to the downscaling. All the frames go to the device as one batch,
+    detections are mapped back to the original image and duplicates across tile seams are merged.
+    With a zone, the tiles cover the bounding box of the zone only.
+    Merged boxes are normalized to the letterboxed whole frame, so postprocess works as for any image.
+    """
+    tiled = True
+
+    def __init__(self, image_stream: io.BytesIO, zone: Optional[np.ndarray] = None):
+        super().__init__(image_stream, zone)
+        self.tiles = []  # (x, y, width, height) in the original image, relative to the crop
+        self.tile_scale = None
+        self.tile_pasted_w = None
+        self.tile_pasted_h = None
+        self.full_frame = config.tile_full_frame
+
+    def preprocess_batch(self):
+        """
+        Cut the image into tiles, each resized to the model input with padding, into one buffer from the pool.
+        The whole frame, if used, is the last one.
+
+        Returns:
+            np.ndarray: (N, model_h, model_w, 3) frames.
+        """
+        start_time = time.perf_counter()
+        image = Image.open(self.image_stream)
+        img_w, img_h = image.size
+        self.set_geometry(img_w, img_h)
+        self.tiles = get_tiles(self.crop_w, self.crop_h, self.model_w, self.model_h,
+                               config.tile_overlap, config.tile_max_tiles)
+        if len(self.tiles) == 1:
+            # the image is not bigger than a tile, nothing to gain
+            self.tiles = []
+            self.full_frame = True
+        _, _, tile_w, tile_h = self.tiles[0] if self.tiles else (0, 0, self.crop_w, self.crop_h)
+        self.tile_scale = min(self.model_w / tile_w, self.model_h / tile_h)
+        tile_new_w, tile_new_h = int(tile_w * self.tile_scale), int(tile_h * self.tile_scale)
+        self.tile_pasted_w = (self.model_w - tile_new_w) // 2
+        self.tile_pasted_h = (self.model_h - tile_new_h) // 2
+
+        # tiles are decoded only as big as they are sent to the device
+        if config.jpeg_draft and image.format == 'JPEG' and self.tile_scale < 0.5:
+            image.draft('RGB', (int(img_w * self.tile_scale), int(img_h * self.tile_scale)))
+        self.image = image.convert('RGB') if image.mode != 'RGB' else image
+        self.image.load()
+        decoded_time = time.perf_counter()
+        self.timings['decode'] = decoded_time - start_time
+
+        ratio = self.image.width / img_w
+        frames = preprocessing.buffer_pool.acquire((len(self.tiles) + self.full_frame, self.model_h, self.model_w, 3))
+        for frame, (x, y, w, h) in zip(frames, self.tiles):
+            x, y = x + self.crop_x, y + self.crop_y
+            tile = self.image.crop((round(x * ratio), round(y * ratio), round((x + w) * ratio), round((y + h) * ratio)))
+            letterbox_into(tile, (tile_new_w, tile_new_h), (self.tile_pasted_w, self.tile_pasted_h), frame)
+        if self.full_frame:
+            letterbox_into(self.get_crop(), (self.new_img_w, self.new_img_h), (self.pasted_w, self.pasted_h), frames[-1])
+        self.padded_image = frames
+        self.timings['letterbox'] = time.perf_counter() - decoded_time
+        return frames
+
+    def extract_detections(self, outputs: list, threshold: float, quantization: Optional[tuple] = None) -> dict:
+        """
+        Detections of all the frames in the coordinates of the cropped original image, merged, then normalized to
+        the letterboxed whole frame.
+        """
+        model_size = np.array([self.model_h, self.model_w, self.model_h, self.model_w], dtype=np.float32)
+        frame_detections = [extract_detections(output, threshold, quantization=quantization) for output in outputs]
+        boxes = []
+        for detections, (x, y, w, h) in zip(frame_detections, self.tiles):
+            padding = np.array([self.tile_pasted_h, self.tile_pasted_w] * 2, dtype=np.float32)
+            tile_boxes = (detections['detection_boxes'] * model_size - padding) / self.tile_scale
+            np.clip(tile_boxes, 0, np.array([h, w, h, w], dtype=np.float32), out=tile_boxes)
+            boxes.append(tile_boxes + np.array([y, x, y, x], dtype=np.float32))
+        padding = np.array([self.pasted_h, self.pasted_w, self.pasted_h, self.pasted_w], dtype=np.float32)
+        if self.full_frame:
+            boxes.append((frame_detections[-1]['detection_boxes'] * model_size - padding) / self.scale)
+
+        boxes, scores, classes = merge_detections(
+            np.concatenate(boxes).reshape(-1, 4),
+            np.concatenate([detections['detection_scores'] for detections in frame_detections]),
+            np.concatenate([detections['detection_classes'] for detections in frame_detections]))
+        if config.max_detections is not None:
+            boxes, scores, classes = (boxes[:config.max_detections], scores[:config.max_detections],
+                                      classes[:config.max_detections])
+        return {
+            'detection_boxes': np.ascontiguousarray((boxes * self.scale + padding) / model_size, dtype=np.float32),
+            'detection_classes': classes,
+            'detection_scores': scores,
+            'num_detections': len(scores)
+        }
@@ -0,0 +1,251 @@
+# streaming ingestion of uploaded images into pooled buffers
+import io
+import tarfile
+import threading
+import zipfile
+import zlib
+from typing import Optional
+
+from aiohttp import BodyPartReader, StreamReader, hdrs
+
+from config import config
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, limit: int):
+        super().__init__(f'Uploaded file is larger than {limit} bytes')
+        self.limit = limit
+
+
+class BufferReader(io.RawIOBase):
+    """
+    Read-only seekable file object over a memoryview, so PIL decodes straight from the upload buffer.
+    """
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        if n <= 0:
+            return 0
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._view) + offset
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+class UploadBuffer:
+    """
+    Growable byte buffer from UploadBufferPool (or of its own if pool is None); give it back with release() once
+    the image is decoded.
+    """
+    def __init__(self, pool: Optional['UploadBufferPool'], data: bytearray):
+        self.pool = pool
+        self.data = data
+        self.size = 0
+        self._readers = []
+
+    def __len__(self):
+        return self.size
+
+    def write(self, chunk: bytes):
+        end = self.size + len(chunk)
+        if end > len(self.data):
+            # a new array instead of resizing, views given out earlier stay valid
+            data = bytearray(max(end, 2 * len(self.data)))
+            data[:self.size] = memoryview(self.data)[:self.size]
+            self.data = data
+        self.data[self.size:end] = chunk
+        self.size = end
+
+    def view(self) -> memoryview:
+        return memoryview(self.data)[:self.size]
+
+    def reader(self) -> BufferReader:
+        reader = BufferReader(self.view())
+        self._readers.append(reader)
+        return reader
+
+    def release(self):
+        for reader in self._readers:
+            reader.close()
+        self._readers = []
+        if self.data is not None and self.pool is not None:
+            self.pool.put(self.data)
+        self.data = None
+
+
+class UploadBufferPool:
+    def __init__(self, max_free: int, initial_size: int, max_size: int):
+        self.max_free = max_free
+        self.initial_size = initial_size
+        self.max_size = max_size  # bigger buffers are not kept
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> UploadBuffer:
+        with self._lock:
+            data = self._free.pop() if self._free else None
+        return UploadBuffer(self, data if data is not None else bytearray(self.initial_size))
+
+    def put(self, data: bytearray):
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(data)
+
+
+upload_pool = UploadBufferPool(max_free=2 * config.cpu_workers + config.batch_size,
+                               initial_size=config.upload_chunk_size * 16,
+                               max_size=2 * config.max_upload_bytes)
+
+
+async def read_part(part: BodyPartReader, limit: int = config.max_upload_bytes) -> UploadBuffer:
+    """
+    Read a multipart file part chunk by chunk into a pooled buffer.
+
+    Args:
+        part (BodyPartReader): Multipart part with the file.
+        limit (int): Max part size in bytes.
+
+    Returns:
+        UploadBuffer: Buffer with the part content.
+
+    Raises:
+        UploadTooLarge: The part is bigger than the limit, reading stops at the first chunk over it.
+    """
+    buffer = upload_pool.acquire()
+    try:
+        if part.headers.get(hdrs.CONTENT_TRANSFER_ENCODING) or part.headers.get(hdrs.CONTENT_ENCODING):
+            # encoded parts are rare, they are decoded as a whole by aiohttp
+            content = await part.read(decode=True)
+            if len(content) > limit:
+                raise UploadTooLarge(limit)
+            buffer.write(content)
+            return buffer
+        while True:
+            chunk = await part.read_chunk(config.upload_chunk_size)
+            if not chunk:
+                break
+            if buffer.size + len(chunk) > limit:
+                raise UploadTooLarge(limit)
+            buffer.write(chunk)
+        return buffer
+    except BaseException:
+        buffer.release()
+        raise
+
+
+async def read_stream(stream: StreamReader, limit: int, pooled: bool = True,
+                      size_hint: Optional[int] = None) -> UploadBuffer:
+    """
+    Read a whole request body chunk by chunk into a pooled buffer.
+
+    Args:
+        stream (StreamReader): Request body.
+        limit (int): Max body size in bytes.
+        pooled (bool): False for bodies much bigger than an image, e.g. archives: the buffer is not taken from
+            the pool and not kept in it after release.
+        size_hint (int): Expected body size (e.g. Content-Length), the buffer is allocated once if it is right;
+            used when pooled is False.
+
+    Raises:
+        UploadTooLarge: The body is bigger than the limit, reading stops at the first chunk over it.
+    """
+    if pooled:
+        buffer = upload_pool.acquire()
+    else:
+        buffer = UploadBuffer(None, bytearray(min(size_hint or config.upload_chunk_size, limit)))
+    try:
+        async for chunk in stream.iter_chunked(config.upload_chunk_size):
+            if buffer.size + len(chunk) > limit:
+                raise UploadTooLarge(limit)
+            buffer.write(chunk)
+        return buffer
+    except BaseException:
+        buffer.release()
+        raise
+
+
+# archive content types of batch requests, gzip and other compressions of tar are detected by tarfile
+ARCHIVE_TYPES = {'application/zip': 'zip',
+                 'application/x-zip-compressed': 'zip',
+                 'application/x-tar': 'tar',
+                 'application/x-gtar': 'tar',
+                 'application/gzip': 'tar'}
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+# errors of reading one member of an archive (corrupt, truncated, encrypted or too large), the others can still be read
+MEMBER_ERRORS = (UploadTooLarge, zipfile.BadZipFile, tarfile.TarError, zlib.error, EOFError, OSError,
+                 NotImplementedError, RuntimeError)
+
+
+def is_image_name(name: str) -> bool:
+    basename = name.rsplit('/', 1)[-1]
+    return not basename.startswith('.') and basename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+class ImageArchive:
+    """
+    Images of a zip or tar archive in an upload buffer, read one at a time and not from several threads at once.
+    Files without an image extension are skipped.
+    """
+    def __init__(self, buffer: UploadBuffer, kind: str):
+        self.buffer = buffer
+        try:
+            if kind == 'zip':
+                self._archive = zipfile.ZipFile(buffer.reader())
+                self.members = [(info.filename, info) for info in self._archive.infolist()
+                                if not info.is_dir() and is_image_name(info.filename)]
+            else:
+                self._archive = tarfile.open(fileobj=buffer.reader(), mode='r:*')
+                self.members = [(info.name, info) for info in self._archive.getmembers()
+                                if info.isfile() and is_image_name(info.name)]
+        except BaseException:
+            buffer.release()
+            raise
+
+    def read(self, member) -> bytes:
+        """
+        Raises:
+            UploadTooLarge: The image is bigger than config.max_upload_bytes.
+            MEMBER_ERRORS: The member can not be read.
+        """
+        size = member.file_size if isinstance(member, zipfile.ZipInfo) else member.size
+        if size > config.max_upload_bytes:
+            raise UploadTooLarge(config.max_upload_bytes)
+        if isinstance(member, zipfile.ZipInfo):
+            return self._archive.read(member)
+        with self._archive.extractfile(member) as file:
+            return file.read()
+
+    def close(self):
+        self._archive.close()
+        self.buffer.release()
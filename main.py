@@ -1,16 +1,21 @@
 from web_server import run_server
-from hailo_infer import hailo_device
-from config import logger
+import hailo_infer
+from prefork import run_prefork_server
+from config import config, logger
 
 if __name__ == '__main__':
     init_result = True
     if init_result:
         try:
-            run_server()
+            if config.frontend_workers > 0:
+                run_prefork_server()
+            else:
+                # the devices are started by the app, see startup.py
+                run_server()
         finally:
             logger.critical('Something bad happened, trying to release Hailo device')
-            if hailo_device and hailo_device.is_initialized:
-                hailo_device.stop_device()
+            if hailo_infer.device_pool and hailo_infer.device_pool.is_initialized:
+                hailo_infer.device_pool.stop()
                 logger.info('Hailo device released')
             else:
                 logger.info('No Hailo device was initialized, nothing to release')
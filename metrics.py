@@ -0,0 +1,149 @@
+# in-process metrics in Prometheus text format, cheap enough to be always on:
+# one lock, one bisect and a few integer increments per observation
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# seconds, from sub-millisecond postprocessing stages to multi-second device stalls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(label_names, label_values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, *label_values, value: float):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f'# TYPE {self.name} gauge'
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [per bucket counts (last one is +Inf), sum, count]
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = [(label_values, list(series[0]), series[1], series[2])
+                      for label_values, series in self._values.items()]
+        for label_values, counts, total, count in values:
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, label_values, f'le="{bucket}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+STAGES = ('multipart_parse', 'scene_gate', 'decode', 'letterbox', 'device_queue_wait', 'device_inference',
+          'nms_extraction', 'deletterbox', 'visualization', 'json_encoding')
+
+stage_duration = registry.register(Histogram(
+    'hailo_stage_duration_seconds', 'Time spent in each request processing stage.', ('stage', 'model', 'endpoint')))
+request_duration = registry.register(Histogram(
+    'hailo_request_duration_seconds', 'Detection request round trip time.', ('model', 'endpoint')))
+batch_size = registry.register(Histogram(
+    'hailo_batch_size', 'Frames per device call.', ('model',), buckets=(1, 2, 4, 8, 16, 32)))
+requests_total = registry.register(Counter(
+    'hailo_requests_total', 'Detection requests by response code.', ('endpoint', 'code')))
+model_swaps = registry.register(Counter(
+    'hailo_model_swaps_total', 'Models loaded to or released from the device.', ('model', 'action')))
+errors = registry.register(Counter(
+    'hailo_errors_total', 'Requests failed with an exception.', ('endpoint',)))
+device_queue_depth = registry.register(Gauge(
+    'hailo_device_queue_depth', 'Batches routed to a device and not finished.', ('device',)))
+device_busy_seconds = registry.register(Counter(
+    'hailo_device_busy_seconds_total', 'Time a device had at least one batch, its rate is the utilization.',
+    ('device',)))
+device_frames = registry.register(Counter(
+    'hailo_device_frames_total', 'Frames inferred by a device.', ('device',)))
+rejected = registry.register(Counter(
+    'hailo_rejected_requests_total', 'Requests rejected before inference.', ('endpoint', 'reason')))
+
+
+def observe_stages(timings: dict, model: str, endpoint: str):
+    """
+    Record stage durations collected for one request.
+
+    Args:
+        timings (dict): Stage name -> duration in seconds, see STAGES.
+        model (str): Model name.
+        endpoint (str): Route of the request.
+    """
+    for stage, duration in timings.items():
+        stage_duration.observe(duration, stage, model, endpoint)
@@ -0,0 +1,165 @@
+# bounded store of visualization images rendered in the background
+import glob
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from config import config, logger
+
+PENDING = 'pending'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class OutputEntry:
+    def __init__(self, path: str, status: str, created_time: float, size: int = 0):
+        self.path = path
+        self.status = status
+        self.created_time = created_time
+        self.size = size
+
+
+class OutputStore:
+    """
+    Images in a directory limited by count, total size and age, least recently used ones are deleted first.
+    Images are rendered one at a time in a background thread, pending renders are limited by max_pending.
+    """
+    def __init__(self, directory: str, max_files: int, max_bytes: int, max_age_s: float, max_pending: int):
+        self.root = directory
+        self.directory = directory
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.max_pending = max_pending
+        self.size_bytes = 0
+        self.pending = 0
+        self._entries = OrderedDict()  # image id -> OutputEntry
+        # renders finish in the worker thread, lookups happen in the event loop
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='visualization')
+        self._load_existing()
+
+    def _load_existing(self):
+        # files left from earlier runs count against the limits too, oldest first
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if os.path.isfile(path) and filename.endswith('.jpg'):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, filename[:-4], path, stat.st_size))
+        now = time.time()
+        for mtime, image_id, path, size in sorted(files):
+            self._entries[image_id] = OutputEntry(path, READY, time.monotonic() - (now - mtime), size)
+            self.size_bytes += size
+        with self._lock:
+            self._evict()
+
+    def use_subdirectory(self, name: str, share: int):
+        """
+        Keep the images in a subdirectory of their own with 1/share of the limits, for front-end worker processes
+        (see prefork.py): each one only ever evicts its own images.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+            self.directory = os.path.join(self.root, name)
+            self.max_files = max(1, self.max_files // share)
+            self.max_bytes = max(1, self.max_bytes // share)
+        self._load_existing()
+
+    def is_full(self) -> bool:
+        return self.pending >= self.max_pending
+
+    def submit(self, image_id: str, render: Callable[[str], None]) -> str:
+        """
+        Queue an image for rendering.
+
+        Args:
+            image_id (str): Image id, also the file name without extension.
+            render (Callable): Called with the image path in the background thread, writes the image.
+
+        Returns:
+            str: Path of the image once it is ready.
+        """
+        path = self.get_path(image_id)
+        with self._lock:
+            self._entries[image_id] = OutputEntry(path, PENDING, time.monotonic())
+            self.pending += 1
+        self._executor.submit(self._render, image_id, render, path)
+        return path
+
+    def _render(self, image_id: str, render: Callable[[str], None], path: str):
+        try:
+            render(path)
+            status, size = READY, os.path.getsize(path)
+        except Exception:
+            logger.exception('Visualization of %s failed', image_id)
+            status, size = FAILED, 0
+        with self._lock:
+            self.pending -= 1
+            entry = self._entries.get(image_id)
+            if entry is not None:
+                entry.status = status
+                entry.size = size
+                self.size_bytes += size
+            self._evict()
+
+    def get_path(self, image_id: str) -> str:
+        return os.path.join(self.directory, f'{os.path.basename(image_id)}.jpg')
+
+    def find_path(self, image_id: str) -> Optional[str]:
+        # images rendered by other front-end workers are in the sibling subdirectories
+        path = self.get_path(image_id)
+        if os.path.isfile(path):
+            return path
+        filename = os.path.basename(path)
+        siblings = glob.glob(os.path.join(glob.escape(self.root), '*', glob.escape(filename)))
+        for path in [os.path.join(self.root, filename)] + siblings:
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def get(self, image_id: str) -> Optional[OutputEntry]:
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(image_id)
+            if entry is not None:
+                self._entries.move_to_end(image_id)
+            return entry
+
+    def _evict(self):
+        expire_time = time.monotonic() - self.max_age_s
+        for image_id, entry in list(self._entries.items()):
+            if entry.status != PENDING and entry.created_time < expire_time:
+                self._remove(image_id)
+        # least recently used first, images still being rendered are never deleted
+        for image_id, entry in list(self._entries.items()):
+            if len(self._entries) <= self.max_files and self.size_bytes <= self.max_bytes:
+                break
+            if entry.status != PENDING:
+                self._remove(image_id)
+
+    def _remove(self, image_id: str):
+        entry = self._entries.pop(image_id)
+        self.size_bytes -= entry.size
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+output_store = OutputStore(directory=config.output_images_path,
+                           max_files=config.output_images_max_files,
+                           max_bytes=config.output_images_max_bytes,
+                           max_age_s=config.output_images_max_age_s,
+                           max_pending=config.visualization_max_pending)
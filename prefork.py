@@ -0,0 +1,286 @@
+# pre-forked front end: config.frontend_workers processes share the HTTP port with SO_REUSEPORT and do parsing,
+# decoding and letterboxing, this process owns the Hailo cards.
+# Frames are letterboxed straight into a shared memory slot of the worker, only the slot number, the shape and the
+# model go over the pipe; the raw detections (a few small arrays) come back over the same pipe.
+import asyncio
+import functools
+import gc
+import itertools
+import multiprocessing
+import threading
+import time
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Optional
+
+import numpy as np
+from aiohttp import web
+
+from config import config, logger
+from batcher import BatchJob, DeadlineExceeded, release_when_done, wait_for_frames
+import hailo_infer
+
+
+class RemoteDeviceError(Exception):
+    pass
+
+
+class SharedFrameRing:
+    """
+    Fixed size frame slots in one shared memory block. In a front-end worker it is the preprocessing buffer pool
+    (the acquire/release interface of preprocessing.BufferPool), so frames are written to shared memory directly;
+    the device owner reads them in place.
+    """
+    shared = True  # only frames in the slots reach the device, see slot_of
+
+    def __init__(self, shm: SharedMemory, slots: int, slot_bytes: int):
+        self.shm = shm
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self._memory = np.frombuffer(shm.buf, dtype=np.uint8)
+        self._address = self._memory.__array_interface__['data'][0]
+        self._free = list(range(slots))
+        self._available = threading.Condition()
+
+    @classmethod
+    def create(cls, slots: int, slot_bytes: int) -> 'SharedFrameRing':
+        return cls(SharedMemory(create=True, size=slots * slot_bytes), slots, slot_bytes)
+
+    @classmethod
+    def attach(cls, name: str, slots: int, slot_bytes: int) -> 'SharedFrameRing':
+        return cls(SharedMemory(name=name), slots, slot_bytes)
+
+    def view(self, slot: int, shape: tuple) -> np.ndarray:
+        start = slot * self.slot_bytes
+        return self._memory[start:start + int(np.prod(shape))].reshape(shape)
+
+    def slot_of(self, frame: np.ndarray) -> int:
+        """
+        Raises:
+            ValueError: The frame does not start a slot of this ring, e.g. it is in the process's own memory.
+        """
+        offset = frame.__array_interface__['data'][0] - self._address
+        if offset < 0 or offset >= self.slots * self.slot_bytes or offset % self.slot_bytes:
+            raise ValueError('Frame is not in a shared memory slot, it can not be sent to the device process')
+        return offset // self.slot_bytes
+
+    def acquire(self, shape: tuple) -> np.ndarray:
+        """
+        Raises:
+            ValueError: The frame does not fit into a slot.
+            TimeoutError: No slot was freed within config.shm_acquire_timeout_s.
+        """
+        if np.prod(shape) > self.slot_bytes:
+            raise ValueError(f'Frame {shape} does not fit into {self.slot_bytes} bytes, see config.shm_slot_bytes')
+        # admission control keeps active requests within the slots, waiting here is only a safety net
+        with self._available:
+            if not self._available.wait_for(lambda: self._free, timeout=config.shm_acquire_timeout_s):
+                raise TimeoutError(f'No free shared memory slot of {self.slots} in {config.shm_acquire_timeout_s} s')
+            slot = self._free.pop()
+        return self.view(slot, shape)
+
+    def release(self, frame: np.ndarray):
+        self.release_slot(self.slot_of(frame))
+
+    def release_slot(self, slot: int):
+        with self._available:
+            self._free.append(slot)
+            self._available.notify()
+
+    def close(self, unlink: bool = False):
+        del self._memory
+        # frames of finished requests may still be referenced from reference cycles
+        gc.collect()
+        try:
+            self.shm.close()
+        except BufferError:
+            # frames still referenced, the mapping goes away with the process
+            pass
+        if unlink:
+            self.shm.unlink()
+
+
+class DeviceClient:
+    """
+    Front-end worker side of the device owner process. Stands in for hailo_infer.device_pool (is_initialized, stop)
+    and hailo_infer.batcher (infer). Model input shapes are read from the HEF files by the worker itself.
+    """
+    def __init__(self, conn: Connection, ring: SharedFrameRing):
+        self.conn = conn
+        self.ring = ring
+        self.is_initialized = True
+        self._pending = dict()  # request id -> asyncio.Future
+        self._ids = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _listen(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop.add_reader(self.conn.fileno(), self._on_message)
+
+    def _on_message(self):
+        try:
+            kind, request_id, *payload = self.conn.recv()
+        except EOFError:
+            self._loop.remove_reader(self.conn.fileno())
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(RemoteDeviceError('Device owner process is gone'))
+            self._pending.clear()
+            return
+        future = self._pending.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if kind == 'deadline':
+            future.set_exception(DeadlineExceeded())
+        elif kind == 'error':
+            future.set_exception(RemoteDeviceError(payload[0]))
+        else:
+            future.set_result(payload)
+
+    def _send(self, kind: str, *args) -> asyncio.Future:
+        self._listen()
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self._pending[request_id] = future
+        self.conn.send((kind, request_id) + args)
+        return future
+
+    async def infer(self, model_name: str, frames, deadline: Optional[float] = None,
+                    release: Optional[Callable[[], None]] = None) -> BatchJob:
+        """
+        Same as RequestBatcher.infer: the caller releases the frames, unless it is cancelled once they are ready.
+        """
+        frames = await wait_for_frames(frames, release)
+        job = BatchJob(model_name, frames, deadline)
+        slot = self.ring.slot_of(frames)
+        timeout = None if deadline is None else deadline - job.enqueue_time
+        future = self._send('infer', slot, frames.shape, model_name, timeout)
+        try:
+            job.outputs, queue_s, inference_s, job.batch_size = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the owner may still be reading the slot, it is freed once the owner replies
+            if release is None:
+                release = functools.partial(self.ring.release_slot, slot)
+            future.add_done_callback(functools.partial(release_when_done, release=release))
+            raise
+        job.start_time = job.enqueue_time + queue_s
+        job.end_time = job.start_time + inference_s
+        return job
+
+    def stop(self):
+        # the cards are released by the device owner process
+        pass
+
+
+async def _ready(frames: np.ndarray) -> np.ndarray:
+    return frames
+
+
+async def handle_request(conn: Connection, ring: SharedFrameRing, message: tuple):
+    _, request_id, slot, shape, model_name, timeout = message
+    try:
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        # the device reads the frame straight from the worker's shared memory
+        job = await hailo_infer.batcher.infer(model_name, _ready(ring.view(slot, shape)), deadline)
+        reply = ('result', request_id, job.outputs, job.start_time - job.enqueue_time,
+                 job.end_time - job.start_time, job.batch_size)
+    except DeadlineExceeded:
+        reply = ('deadline', request_id)
+    except Exception as e:
+        logger.exception('Inference for a front-end worker failed')
+        reply = ('error', request_id, f'{type(e).__name__}: {e}')
+    conn.send(reply)
+
+
+async def serve_devices(channels: list, processes: list):
+    """
+    Run inference for the front-end workers until all of them exit.
+
+    Args:
+        channels (list): (Connection, SharedFrameRing) of each worker.
+        processes (list): Worker processes.
+    """
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    def on_message(conn: Connection, ring: SharedFrameRing):
+        try:
+            message = conn.recv()
+        except EOFError:
+            loop.remove_reader(conn.fileno())
+            return
+        task = asyncio.create_task(handle_request(conn, ring, message))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    for conn, ring in channels:
+        loop.add_reader(conn.fileno(), on_message, conn, ring)
+    while any(process.is_alive() for process in processes):
+        await asyncio.sleep(1)
+    logger.critical('All front-end workers exited')
+
+
+def run_frontend(index: int, conn: Connection, shm_name: str, slots: int, slot_bytes: int):
+    import preprocessing
+    from output_store import output_store
+    from web_server import create_app
+
+    ring = SharedFrameRing.attach(shm_name, slots, slot_bytes)
+    preprocessing.buffer_pool = ring
+    output_store.use_subdirectory(f'worker-{index}', config.frontend_workers)
+    hailo_infer.use_remote_devices(DeviceClient(conn, ring))
+    logger.info('Starting front-end worker %d', index)
+    try:
+        web.run_app(create_app(owns_devices=False), port=config.server_port, reuse_port=True, access_log=logger, print=None)
+    finally:
+        ring.close()
+
+
+def get_slot_bytes() -> int:
+    """
+    Shared memory one request needs: all the frames of a tiled request (config.tile_max_tiles tiles and the whole
+    frame) of the biggest model input. Shared memory pages are only allocated when written, small requests in big
+    slots cost address space only.
+    """
+    frames = max(1, config.tile_max_tiles) + config.tile_full_frame
+    input_bytes = max(int(np.prod(hailo_infer.get_model_metadata(model_name)[0][0].shape))
+                      for model_name in config.get_model_list())
+    slot_bytes = frames * input_bytes
+    if config.shm_slot_bytes is None:
+        return slot_bytes
+    if config.shm_slot_bytes < slot_bytes:
+        raise ValueError(f'config.shm_slot_bytes {config.shm_slot_bytes} does not fit a tiled request of {frames} '
+                         f'frames of the biggest model input, {slot_bytes} bytes are needed')
+    return config.shm_slot_bytes
+
+
+def run_prefork_server():
+    """
+    Open the cards in this process and start config.frontend_workers HTTP worker processes on config.server_port.
+    """
+    slot_bytes = get_slot_bytes()
+    hailo_infer.start_devices()
+    # spawn, not fork: workers must not inherit the device handles and the threads of this process
+    context = multiprocessing.get_context('spawn')
+    slots = config.max_active_requests
+    channels, processes = [], []
+    try:
+        for index in range(config.frontend_workers):
+            ring = SharedFrameRing.create(slots, slot_bytes)
+            owner_conn, worker_conn = context.Pipe()
+            process = context.Process(target=run_frontend, name=f'frontend-{index}', daemon=True,
+                                      args=(index, worker_conn, ring.shm.name, slots, slot_bytes))
+            process.start()
+            worker_conn.close()
+            channels.append((owner_conn, ring))
+            processes.append(process)
+        logger.info('Started %d front-end workers', len(processes))
+        asyncio.run(serve_devices(channels, processes))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        for conn, ring in channels:
+            conn.close()
+            ring.close(unlink=True)
@@ -0,0 +1,111 @@
+# letterbox preprocessing with reusable input buffers
+import threading
+from collections import defaultdict
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from config import config
+
+RESAMPLE_FILTER = getattr(Image.Resampling, config.resample_filter)
+
+
+class BufferPool:
+    """
+    Pool of preallocated uint8 (H, W, 3) model input buffers, one free list per model input shape.
+    A buffer is taken for a request, written in place and handed to the device as is, then returned after inference.
+    """
+    shared = False  # buffers are in this process's memory, any array can go to the device instead
+
+    def __init__(self, max_free_per_shape: int):
+        self.max_free_per_shape = max_free_per_shape
+        self._free = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def acquire(self, shape: tuple) -> np.ndarray:
+        with self._lock:
+            free = self._free[shape]
+            if free:
+                return free.pop()
+        return np.empty(shape, dtype=np.uint8)
+
+    def release(self, buffer: np.ndarray):
+        with self._lock:
+            free = self._free[buffer.shape]
+            if len(free) < self.max_free_per_shape:
+                free.append(buffer)
+
+
+buffer_pool = BufferPool(max_free_per_shape=config.cpu_workers + 2 * config.batch_size)
+
+
+def open_image(image_stream, model_w: int, model_h: int, crop: Optional[tuple] = None):
+    """
+    Open an image and, for JPEGs, let the decoder scale it down by 1/2, 1/4 or 1/8 while it stays at least
+    as big as the letterboxed size, so 4K snapshots are never fully decoded.
+
+    Args:
+        crop (tuple): (left, top, right, bottom) fractions of the image that will be letterboxed, the whole image
+            if None.
+
+    Returns:
+        tuple: PIL.Image.Image, (width, height) of the original image.
+    """
+    image = Image.open(image_stream)
+    original_size = image.size
+    if config.jpeg_draft and image.format == 'JPEG':
+        img_w, img_h = original_size
+        left, top, right, bottom = crop if crop is not None else (0, 0, 1, 1)
+        scale = min(model_w / max(1.0, img_w * (right - left)), model_h / max(1.0, img_h * (bottom - top)))
+        if scale < 0.5:
+            image.draft('RGB', (int(img_w * scale), int(img_h * scale)))
+    return image, original_size
+
+
+def letterbox_into(image: Image.Image, new_size: tuple, pasted: tuple, out: np.ndarray) -> np.ndarray:
+    """
+    Resize the image and write it with padding into a preallocated buffer.
+
+    Args:
+        image (PIL.Image.Image): Decoded image, possibly reduced by draft mode.
+        new_size (tuple): (width, height) of the resized image.
+        pasted (tuple): (x, y) offset of the resized image in the buffer.
+        out (np.ndarray): (H, W, 3) uint8 buffer to write to.
+
+    Returns:
+        np.ndarray: The out buffer.
+    """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    new_w, new_h = new_size
+    pasted_w, pasted_h = pasted
+    if image.size != new_size:
+        image = image.resize(new_size, RESAMPLE_FILTER)
+
+    # only the padding bands are filled, the rest is overwritten by the image
+    out[:pasted_h] = config.padding_color
+    out[pasted_h + new_h:] = config.padding_color
+    out[pasted_h:pasted_h + new_h, :pasted_w] = config.padding_color
+    out[pasted_h:pasted_h + new_h, pasted_w + new_w:] = config.padding_color
+    out[pasted_h:pasted_h + new_h, pasted_w:pasted_w + new_w] = np.asarray(image)
+    return out
+
+
+def make_thumbnail(image_stream, size: tuple):
+    """
+    Decode an image into a tiny grayscale thumbnail, JPEGs are decoded at 1/8 scale by the decoder itself.
+
+    Args:
+        image_stream: File object with the image.
+        size (tuple): (width, height) of the thumbnail.
+
+    Returns:
+        tuple: (height, width) float32 np.ndarray, (width, height) of the original image.
+    """
+    image = Image.open(image_stream)
+    original_size = image.size
+    if image.format == 'JPEG':
+        image.draft('L', size)
+    thumbnail = image.convert('L').resize(size, Image.Resampling.BOX)
+    return np.asarray(thumbnail, dtype=np.float32), original_size
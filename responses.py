@@ -0,0 +1,84 @@
+# CodeProject.AI compatible responses: the fields that depend on the model only are built once per model,
+# JSON is encoded with orjson when it is installed
+import functools
+import json
+import uuid
+from typing import Optional
+
+from aiohttp import web
+
+from config import config
+from detections import build_predictions
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_model_fields(model_name: str) -> tuple:
+    return (("moduleId", config.get_api_module_id(model_name)),
+            ("moduleName", config.get_api_module_name(model_name)),
+            ("executionProvider", "TPU"),
+            ("inferenceDevice", "TPU"),
+            ("processedBy", "localhost"),
+            ("canUseGPU", False))
+
+
+def new_response(model_name: Optional[str] = None) -> dict:
+    """
+    Common fields of a response with a new request id.
+
+    Args:
+        model_name (str): Model the request is processed with, the current model if None.
+    """
+    response = {"requestId": str(uuid.uuid4())}
+    response.update(get_model_fields(model_name or config.get_current_model_name()))
+    return response
+
+
+def get_message(labels: list) -> str:
+    if not labels:
+        return 'No objects found'
+    # unique labels in the order of detection, as many as fit into config.detect_msg_len
+    message = 'Found '
+    for i, label in enumerate(dict.fromkeys(labels)):
+        part = label if i == 0 else f', {label}'
+        if i > 0 and len(message) + len(part) > config.detect_msg_len:
+            return f'{message}...'
+        message += part
+    return message
+
+
+def build_detection_response(detection: dict, response: dict) -> dict:
+    """
+    Add detections to a response created with new_response.
+
+    Args:
+        detection (dict): Detections as returned by do_inference.
+        response (dict): Response to update.
+
+    Returns:
+        dict: The updated response.
+    """
+    response.update({"command": "detect",
+                     "count": detection['num_detections'],
+                     'inferenceMs': detection['inferenceMs'],
+                     'processMs': detection['processMs']})
+    for key in ('success', 'error', 'imagePath', 'imageStatusPath', 'sceneGate'):
+        if detection.get(key):
+            response[key] = detection[key]
+    response.update({'message': get_message(detection['detection_labels']),
+                     'predictions': build_predictions(detection)})
+    return response
+
+
+def encode(response: dict) -> bytes:
+    if orjson is not None and config.fast_json:
+        return orjson.dumps(response)
+    return json.dumps(response).encode()
+
+
+def json_response(response: dict, status: int = 200) -> web.Response:
+    return web.Response(body=encode(response), status=status, content_type='application/json')
@@ -0,0 +1,132 @@
+# content-addressed cache of detection results, for resent alert snapshots and static scenes
+import asyncio
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+import numpy as np
+
+from config import config
+import metrics
+
+cache_requests = metrics.registry.register(metrics.Counter(
+    'hailo_result_cache_requests_total', 'Detection result cache lookups by result.', ('result',)))
+cache_entries = metrics.registry.register(metrics.Gauge(
+    'hailo_result_cache_entries', 'Detection results in the cache.'))
+
+
+def get_confidence_bucket(min_confidence: float) -> float:
+    """
+    Lower edge of the min_confidence bucket. Results are computed at this threshold, so a cached entry serves every
+    min_confidence in the bucket after filtering.
+    """
+    step = config.result_cache_confidence_step
+    return math.floor(min_confidence / step + 1e-9) * step
+
+
+def _entry_size(detections: dict) -> int:
+    # rough footprint: dict overhead plus arrays and labels
+    size = 512
+    for value in detections.values():
+        if isinstance(value, np.ndarray):
+            size += value.nbytes
+        elif isinstance(value, list):
+            size += 64 * len(value)
+    return size
+
+
+class DetectionCache:
+    """
+    LRU cache of detections keyed by a hash of the uploaded bytes, model name and confidence bucket,
+    bounded by entries and approximate bytes, with TTL expiry.
+    Concurrent requests for the same key share one inference (single flight).
+    """
+    def __init__(self, max_entries: int, max_bytes: int, ttl_s: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expire time, size, detections)
+        self._in_flight = dict()  # key -> asyncio.Future
+
+    @staticmethod
+    def make_key(content, model_name: str, confidence_bucket: float) -> bytes:
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        return digest + f'|{model_name}|{confidence_bucket:.3f}'.encode()
+
+    def _get(self, key: bytes):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expire_time, size, detections = entry
+        if expire_time < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return detections
+
+    def _remove(self, key: bytes):
+        _, size, _ = self._entries.pop(key)
+        self.size_bytes -= size
+
+    def _put(self, key: bytes, detections: dict):
+        size = _entry_size(detections)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl_s, size, detections)
+        self.size_bytes += size
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        cache_entries.set(value=len(self._entries))
+
+    async def get_or_compute(self, key: bytes, compute: Callable[[], Awaitable[dict]]):
+        """
+        Get detections from the cache, or compute them once for all the concurrent callers with the same key.
+
+        Args:
+            key (bytes): Key from make_key.
+            compute (Callable): Called on a miss only, right away in the caller, so what it sets up is in place
+                before the caller can be cancelled; the awaitable it returns runs in a task of its own.
+
+        Returns:
+            tuple: (detections dict, 'hit' | 'shared' | 'miss')
+        """
+        detections = self._get(key)
+        if detections is not None:
+            self.hits += 1
+            cache_requests.inc('hit')
+            return detections, 'hit'
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.hits += 1
+            cache_requests.inc('shared')
+            # shield: a cancelled waiter must not cancel the inference shared with the others
+            return await asyncio.shield(in_flight), 'shared'
+
+        self.misses += 1
+        cache_requests.inc('miss')
+        # a task of its own, so the client that started it going away does not fail the others waiting for it
+        task = asyncio.create_task(self._compute(key, compute()))
+        # nobody may be waiting when it fails, retrieve the exception so it is not reported as never retrieved
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._in_flight[key] = task
+        return await asyncio.shield(task), 'miss'
+
+    async def _compute(self, key: bytes, computation: Awaitable[dict]) -> dict:
+        try:
+            detections = await computation
+            self._put(key, detections)
+            return detections
+        finally:
+            del self._in_flight[key]
+
+
+result_cache = DetectionCache(max_entries=config.result_cache_max_entries,
+                              max_bytes=config.result_cache_max_bytes,
+                              ttl_s=config.result_cache_ttl_s)
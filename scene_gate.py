@@ -0,0 +1,96 @@
+# per camera change detection: frames that barely differ from the last inferred one reuse its detections
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from config import config
+import metrics
+
+scene_gate_requests = metrics.registry.register(metrics.Counter(
+    'hailo_scene_gate_requests_total', 'Frames checked by the scene change gate by result.', ('result',)))
+
+
+class CameraState:
+    def __init__(self, thumbnail: np.ndarray, detections: dict, confidence_score: float):
+        self.thumbnail = thumbnail
+        self.detections = detections
+        self.confidence_score = confidence_score
+        self.inferred_time = time.monotonic()
+        self.skips = 0
+
+
+def normalize_thumbnail(thumbnail: np.ndarray) -> np.ndarray:
+    # mean brightness removed, so IR switching, flicker and passing clouds do not count as a change
+    return thumbnail - thumbnail.mean()
+
+
+def scene_difference(thumbnail: np.ndarray, previous: np.ndarray) -> float:
+    """
+    Mean absolute difference of two normalized thumbnails, in 0-255 gray levels.
+    """
+    if thumbnail.shape != previous.shape:
+        return float('inf')
+    return float(np.abs(thumbnail - previous).mean())
+
+
+class SceneGate:
+    """
+    Last inferred thumbnail and detections per camera and model, at most max_cameras of them, least recently used
+    dropped first. A frame is skipped if it differs from the last inferred one less than the threshold, the scene
+    is re-inferred at least every max_age_s.
+    """
+    def __init__(self, threshold: float, max_cameras: int, max_age_s: float):
+        self.threshold = threshold
+        self.max_cameras = max_cameras
+        self.max_age_s = max_age_s
+        self._cameras = OrderedDict()  # (camera id, model name) -> CameraState
+
+    def check(self, camera_id: str, model_name: str, thumbnail: np.ndarray, confidence_score: float):
+        """
+        Compare a frame with the last inferred frame of the camera.
+
+        Args:
+            camera_id (str): Camera id or uploaded file name.
+            model_name (str): Model name.
+            thumbnail (np.ndarray): Normalized thumbnail of the frame.
+            confidence_score (float): Requested min confidence, stored detections are reused only if they were
+                inferred with the same or a lower one.
+
+        Returns:
+            tuple: (CameraState to reuse or None, difference score or None if there is nothing to compare to)
+        """
+        key = (camera_id, model_name)
+        state = self._cameras.get(key)
+        if state is None:
+            return None, None
+        self._cameras.move_to_end(key)
+        difference = scene_difference(thumbnail, state.thumbnail)
+        if (difference < self.threshold
+                and confidence_score >= state.confidence_score
+                and time.monotonic() - state.inferred_time < self.max_age_s):
+            state.skips += 1
+            scene_gate_requests.inc('skip')
+            return state, difference
+        return None, difference
+
+    def update(self, camera_id: str, model_name: str, thumbnail: np.ndarray, detections: dict,
+               confidence_score: float):
+        key = (camera_id, model_name)
+        self._cameras[key] = CameraState(thumbnail, detections, confidence_score)
+        self._cameras.move_to_end(key)
+        while len(self._cameras) > self.max_cameras:
+            self._cameras.popitem(last=False)
+        scene_gate_requests.inc('infer')
+
+
+scene_gate = SceneGate(threshold=config.scene_gate_threshold,
+                       max_cameras=config.scene_gate_max_cameras,
+                       max_age_s=config.scene_gate_max_age_s)
+
+
+def get_camera_id(camera_id: Optional[str], filename: Optional[str]) -> Optional[str]:
+    if config.scene_gate_key == 'camera_id':
+        return camera_id
+    return camera_id or filename
@@ -0,0 +1,137 @@
+# startup in the background: the HTTP server answers right away while the cards are opened, then every preloaded
+# model is warmed up with synthetic snapshots through the whole preprocess to postprocess path, and only then
+# the server is ready - so the first real request after a restart does not pay for first use costs
+import asyncio
+import io
+import time
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+from aiohttp import web
+
+from config import config, logger
+import hailo_infer
+from inference_image import InferenceImage
+
+STARTING = 'starting'
+WARMING_UP = 'warming_up'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class Readiness:
+    def __init__(self):
+        self.status = STARTING
+        self.error: Optional[str] = None
+        self.start_time = time.perf_counter()
+        self.startup_s: Optional[float] = None
+        self.warmed_up_models = []
+        self._done: Optional[asyncio.Event] = None
+
+    @property
+    def is_ready(self):
+        return self.status == READY
+
+    def _get_done(self) -> asyncio.Event:
+        if self._done is None:
+            self._done = asyncio.Event()
+        return self._done
+
+    def set_status(self, status: str, error: Optional[str] = None):
+        self.status = status
+        self.error = error
+        if status in (READY, FAILED):
+            self.startup_s = time.perf_counter() - self.start_time
+            self._get_done().set()
+
+    async def wait(self, deadline: float) -> bool:
+        """
+        Wait until the startup is over.
+
+        Args:
+            deadline (float): time.perf_counter() time to wait until at most.
+
+        Returns:
+            bool: True if the server is ready.
+        """
+        if self.status not in (READY, FAILED):
+            try:
+                await asyncio.wait_for(self._get_done().wait(), timeout=max(0.0, deadline - time.perf_counter()))
+            except asyncio.TimeoutError:
+                pass
+        return self.is_ready
+
+
+readiness = Readiness()
+
+
+def get_preloaded_models() -> list:
+    models = [config.get_current_model_name()] + config.resident_models
+    return [model_name for model_name in dict.fromkeys(models) if model_name in config.model_filename_dict]
+
+
+def make_warmup_image(width: int, height: int) -> bytes:
+    # gradients with some noise, compressed like a camera snapshot
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, np.newaxis]
+    frame = np.stack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)),
+                      (x + y) / 2], axis=2)
+    frame += rng.normal(0, 8, size=frame.shape).astype(np.float32)
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8)).save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+async def warm_up(model_name: str, image_bytes: bytes):
+    start_time = time.perf_counter()
+    await asyncio.gather(*[hailo_infer.do_inference(InferenceImage(io.BytesIO(image_bytes)), model_name,
+                                                    endpoint='warmup')
+                           for _ in range(config.warmup_frames)])
+    logger.info('Model %s is warmed up in %d ms', model_name, (time.perf_counter() - start_time) * 1000)
+
+
+async def start(owns_devices: bool):
+    loop = asyncio.get_running_loop()
+    try:
+        if owns_devices:
+            # opening the cards and configuring the models blocks, requests are answered meanwhile
+            await loop.run_in_executor(None, hailo_infer.start_devices)
+        readiness.set_status(WARMING_UP)
+        if config.warmup_frames > 0:
+            image_bytes = await loop.run_in_executor(hailo_infer.cpu_executor, make_warmup_image,
+                                                     *config.warmup_image_size)
+            for model_name in get_preloaded_models():
+                await warm_up(model_name, image_bytes)
+                readiness.warmed_up_models.append(model_name)
+        readiness.set_status(READY)
+        logger.info('Server is ready in %d ms', readiness.startup_s * 1000)
+    except Exception as e:
+        logger.exception('Startup failed')
+        readiness.set_status(FAILED, f'{type(e).__name__}: {e}')
+
+
+def setup(app: web.Application, owns_devices: bool = True):
+    """
+    Start the devices (if this process owns them) and warm up the models once the app is started,
+    release the devices on cleanup.
+
+    Args:
+        app (web.Application): Application to add the handlers to.
+        owns_devices (bool): False in front-end worker processes, the cards are opened by the device owner process.
+    """
+    tasks = []
+
+    async def on_startup(_):
+        tasks.append(asyncio.create_task(start(owns_devices)))
+
+    async def on_cleanup(_):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if owns_devices and hailo_infer.device_pool.is_initialized:
+            hailo_infer.device_pool.stop()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
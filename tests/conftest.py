@@ -0,0 +1,17 @@
+# tests run on fake_hailo_platform, from the repo root like the server
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ['HAILO_FAKE'] = '1'
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_readiness():
+    # every test starts its own server, which opens the devices and warms up from the start
+    from startup import readiness
+    readiness.__init__()
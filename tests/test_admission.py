@@ -0,0 +1,126 @@
+import asyncio
+import io
+import time
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from PIL import Image
+
+import web_server
+from admission import AdmissionController, Rejected
+from config import config
+from web_server import create_app
+
+FAR = 60  # seconds, a deadline that does not pass during a test
+
+
+def deadline(seconds: float = FAR) -> float:
+    return time.perf_counter() + seconds
+
+
+async def queue_waiters(controller: AdmissionController, priorities: list, admitted: list) -> list:
+    async def wait(name, priority):
+        await controller.admit(priority, deadline())
+        admitted.append(name)
+
+    tasks = []
+    for name, priority in enumerate(priorities):
+        tasks.append(asyncio.create_task(wait(name, priority)))
+        await asyncio.sleep(0)
+    return tasks
+
+
+def test_waiters_are_admitted_by_priority_then_in_order():
+    async def main():
+        controller = AdmissionController(max_active=1, max_queued=10)
+        await controller.admit(0, deadline())
+        admitted = []
+        tasks = await queue_waiters(controller, [2, 0, 1, 0], admitted)
+        for _ in tasks:
+            controller.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        assert admitted == [1, 3, 2, 0]
+        assert controller.active == 1
+    asyncio.run(main())
+
+
+def test_full_queue_rejects_requests_of_the_same_priority():
+    async def main():
+        controller = AdmissionController(max_active=1, max_queued=2)
+        await controller.admit(1, deadline())
+        tasks = await queue_waiters(controller, [1, 1], [])
+        with pytest.raises(Rejected) as e:
+            await controller.admit(1, deadline())
+        assert e.value.reason == 'queue_full'
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    asyncio.run(main())
+
+
+def test_full_queue_sheds_the_newest_lower_priority_waiter():
+    async def main():
+        controller = AdmissionController(max_active=1, max_queued=2)
+        await controller.admit(0, deadline())
+        admitted = []
+        tasks = await queue_waiters(controller, [2, 2], admitted)
+        urgent = asyncio.create_task(controller.admit(0, deadline()))
+        await asyncio.sleep(0)
+        results = await asyncio.gather(tasks[1], return_exceptions=True)
+        assert isinstance(results[0], Rejected) and results[0].reason == 'shed'
+        controller.release()
+        await urgent
+        controller.release()
+        await tasks[0]
+        assert admitted == [0]
+    asyncio.run(main())
+
+
+def test_waiter_past_its_deadline_is_rejected_and_leaves_the_queue():
+    async def main():
+        controller = AdmissionController(max_active=1, max_queued=2)
+        await controller.admit(0, deadline())
+        with pytest.raises(Rejected) as e:
+            await controller.admit(0, deadline(0.02))
+        assert e.value.reason == 'deadline'
+        assert not controller._waiters
+        controller.release()
+        assert controller.active == 0
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_passes_the_slot_on():
+    async def main():
+        controller = AdmissionController(max_active=1, max_queued=4)
+        await controller.admit(0, deadline())
+        admitted = []
+        tasks = await queue_waiters(controller, [0, 0], admitted)
+        tasks[0].cancel()
+        await asyncio.gather(tasks[0], return_exceptions=True)
+        controller.release()
+        await tasks[1]
+        assert admitted == [1]
+    asyncio.run(main())
+
+
+def test_overloaded_server_answers_503_with_retry_after(monkeypatch):
+    controller = AdmissionController(max_active=1, max_queued=0)
+    monkeypatch.setattr(web_server, 'admission', controller)
+    monkeypatch.setattr(config, 'retry_after_s', 3)
+
+    async def main():
+        stream = io.BytesIO()
+        Image.new('RGB', (320, 240)).save(stream, format='JPEG')
+        async with TestClient(TestServer(create_app())) as client:
+            # the only slot is taken, there is no room in the queue
+            await controller.admit(0, deadline())
+            form = aiohttp.FormData()
+            form.add_field('image', stream.getvalue(), filename='snapshot.jpg', content_type='image/jpeg')
+            response = await client.post('/v1/vision/detection', data=form)
+            assert response.status == 503
+            assert response.headers['Retry-After'] == '3'
+            controller.release()
+
+    asyncio.run(main())
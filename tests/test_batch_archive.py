@@ -0,0 +1,49 @@
+import asyncio
+import io
+import json
+import zipfile
+
+from aiohttp.test_utils import TestClient, TestServer
+from PIL import Image
+
+from config import config
+from web_server import create_app
+
+
+def make_jpeg() -> bytes:
+    stream = io.BytesIO()
+    Image.new('RGB', (320, 240)).save(stream, format='JPEG')
+    return stream.getvalue()
+
+
+def corrupt_member(archive: bytes, name: str) -> bytes:
+    # flips bytes of the compressed data of one member, its CRC check or decompression fails
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        info = zf.getinfo(name)
+    data = bytearray(archive)
+    start = info.header_offset + 30 + len(info.filename.encode()) + len(info.extra)
+    for i in range(start, start + info.compress_size):
+        data[i] ^= 0xff
+    return bytes(data)
+
+
+async def post_batch(body: bytes) -> list:
+    async with TestClient(TestServer(create_app())) as client:
+        response = await client.post('/v1/vision/detection/batch', data=body,
+                                     headers={'Content-Type': 'application/zip'})
+        assert response.status == 200
+        return [json.loads(line) for line in (await response.text()).splitlines()]
+
+
+def test_unreadable_members_fail_alone(monkeypatch):
+    monkeypatch.setattr(config, 'max_upload_bytes', 100_000)
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('a.jpg', make_jpeg())
+        zf.writestr('corrupt.jpg', make_jpeg())
+        zf.writestr('large.jpg', b'\0' * 200_000)
+        zf.writestr('b.jpg', make_jpeg())
+    lines = asyncio.run(post_batch(corrupt_member(stream.getvalue(), 'corrupt.jpg')))
+    codes = {line['filename']: line['code'] for line in lines}
+    assert codes == {'a.jpg': 200, 'corrupt.jpg': 400, 'large.jpg': 413, 'b.jpg': 200}
+    assert sorted(line['index'] for line in lines) == [0, 1, 2, 3]
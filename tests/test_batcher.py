@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+from batcher import DeadlineExceeded, RequestBatcher
+
+
+def make_frames(num_frames: int = 1, value: int = 0) -> np.ndarray:
+    return np.full((num_frames, 2, 2, 3), value, dtype=np.uint8)
+
+
+async def ready(frames: np.ndarray) -> np.ndarray:
+    return frames
+
+
+async def preprocessed_after(delay: float, frames: np.ndarray) -> np.ndarray:
+    await asyncio.sleep(delay)
+    return frames
+
+
+class Device:
+    # stub run_batch: records the batches, one output per frame (the frame's value)
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+        self.batches = []
+        self.start_times = []
+
+    async def run_batch(self, model_name: str, frames: np.ndarray) -> list:
+        self.batches.append(frames[:, 0, 0, 0].tolist())
+        self.start_times.append(time.perf_counter())
+        await asyncio.sleep(self.delay)
+        return frames[:, 0, 0, 0].tolist()
+
+
+def test_batches_are_cut_at_batch_size():
+    async def main():
+        device = Device()
+        batcher = RequestBatcher(device.run_batch, batch_size=4, batch_window_ms=1000)
+        jobs = await asyncio.gather(*[batcher.infer('m', ready(make_frames(1, i))) for i in range(10)])
+        assert [len(batch) for batch in device.batches] == [4, 4, 2]
+        # each request gets the outputs of its own frames
+        assert [job.outputs for job in jobs] == [[i] for i in range(10)]
+    asyncio.run(main())
+
+
+def test_requests_with_several_frames_are_not_split():
+    async def main():
+        device = Device()
+        batcher = RequestBatcher(device.run_batch, batch_size=4, batch_window_ms=1000)
+        jobs = await asyncio.gather(batcher.infer('m', ready(make_frames(3, 1))),
+                                    batcher.infer('m', ready(make_frames(3, 2))))
+        assert device.batches == [[1, 1, 1], [2, 2, 2]]
+        assert [job.outputs for job in jobs] == [[1, 1, 1], [2, 2, 2]]
+    asyncio.run(main())
+
+
+def test_window_waits_for_requests_still_preprocessing():
+    async def main():
+        device = Device()
+        batcher = RequestBatcher(device.run_batch, batch_size=8, batch_window_ms=100)
+        start_time = time.perf_counter()
+        await asyncio.gather(batcher.infer('m', ready(make_frames(1, 0))),
+                             batcher.infer('m', preprocessed_after(0.02, make_frames(1, 1))),
+                             batcher.infer('m', preprocessed_after(0.5, make_frames(1, 2))))
+        # the frame ready within the window joins the batch, the late one does not hold it past the window
+        assert device.batches == [[0, 1], [2]]
+        assert device.start_times[0] - start_time < 0.3
+    asyncio.run(main())
+
+
+def test_lone_request_is_not_held_for_the_window():
+    async def main():
+        device = Device()
+        batcher = RequestBatcher(device.run_batch, batch_size=8, batch_window_ms=1000)
+        start_time = time.perf_counter()
+        await batcher.infer('m', ready(make_frames()))
+        assert time.perf_counter() - start_time < 0.5
+    asyncio.run(main())
+
+
+def test_models_are_batched_apart():
+    async def main():
+        device = Device()
+        batcher = RequestBatcher(device.run_batch, batch_size=8, batch_window_ms=100)
+        await asyncio.gather(batcher.infer('a', ready(make_frames(1, 0))),
+                             batcher.infer('b', ready(make_frames(1, 1))),
+                             batcher.infer('a', ready(make_frames(1, 2))))
+        assert sorted(device.batches) == [[0, 2], [1]]
+    asyncio.run(main())
+
+
+def test_frames_past_their_deadline_are_dropped_before_dispatch():
+    async def main():
+        device = Device(delay=0.1)
+        batcher = RequestBatcher(device.run_batch, batch_size=1, batch_window_ms=0)
+        released = []
+        first = asyncio.create_task(batcher.infer('m', ready(make_frames(1, 0))))
+        await asyncio.sleep(0.01)
+        # waits for the device busy with the first frame, its deadline passes meanwhile
+        late = batcher.infer('m', ready(make_frames(1, 1)), deadline=time.perf_counter() + 0.02,
+                             release=lambda: released.append(1))
+        with pytest.raises(DeadlineExceeded):
+            await late
+        await first
+        assert device.batches == [[0]]
+        # the caller releases the frames of a dropped job itself
+        assert released == []
+        with pytest.raises(DeadlineExceeded):
+            await batcher.infer('m', ready(make_frames()), deadline=time.perf_counter() - 1)
+    asyncio.run(main())
+
+
+def test_device_errors_reach_every_request_of_the_batch():
+    async def main():
+        async def run_batch(model_name, frames):
+            raise RuntimeError('device failed')
+
+        batcher = RequestBatcher(run_batch, batch_size=4, batch_window_ms=100)
+        results = await asyncio.gather(*[batcher.infer('m', ready(make_frames())) for _ in range(3)],
+                                       return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+    asyncio.run(main())
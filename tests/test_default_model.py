@@ -0,0 +1,19 @@
+import numpy as np
+
+from config import config
+from fake_hailo_platform import FAKE_INPUT_SHAPE
+from hailo_infer import HailoDevice
+from responses import new_response
+
+
+def test_other_models_do_not_change_the_default(monkeypatch):
+    monkeypatch.setitem(config.model_filename_dict, 'second', 'models/second.hef')
+    monkeypatch.setattr(config, 'resident_models', [])
+    default_model = config.get_current_model_name()
+    device = HailoDevice()
+    device.start_device()
+    device.infer('second', np.zeros((1,) + FAKE_INPUT_SHAPE, dtype=np.uint8))
+    assert device.current_model_name == 'second'
+    assert config.get_current_model_name() == default_model
+    assert new_response()['moduleId'] == config.get_api_module_id(default_model)
+    device.stop_device()
@@ -0,0 +1,56 @@
+import numpy as np
+
+from config import config
+from detections import extract_detections
+
+NUM_CLASSES = 80
+
+
+def make_output(rows_by_class: dict) -> list:
+    output = [np.empty((0, 5), dtype=np.float32) for _ in range(NUM_CLASSES)]
+    for class_id, rows in rows_by_class.items():
+        output[class_id] = np.array(rows, dtype=np.float32)
+    return output
+
+
+OUTPUT = make_output({0: [[0.1, 0.1, 0.2, 0.2, 0.9], [0.3, 0.3, 0.4, 0.4, 0.7]],
+                      2: [[0.5, 0.5, 0.6, 0.6, 0.8]],
+                      79: [[0.0, 0.0, 0.1, 0.1, 0.5]]})
+
+
+def test_filters_by_threshold():
+    detections = extract_detections(OUTPUT, 0.75)
+    assert detections['num_detections'] == 2
+    assert detections['detection_classes'].tolist() == [0, 2]
+    assert np.allclose(detections['detection_scores'], [0.9, 0.8])
+
+
+def test_config_is_read_per_call(monkeypatch):
+    monkeypatch.setattr(config, 'max_detections', 2)
+    assert extract_detections(OUTPUT, 0.4)['detection_scores'].tolist() == np.float32([0.9, 0.8]).tolist()
+    monkeypatch.setattr(config, 'max_detections', None)
+    monkeypatch.setattr(config, 'default_confidence_score', 0.6)
+    assert extract_detections(OUTPUT)['num_detections'] == 3
+
+
+def test_allowed_classes_out_of_range_are_ignored():
+    detections = extract_detections(OUTPUT, 0.4, allowed_classes=[2, 79, 80, 1000, -1])
+    assert detections['detection_classes'].tolist() == [2, 79]
+
+
+def test_no_detections():
+    detections = extract_detections(make_output({}), 0.4)
+    assert detections['num_detections'] == 0
+    assert detections['detection_boxes'].shape == (0, 4)
+
+
+def test_class_filters_are_read_per_call(monkeypatch):
+    car, person = 2, 0
+    assert extract_detections(OUTPUT, 0.4)['num_detections'] == 4
+    monkeypatch.setattr(config, 'allowed_labels', ['car'])
+    assert extract_detections(OUTPUT, 0.4)['detection_classes'].tolist() == [car]
+    monkeypatch.setattr(config, 'allowed_labels', None)
+    monkeypatch.setattr(config, 'class_confidence_scores', {'person': 0.8})
+    assert extract_detections(OUTPUT, 0.4)['detection_classes'].tolist() == [person, car, 79]
+    monkeypatch.setattr(config, 'class_confidence_scores', {'person': 0.95})
+    assert extract_detections(OUTPUT, 0.4)['detection_classes'].tolist() == [car, 79]
@@ -0,0 +1,59 @@
+import pytest
+
+from config import config
+from hailo_infer import DevicePool, HailoDevice
+
+
+@pytest.fixture
+def pool():
+    # devices are not started, routing only looks at queue depths and config
+    device_pool = DevicePool()
+    device_pool.devices = [HailoDevice(None, index) for index in range(3)]
+    yield device_pool
+    for device in device_pool.devices:
+        device.executor.shutdown()
+
+
+def pick_indices(pool, model_name='yolov8m', times=6):
+    return [pool.pick_device(model_name).index for _ in range(times)]
+
+
+def test_least_loaded_picks_the_shortest_queue(pool, monkeypatch):
+    monkeypatch.setattr(config, 'device_routing', 'least_loaded')
+    pool.devices[0].queue_depth = 3
+    pool.devices[1].queue_depth = 1
+    pool.devices[2].queue_depth = 2
+    assert set(pick_indices(pool)) == {1}
+
+
+def test_least_loaded_ties_rotate(pool, monkeypatch):
+    monkeypatch.setattr(config, 'device_routing', 'least_loaded')
+    assert pick_indices(pool) == [0, 1, 2, 0, 1, 2]
+    pool.devices[1].queue_depth = 1
+    assert set(pick_indices(pool)) == {0, 2}
+
+
+def test_round_robin_ignores_queue_depth(pool, monkeypatch):
+    monkeypatch.setattr(config, 'device_routing', 'round_robin')
+    pool.devices[0].queue_depth = 10
+    assert pick_indices(pool) == [0, 1, 2, 0, 1, 2]
+
+
+@pytest.mark.parametrize('routing', ['least_loaded', 'round_robin'])
+def test_pinned_model_runs_on_its_devices_only(pool, monkeypatch, routing):
+    monkeypatch.setattr(config, 'device_routing', routing)
+    monkeypatch.setattr(config, 'model_devices', {'yolov8m': [0, 2]})
+    pool.devices[0].queue_depth = 1
+    picked = pick_indices(pool)
+    assert set(picked) <= {0, 2}
+    if routing == 'least_loaded':
+        assert set(picked) == {2}
+    # other models still use every device
+    expected = {1, 2} if routing == 'least_loaded' else {0, 1, 2}
+    assert set(pick_indices(pool, 'yolov8s')) == expected
+
+
+def test_pins_out_of_range_fall_back_to_all_devices(pool, monkeypatch):
+    monkeypatch.setattr(config, 'device_routing', 'round_robin')
+    monkeypatch.setattr(config, 'model_devices', {'yolov8m': [5]})
+    assert set(pick_indices(pool)) == {0, 1, 2}
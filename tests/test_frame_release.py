@@ -0,0 +1,125 @@
+import asyncio
+import threading
+import time
+from multiprocessing import Pipe
+
+import numpy as np
+import pytest
+
+import hailo_infer
+import preprocessing
+from batcher import RequestBatcher
+from config import config
+from fake_hailo_platform import FAKE_INPUT_SHAPE
+from inference_image import RawImage
+from prefork import DeviceClient, RemoteDeviceError, SharedFrameRing
+
+SLOTS = 2
+
+
+@pytest.fixture
+def ring(monkeypatch):
+    frame_ring = SharedFrameRing.create(SLOTS, int(np.prod(FAKE_INPUT_SHAPE)))
+    monkeypatch.setattr(preprocessing, 'buffer_pool', frame_ring)
+    yield frame_ring
+    frame_ring.close(unlink=True)
+
+
+def make_image() -> RawImage:
+    model_h, model_w, _ = FAKE_INPUT_SHAPE
+    return RawImage(bytes(model_h * model_w * 3), model_w, model_h)
+
+
+async def wait_for_free_slots(ring: SharedFrameRing, timeout: float = 2) -> int:
+    end_time = time.perf_counter() + timeout
+    while len(ring._free) < SLOTS and time.perf_counter() < end_time:
+        await asyncio.sleep(0.01)
+    return len(ring._free)
+
+
+def test_device_errors_release_the_slot(ring, monkeypatch):
+    conn, owner_conn = Pipe()
+
+    def fail_every_request():
+        # the device owner process answers every frame with an error
+        while True:
+            try:
+                _, request_id, *_ = owner_conn.recv()
+            except EOFError:
+                return
+            owner_conn.send(('error', request_id, 'HailoRTException: device failed'))
+
+    owner = threading.Thread(target=fail_every_request, daemon=True)
+    owner.start()
+    monkeypatch.setattr(hailo_infer, 'batcher', DeviceClient(conn, ring))
+
+    async def run():
+        for _ in range(SLOTS + 1):
+            with pytest.raises(RemoteDeviceError):
+                await hailo_infer.do_inference(make_image(), config.default_model_name)
+        return len(ring._free)
+
+    try:
+        assert asyncio.run(run()) == SLOTS
+    finally:
+        conn.close()
+        owner.join()
+        owner_conn.close()
+
+
+def test_request_cancelled_while_preprocessing_releases_the_slot(ring, monkeypatch):
+    preprocess_image = hailo_infer.preprocess_image
+
+    def slow_preprocess_image(*args):
+        time.sleep(0.2)
+        return preprocess_image(*args)
+
+    async def run_batch(model_name, frames):
+        return [None] * len(frames)
+
+    monkeypatch.setattr(hailo_infer, 'preprocess_image', slow_preprocess_image)
+
+    async def run():
+        hailo_infer.batcher = RequestBatcher(run_batch)
+        task = asyncio.create_task(hailo_infer.do_inference(make_image(), config.default_model_name))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return await wait_for_free_slots(ring)
+
+    monkeypatch.setattr(hailo_infer, 'batcher', None)
+    assert asyncio.run(run()) == SLOTS
+
+
+def test_request_cancelled_on_the_device_releases_the_slot_when_the_device_is_done(ring, monkeypatch):
+    monkeypatch.setattr(hailo_infer, 'batcher', None)
+
+    async def run():
+        started, done = asyncio.Event(), asyncio.Event()
+
+        async def run_batch(model_name, frames):
+            started.set()
+            await done.wait()
+            return [None] * len(frames)
+
+        hailo_infer.batcher = RequestBatcher(run_batch)
+        task = asyncio.create_task(hailo_infer.do_inference(make_image(), config.default_model_name))
+        await started.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # the device still reads the frame
+        free_on_device = len(ring._free)
+        done.set()
+        return free_on_device, await wait_for_free_slots(ring)
+
+    assert asyncio.run(run()) == (SLOTS - 1, SLOTS)
+
+
+def test_acquire_fails_instead_of_waiting_forever(ring, monkeypatch):
+    monkeypatch.setattr(config, 'shm_acquire_timeout_s', 0.05)
+    frames = [ring.acquire((16,)) for _ in range(SLOTS)]
+    with pytest.raises(TimeoutError):
+        ring.acquire((16,))
+    for frame in frames:
+        ring.release(frame)
+    del frames
@@ -0,0 +1,35 @@
+import asyncio
+
+from config import config
+from ingestion import UploadBufferPool, read_stream, upload_pool
+
+
+class Body:
+    # the part of aiohttp's StreamReader read_stream uses
+    def __init__(self, data: bytes, chunk_size: int):
+        self.chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    async def iter_chunked(self, n):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def test_pool_does_not_keep_oversized_buffers():
+    pool = UploadBufferPool(max_free=4, initial_size=16, max_size=64)
+    buffer = pool.acquire()
+    buffer.write(b'x' * 100)
+    buffer.release()
+    small = pool.acquire()
+    small.release()
+    assert [len(data) for data in pool._free] == [16]
+
+
+def test_archive_body_is_not_pooled():
+    data = b'x' * (10 * config.upload_chunk_size)
+    free_before = [id(free) for free in upload_pool._free]
+    buffer = asyncio.run(read_stream(Body(data, config.upload_chunk_size), len(data), pooled=False,
+                                     size_hint=len(data)))
+    assert bytes(buffer.view()) == data
+    assert len(buffer.data) == len(data)
+    buffer.release()
+    assert [id(free) for free in upload_pool._free] == free_before
@@ -0,0 +1,38 @@
+from output_store import OutputStore, READY
+
+
+def write_image(path: str):
+    with open(path, 'wb') as f:
+        f.write(b'\0' * 10)
+
+
+def make_store(directory, max_files=4):
+    return OutputStore(str(directory), max_files=max_files, max_bytes=10 ** 6, max_age_s=3600, max_pending=10)
+
+
+def test_workers_only_evict_their_own_images(tmp_path):
+    stores = [make_store(tmp_path) for _ in range(2)]
+    for index, store in enumerate(stores):
+        store.use_subdirectory(f'worker-{index}', len(stores))
+        assert store.max_files == 2
+    for i in range(3):
+        stores[0].submit(f'a{i}', write_image)
+    stores[0].shutdown()
+    stores[1].submit('b0', write_image)
+    stores[1].shutdown()
+    assert stores[0].get('a0') is None
+    assert stores[0].get('a2').status == READY
+    # worker 0 going over its limit left the image of worker 1 alone
+    assert stores[1].get('b0').status == READY
+    assert (tmp_path / 'worker-1' / 'b0.jpg').is_file()
+
+
+def test_images_of_other_workers_are_found(tmp_path):
+    owner, other = make_store(tmp_path), make_store(tmp_path)
+    owner.use_subdirectory('worker-0', 2)
+    other.use_subdirectory('worker-1', 2)
+    path = owner.submit('a0', write_image)
+    owner.shutdown()
+    assert other.get('a0') is None
+    assert other.find_path('a0') == path
+    assert other.find_path('missing') is None
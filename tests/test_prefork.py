@@ -0,0 +1,77 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import inference_image
+import preprocessing
+from config import config
+from fake_hailo_platform import FAKE_INPUT_SHAPE
+from prefork import SharedFrameRing, get_slot_bytes
+
+
+def test_slot_fits_a_tiled_request(monkeypatch):
+    monkeypatch.setattr(config, 'shm_slot_bytes', None)
+    monkeypatch.setattr(config, 'tile_max_tiles', 6)
+    monkeypatch.setattr(config, 'tile_full_frame', True)
+    assert get_slot_bytes() == 7 * int(np.prod(FAKE_INPUT_SHAPE))
+
+
+def test_too_small_slot_fails_at_startup(monkeypatch):
+    monkeypatch.setattr(config, 'shm_slot_bytes', int(np.prod(FAKE_INPUT_SHAPE)))
+    with pytest.raises(ValueError):
+        get_slot_bytes()
+
+
+def test_tiled_image_fits_into_a_slot(monkeypatch):
+    monkeypatch.setattr(config, 'shm_slot_bytes', None)
+    ring = SharedFrameRing.create(2, get_slot_bytes())
+    monkeypatch.setattr(preprocessing, 'buffer_pool', ring)
+    try:
+        stream = io.BytesIO()
+        Image.new('RGB', (3840, 2160)).save(stream, format='JPEG')
+        stream.seek(0)
+        image = inference_image.TiledImage(stream)
+        model_h, model_w, _ = FAKE_INPUT_SHAPE
+        image.set_model_input_size(model_w, model_h)
+        frames = image.preprocess_batch()
+        assert len(frames) == len(image.tiles) + 1
+        assert ring.slot_of(frames) in range(ring.slots)
+        image.release_buffer()
+        del frames, image
+    finally:
+        ring.close(unlink=True)
+
+
+def test_raw_frame_of_model_size_is_copied_into_a_slot(monkeypatch):
+    ring = SharedFrameRing.create(2, int(np.prod(FAKE_INPUT_SHAPE)))
+    monkeypatch.setattr(preprocessing, 'buffer_pool', ring)
+    try:
+        model_h, model_w, _ = FAKE_INPUT_SHAPE
+        data = np.random.default_rng(0).integers(0, 256, size=FAKE_INPUT_SHAPE, dtype=np.uint8).tobytes()
+        image = inference_image.RawImage(data, model_w, model_h)
+        image.set_model_input_size(model_w, model_h)
+        frame = image.preprocess()
+        assert not image.zero_copy
+        assert frame.tobytes() == data
+        assert ring.slot_of(frame) in range(ring.slots)
+        image.release_buffer()
+        assert sorted(ring._free) == [0, 1]
+        del frame, image
+    finally:
+        ring.close(unlink=True)
+
+
+def test_frames_outside_the_ring_are_refused():
+    ring = SharedFrameRing.create(2, 1024)
+    try:
+        with pytest.raises(ValueError):
+            ring.slot_of(np.zeros(16, dtype=np.uint8))
+        frame = ring.acquire((16,))
+        with pytest.raises(ValueError):
+            ring.slot_of(frame[1:])
+        ring.release(frame)
+        del frame
+    finally:
+        ring.close(unlink=True)
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from benchmarks.quantized_output import DEFAULT_RECORDING, FAKE_SOURCE, check_same_result, load_recording
+from detections import dequantize, extract_detections
+
+NUM_CLASSES = 4
+
+
+def assert_same_rows(quantized_output: list, quantization: tuple, threshold: float, class_thresholds: np.ndarray):
+    expected = extract_detections([dequantize(rows, quantization) for rows in quantized_output], threshold,
+                                  class_thresholds=class_thresholds, top_k=None, allowed_classes=None)
+    actual = extract_detections(quantized_output, threshold, class_thresholds=class_thresholds, top_k=None,
+                                allowed_classes=None, quantization=quantization)
+    assert actual['num_detections'] == expected['num_detections']
+    assert np.array_equal(actual['detection_classes'], expected['detection_classes'])
+    assert np.array_equal(actual['detection_scores'], expected['detection_scores'])
+    assert np.array_equal(actual['detection_boxes'], expected['detection_boxes'])
+    return actual
+
+
+def make_edge_output(thresholds: np.ndarray, quantization: tuple) -> list:
+    # a row per score one step below, at and above the quantized value of each class threshold
+    scale, zero_point = quantization
+    output = []
+    for threshold in thresholds:
+        edge = int(round(threshold / scale + zero_point))
+        scores = np.arange(edge - 2, edge + 3, dtype=np.uint16)
+        rows = np.zeros((len(scores), 5), dtype=np.uint16)
+        rows[:, 2:4] = edge
+        rows[:, 4] = scores
+        output.append(rows)
+    return output
+
+
+@pytest.mark.parametrize('quantization', [(1 / 65535, 0), (1.5259021896696422e-05, 0), (0.003921569, 10),
+                                          (2.3e-05, 123)])
+@pytest.mark.parametrize('threshold', [0.1, 0.4, 0.45, 0.5, 0.7])
+def test_quantized_extraction_keeps_the_float_rows_at_threshold_edges(quantization, threshold):
+    class_thresholds = np.array([0, 0.3, 0.55, 0.9], dtype=np.float32)
+    edges = np.maximum(class_thresholds, threshold)
+    result = assert_same_rows(make_edge_output(edges, quantization), quantization, threshold, class_thresholds)
+    # not all kept or all dropped, the edge is really tested
+    assert 0 < result['num_detections'] < 5 * NUM_CLASSES
+
+
+def test_recording_matches_the_float_outputs():
+    float_outputs, quantized_outputs, quantization, source = load_recording(DEFAULT_RECORDING)
+    # synthetic, see the readme
+    assert source == FAKE_SOURCE
+    assert len(float_outputs) == len(quantized_outputs) > 0
+    for float_output, quantized_output in zip(float_outputs, quantized_outputs):
+        for threshold in (0.1, 0.4, 0.8):
+            # asserts that the quantized path gives exactly what dequantizing the whole output gives
+            check_same_result(float_output, quantized_output, quantization, threshold)
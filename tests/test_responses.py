@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+from benchmarks.responses import check_same_result, make_detection
+from config import config
+from responses import get_message
+
+
+@pytest.mark.parametrize('num_detections', [0, 1, 5, 50, 300])
+def test_response_matches_the_former_one(num_detections):
+    check_same_result(make_detection(num_detections, np.random.default_rng(num_detections)))
+
+
+def test_message_keeps_labels_in_order_of_detection(monkeypatch):
+    monkeypatch.setattr(config, 'detect_msg_len', 25)
+    assert get_message([]) == 'No objects found'
+    assert get_message(['dog', 'dog']) == 'Found dog'
+    assert get_message(['dog', 'cat', 'dog']) == 'Found dog, cat'
+    assert get_message(['person', 'bicycle', 'car', 'truck']) == 'Found person, bicycle...'
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from result_cache import DetectionCache
+
+
+def make_cache():
+    return DetectionCache(max_entries=8, max_bytes=1024 * 1024, ttl_s=30)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_identical_requests_share_one_inference():
+    async def main():
+        cache = make_cache()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {'num_detections': 0}
+
+        results = await asyncio.gather(*[cache.get_or_compute(b'key', compute) for _ in range(3)])
+        assert [result for _, result in results] == ['miss', 'shared', 'shared']
+        assert len(calls) == 1
+        assert (await cache.get_or_compute(b'key', compute))[1] == 'hit'
+    run(main())
+
+
+def test_cancelled_owner_does_not_fail_the_waiters():
+    async def main():
+        cache = make_cache()
+        started = asyncio.Event()
+
+        async def compute():
+            started.set()
+            await asyncio.sleep(0.02)
+            return {'num_detections': 1}
+
+        owner = asyncio.create_task(cache.get_or_compute(b'key', compute))
+        await started.wait()
+        waiter = asyncio.create_task(cache.get_or_compute(b'key', compute))
+        await asyncio.sleep(0)
+        owner.cancel()
+        detections, result = await waiter
+        assert result == 'shared' and detections == {'num_detections': 1}
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        # the result is cached even though the client that started it went away
+        assert (await cache.get_or_compute(b'key', compute))[1] == 'hit'
+    run(main())
+
+
+def test_errors_reach_every_caller_and_are_not_cached():
+    async def main():
+        cache = make_cache()
+
+        async def compute():
+            await asyncio.sleep(0.01)
+            raise RuntimeError('device failed')
+
+        results = await asyncio.gather(*[cache.get_or_compute(b'key', compute) for _ in range(2)],
+                                       return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert not cache._in_flight
+    run(main())
+
+
+def test_compute_is_set_up_before_the_owner_can_be_cancelled():
+    async def main():
+        cache = make_cache()
+        setups = []
+        finished = asyncio.Event()
+
+        def compute():
+            # synchronous part, e.g. taking over the upload buffer
+            setups.append(1)
+            return infer()
+
+        async def infer():
+            await asyncio.sleep(0.01)
+            finished.set()
+            return {'num_detections': 0}
+
+        owner = asyncio.create_task(cache.get_or_compute(b'key', compute))
+        await asyncio.sleep(0)
+        # cancelled before the shared computation had a chance to start
+        owner.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        assert setups == [1]
+        await finished.wait()
+        assert (await cache.get_or_compute(b'key', compute))[1] == 'hit'
+        assert setups == [1]
+    run(main())
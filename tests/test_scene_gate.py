@@ -0,0 +1,14 @@
+from config import config
+from scene_gate import get_camera_id
+
+
+def test_requests_without_camera_id_are_not_gated_by_default():
+    assert config.scene_gate_key == 'camera_id'
+    assert get_camera_id(None, 'snapshot.jpg') is None
+    assert get_camera_id('driveway', 'snapshot.jpg') == 'driveway'
+
+
+def test_filename_key_is_opt_in(monkeypatch):
+    monkeypatch.setattr(config, 'scene_gate_key', 'filename')
+    assert get_camera_id(None, 'driveway.jpg') == 'driveway.jpg'
+    assert get_camera_id('porch', 'driveway.jpg') == 'porch'
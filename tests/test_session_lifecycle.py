@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from config import config
+from fake_hailo_platform import FAKE_INPUT_SHAPE, stats
+from hailo_infer import HailoDevice
+from utils import HailoInference, create_scheduled_vdevice
+
+MODEL = config.default_model_name
+
+
+@pytest.fixture
+def frames():
+    return np.zeros((2,) + FAKE_INPUT_SHAPE, dtype=np.uint8)
+
+
+@pytest.fixture
+def second_model(monkeypatch):
+    # the fake device does not read HEF files, any name will do
+    monkeypatch.setitem(config.model_filename_dict, 'second', 'models/second.hef')
+    return 'second'
+
+
+def test_session_is_opened_once_and_reused(frames):
+    opened, closed = stats['pipelines_opened'], stats['pipelines_closed']
+    hailo_inference = HailoInference(config.model_filename_dict[MODEL])
+    hailo_inference.open_session()
+    hailo_inference.open_session()
+    for _ in range(3):
+        assert len(hailo_inference.run(frames)) == len(frames)
+    assert stats['pipelines_opened'] - opened == 1
+    assert stats['pipelines_closed'] == closed
+
+    hailo_inference.close_session()
+    assert stats['pipelines_closed'] - closed == 1
+    hailo_inference.close_session()
+    assert stats['pipelines_closed'] - closed == 1
+    hailo_inference.release_device()
+
+
+def test_run_without_session_opens_a_pipeline_per_call(frames):
+    opened = stats['pipelines_opened']
+    hailo_inference = HailoInference(config.model_filename_dict[MODEL])
+    hailo_inference.run(frames)
+    hailo_inference.run(frames)
+    assert stats['pipelines_opened'] - opened == 2
+    hailo_inference.release_device()
+
+
+def test_release_closes_the_session(frames):
+    closed, released = stats['pipelines_closed'], stats['devices_released']
+    hailo_inference = HailoInference(config.model_filename_dict[MODEL])
+    hailo_inference.open_session()
+    hailo_inference.run(frames)
+    hailo_inference.release_device()
+    assert stats['pipelines_closed'] - closed == 1
+    assert stats['devices_released'] - released == 1
+
+
+def test_scheduled_session_shares_the_device(frames):
+    target = create_scheduled_vdevice()
+    hailo_inference = HailoInference(config.model_filename_dict[MODEL], target=target)
+    hailo_inference.open_session()
+    activations = stats['activations']
+    hailo_inference.run(frames)
+    # the model scheduler activates the network group, not the session
+    assert stats['activations'] == activations
+    hailo_inference.release_device()
+    assert not target.is_released
+    target.release()
+
+
+def test_evicted_model_closes_its_session(monkeypatch, frames, second_model):
+    monkeypatch.setattr(config, 'max_resident_models', 1)
+    monkeypatch.setattr(config, 'persistent_session', True)
+    monkeypatch.setattr(config, 'resident_models', [])
+    device = HailoDevice()
+    device.start_device(MODEL)
+    opened, closed = stats['pipelines_opened'], stats['pipelines_closed']
+    device.infer(MODEL, frames)
+    assert stats['pipelines_opened'] == opened
+
+    device.infer(second_model, frames)
+    assert list(device.models) == [second_model]
+    assert stats['pipelines_opened'] - opened == 1
+    assert stats['pipelines_closed'] - closed == 1
+
+    device.stop_device()
+    assert stats['pipelines_closed'] - closed == 2
+    assert not device.is_initialized
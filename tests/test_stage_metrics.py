@@ -0,0 +1,45 @@
+import asyncio
+import io
+
+import aiohttp
+from aiohttp.test_utils import TestClient, TestServer
+from PIL import Image
+
+import metrics
+from config import config
+from web_server import create_app
+
+
+def make_jpeg() -> bytes:
+    stream = io.BytesIO()
+    Image.new('RGB', (320, 240), (40, 80, 120)).save(stream, format='JPEG')
+    return stream.getvalue()
+
+
+def test_cache_hits_record_their_stages(monkeypatch):
+    monkeypatch.setattr(config, 'result_cache', True)
+    monkeypatch.setattr(config, 'scene_gate', False)
+    observed = []
+    observe_stages = metrics.observe_stages
+
+    def record(timings, model, endpoint):
+        if endpoint != 'warmup':
+            observed.append(set(timings))
+        observe_stages(timings, model, endpoint)
+
+    monkeypatch.setattr(metrics, 'observe_stages', record)
+
+    async def main():
+        image = make_jpeg()
+        async with TestClient(TestServer(create_app())) as client:
+            for _ in range(2):
+                form = aiohttp.FormData()
+                form.add_field('image', image, filename='snapshot.jpg', content_type='image/jpeg')
+                response = await client.post('/v1/vision/detection', data=form)
+                assert response.status == 200
+
+    asyncio.run(main())
+    # the miss records every stage, the hit the ones it ran
+    assert len(observed) == 2
+    assert 'device_inference' in observed[0]
+    assert 'multipart_parse' in observed[1] and 'device_inference' not in observed[1]
@@ -0,0 +1,97 @@
+import asyncio
+import io
+import json
+
+from aiohttp import WSMsgType
+from aiohttp.test_utils import TestClient, TestServer
+from PIL import Image
+
+import web_server
+from admission import admission
+from config import config
+from web_server import DetectionStream, DetectRequest, create_app
+
+
+def make_jpeg() -> bytes:
+    stream = io.BytesIO()
+    Image.new('RGB', (320, 240)).save(stream, format='JPEG')
+    return stream.getvalue()
+
+
+def slow_inference(monkeypatch, delay: float = 0.2):
+    do_inference = web_server.do_inference
+
+    async def slow_do_inference(*args, **kwargs):
+        await asyncio.sleep(delay)
+        return await do_inference(*args, **kwargs)
+
+    monkeypatch.setattr(web_server, 'do_inference', slow_do_inference)
+
+
+async def run_stream(frames: list, query: str = '', close_early: bool = False) -> list:
+    async with TestClient(TestServer(create_app())) as client:
+        ws = await client.ws_connect(f'/v1/vision/detection/stream{query}')
+        for frame in frames:
+            if isinstance(frame, str):
+                await ws.send_str(frame)
+            else:
+                await ws.send_bytes(frame)
+        messages = []
+        if not close_early:
+            while len(messages) < len(frames):
+                msg = await ws.receive(timeout=5)
+                assert msg.type == WSMsgType.TEXT
+                messages.append(json.loads(msg.data))
+        await ws.close()
+        # the server side of the stream is done with its frames
+        for _ in range(100):
+            if admission.active == 0:
+                break
+            await asyncio.sleep(0.01)
+        return messages
+
+
+def test_every_frame_gets_a_message_with_its_seq():
+    messages = asyncio.run(run_stream([make_jpeg() for _ in range(3)] + ['not a frame']))
+    by_seq = {message['seq']: message for message in messages if 'seq' in message}
+    assert sorted(by_seq) == [0, 1, 2]
+    assert all(message['code'] == 200 and 'predictions' in message for message in by_seq.values())
+    assert [message['code'] for message in messages if 'seq' not in message] == [400]
+
+
+def test_drop_mode_infers_only_the_latest_waiting_frame(monkeypatch):
+    monkeypatch.setattr(config, 'stream_max_in_flight', 1)
+    slow_inference(monkeypatch)
+    messages = asyncio.run(run_stream([make_jpeg() for _ in range(4)], '?drop=1'))
+    dropped = [message['seq'] for message in messages if message.get('dropped')]
+    inferred = [message['seq'] for message in messages if message['code'] == 200]
+    # frame 0 is on the device, 1 and 2 are replaced by the next frame while they wait
+    assert dropped == [1, 2]
+    assert inferred == [0, 3]
+
+
+def test_close_with_frames_in_flight(monkeypatch):
+    slow_inference(monkeypatch)
+    asyncio.run(run_stream([make_jpeg() for _ in range(3)], close_early=True))
+    assert admission.active == 0
+
+
+class ClosingSocket:
+    closed = False
+
+    async def send_str(self, data: str):
+        raise RuntimeError('Cannot write to closing transport')
+
+
+def test_send_to_a_closing_socket_is_not_an_error(monkeypatch):
+    async def main():
+        stream = DetectionStream(None, ClosingSocket(), DetectRequest(), config.default_model_name, '', None, False)
+
+        async def detect(seq, frame):
+            return {'seq': seq, 'code': 200}
+
+        monkeypatch.setattr(stream, 'detect', detect)
+        stream.start(0, b'')
+        await asyncio.gather(*stream.tasks)
+        assert stream.active == 0
+    asyncio.run(main())
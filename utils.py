@@ -1,26 +1,90 @@
 # taken from https://github.com/hailo-ai/Hailo-Application-Code-Examples/blob/main/runtime/python/utils.py
 
-from hailo_platform import (HEF, VDevice, HailoStreamInterface, InferVStreams, ConfigureParams,
-                            InputVStreamParams, OutputVStreamParams, FormatType, HailoSchedulingAlgorithm)
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import ExitStack
 from functools import partial
-from config import logger
+from config import config, logger
 import numpy as np
 
+if config.use_fake_hailo:
+    from fake_hailo_platform import (HEF, Device, VDevice, HailoStreamInterface, InferVStreams, ConfigureParams,
+                                     InputVStreamParams, OutputVStreamParams, FormatType, HailoSchedulingAlgorithm,
+                                     HailoRTException)
+else:
+    from hailo_platform import (HEF, Device, VDevice, HailoStreamInterface, InferVStreams, ConfigureParams,
+                                InputVStreamParams, OutputVStreamParams, FormatType, HailoSchedulingAlgorithm,
+                                HailoRTException)
+
+
+# numpy types of the output buffers by output format type
+OUTPUT_DTYPES = {'FLOAT32': np.float32, 'UINT16': np.uint16, 'UINT8': np.uint8}
+
+
+def scan_devices():
+    """
+    Get ids of the Hailo devices on the machine.
+
+    Returns:
+        list: Device ids, e.g. ['0000:01:00.0'].
+    """
+    return Device.scan()
+
+
+def read_hef_metadata(hef_path):
+    """
+    Read the input and output layer information of a model, no device is opened.
+
+    Args:
+        hef_path (str): Path to the HEF model file.
+
+    Returns:
+        tuple: List of input layer infos, list of output layer infos.
+    """
+    hef = HEF(hef_path)
+    return list(hef.get_input_vstream_infos()), list(hef.get_output_vstream_infos())
+
+
+def create_scheduled_vdevice(device_id=None):
+    """
+    Create a VDevice with the HailoRT model scheduler, so several models can be configured on it at the same time
+    and the scheduler switches between them.
+
+    Args:
+        device_id (str): Id of the physical device to open, the first available one if None.
+
+    Returns:
+        VDevice: Virtual device.
+    """
+    params = VDevice.create_params()
+    params.scheduling_algorithm = HailoSchedulingAlgorithm.ROUND_ROBIN
+    if device_id:
+        return VDevice(params, device_ids=[device_id])
+    return VDevice(params)
+
 
 class HailoInference:
-    def __init__(self, hef_path, output_type='FLOAT32'):
+    def __init__(self, hef_path, output_type='FLOAT32', target=None):
         """
         Initialize the HailoInference class with the provided HEF model file path.
 
         Args:
             hef_path (str): Path to the HEF model file.
+            output_type (str): Format type of the output stream.
+            target (VDevice): Shared scheduled device (see create_scheduled_vdevice), a new device is created if None.
         """
         self.hef = HEF(hef_path)
-        self.target = VDevice()
+        self.owns_target = target is None
+        self.target = VDevice() if self.owns_target else target
+        # network groups on a shared device are activated by the model scheduler, not manually
+        self.is_scheduled = not self.owns_target
         self.network_group = self._configure_and_get_network_group()
         self.network_group_params = self.network_group.create_params()
         self.input_vstreams_params, self.output_vstreams_params = self._create_vstream_params(output_type)
         self.input_vstream_info, self.output_vstream_info = self._get_and_print_vstream_info()
+        self._session = None
+        self._infer_pipeline = None
 
     def _configure_and_get_network_group(self):
         """
@@ -86,12 +150,49 @@ class HailoInference:
         """
         input_dict = self._prepare_input_data(input_data)
 
+        if self._infer_pipeline is not None:
+            return self._infer_pipeline.infer(input_dict)[self.output_vstream_info[0].name]
+
         with InferVStreams(self.network_group, self.input_vstreams_params, self.output_vstreams_params) as infer_pipeline:
+            if self.is_scheduled:
+                return infer_pipeline.infer(input_dict)[self.output_vstream_info[0].name]
             with self.network_group.activate(self.network_group_params):
                 output = infer_pipeline.infer(input_dict)[self.output_vstream_info[0].name]
 
         return output
 
+    def open_session(self):
+        """
+        Build the vstreams and activate the network group once, so they are reused by every following run call
+        until close_session is called.
+        """
+        if self._session is not None:
+            return
+        session = ExitStack()
+        try:
+            self._infer_pipeline = session.enter_context(
+                InferVStreams(self.network_group, self.input_vstreams_params, self.output_vstreams_params))
+            if not self.is_scheduled:
+                session.enter_context(self.network_group.activate(self.network_group_params))
+        except Exception:
+            self._infer_pipeline = None
+            session.close()
+            raise
+        self._session = session
+        logger.info('Persistent inference session is open')
+
+    def close_session(self):
+        """
+        Deactivate the network group and tear down the vstreams of a persistent session, if one is open.
+        """
+        if self._session is None:
+            return
+        session = self._session
+        self._session = None
+        self._infer_pipeline = None
+        session.close()
+        logger.info('Persistent inference session is closed')
+
     def _prepare_input_data(self, input_data):
         """
         Prepare input data for inference.
@@ -117,13 +218,17 @@ class HailoInference:
 
     def release_device(self):
         """
-        Release the Hailo device.
+        Release the Hailo device, or only this model's network group if the device is shared.
         """
-        self.target.release()
+        self.close_session()
+        if self.owns_target:
+            self.target.release()
+        else:
+            self.network_group.shutdown()
 
 
 class HailoAsyncInference:
-    def __init__(self, hef_path, batch_size=1, output_type='FLOAT32'):
+    def __init__(self, hef_path, batch_size=1, output_type='FLOAT32', max_in_flight=4, target=None):
         """
         Initialize the HailoAsyncInference class with the provided HEF model file path.
 
@@ -131,18 +236,24 @@ class HailoAsyncInference:
             hef_path (str): Path to the HEF model file.
             batch_size (int): Batch size for inference.
             output_type (str): Format type of the output stream.
+            max_in_flight (int): Max number of frames submitted to the device and not completed yet.
+            target (VDevice): Shared scheduled device (see create_scheduled_vdevice), a new device is created if None.
         """
-        params = VDevice.create_params()
-        params.scheduling_algorithm = HailoSchedulingAlgorithm.ROUND_ROBIN
-
         self.hef = HEF(hef_path)
-        self.target = VDevice(params)
+        self.owns_target = target is None
+        self.target = create_scheduled_vdevice() if self.owns_target else target
         self.infer_model = self.target.create_infer_model(hef_path)
         self.infer_model.set_batch_size(batch_size)
+        self.output_type = output_type
         self._set_input_output(output_type)
-        self.input_vstream_info, self.output_vstream_info = self._get_vstream_info()
+        self.input_vstream_info, self.output_vstream_info = self._get_and_print_vstream_info()
         self.configured_infer_model = self.infer_model.configure()
-        self.output_results = []
+        self.max_in_flight = max_in_flight
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        # bindings with preallocated output buffers, reused by the following jobs once a job is completed
+        self._free_bindings = queue.SimpleQueue()
+        for _ in range(max_in_flight):
+            self._free_bindings.put(self._create_bindings())
 
     def _set_input_output(self, output_type):
         """
@@ -155,27 +266,42 @@ class HailoAsyncInference:
         self.infer_model.input().set_format_type(input_format_type)
         self.infer_model.output().set_format_type(getattr(FormatType, output_type))
 
-    def callback(self, completion_info, bindings):
+    def callback(self, completion_info, bindings, future: Future):
         """
-        Callback function for handling inference results.
+        Callback function for handling inference results of one job.
 
         Args:
             completion_info: Information about the completion of the inference task.
             bindings: Bindings object containing input and output buffers.
-        """
-        if completion_info.exception:
-            logger.error(f'Inference error: {completion_info.exception}')
-        else:
-            self.output_results.append(bindings.output().get_buffer()[0])
+            future (Future): Future of the job, gets the output or the exception.
+        """
+        try:
+            if completion_info.exception:
+                logger.error(f'Inference error: {completion_info.exception}')
+                future.set_exception(completion_info.exception)
+            else:
+                # bindings go back to the pool, so the output must not reference their buffer
+                future.set_result(_copy_output(bindings.output().get_buffer()))
+        finally:
+            self._free_bindings.put(bindings)
+            self._in_flight.release()
 
-    def _get_vstream_info(self):
+    def _get_and_print_vstream_info(self):
         """
-        Get information about input and output stream layers.
+        Get and print information about input and output stream layers.
 
         Returns:
             tuple: List of input stream layer information, List of output stream layer information.
         """
-        return self.hef.get_input_vstream_infos(), self.hef.get_output_vstream_infos()
+        input_vstream_info = self.hef.get_input_vstream_infos()
+        output_vstream_info = self.hef.get_output_vstream_infos()
+
+        for layer_info in input_vstream_info:
+            logger.info(f'Input layer: {layer_info.name} {layer_info.shape} {layer_info.format.type}')
+        for layer_info in output_vstream_info:
+            logger.info(f'Output layer: {layer_info.name} {layer_info.shape} {layer_info.format.type}')
+
+        return input_vstream_info, output_vstream_info
 
     def get_input_shape(self):
         """
@@ -186,38 +312,62 @@ class HailoAsyncInference:
         """
         return self.input_vstream_info[0].shape  # Assumes that the model has one input
 
-    def get_output_results(self):
+    def submit(self, input_data):
         """
-        Get the results of the inference.
+        Submit frames for asynchronous inference. Blocks only while max_in_flight frames are already on the device.
+
+        Args:
+            input_data (np.ndarray): Input frames, (H, W, C) or (N, H, W, C).
 
         Returns:
-            list: List of inference outputs.
+            list: One Future per frame, resolved with the inference output of that frame.
         """
-        return self.output_results
+        if input_data is None or input_data.size == 0 or input_data.ndim == 1:
+            raise ValueError('Input data is empty')
+        if input_data.ndim == 3:
+            input_data = np.expand_dims(input_data, axis=0)
+
+        futures = []
+        for frame in input_data:
+            self._in_flight.acquire()
+            future = Future()
+            bindings = self._free_bindings.get()
+            try:
+                bindings.input().set_buffer(frame)
+                self.configured_infer_model.wait_for_async_ready(timeout_ms=10000)
+                self.configured_infer_model.run_async([bindings], partial(self.callback, bindings=bindings,
+                                                                          future=future))
+            except Exception as e:
+                self._free_bindings.put(bindings)
+                self._in_flight.release()
+                future.set_exception(e)
+            futures.append(future)
+        return futures
 
     def run(self, input_data):
         """
-        Run asynchronous inference on the Hailo-8 device.
+        Run asynchronous inference on the Hailo-8 device and wait for all the frames.
 
         Args:
             input_data (np.ndarray): Input data for inference.
 
         Returns:
-            list: List of inference outputs.
+            list: List of inference outputs, one per frame.
         """
-        if input_data.ndim == 1 or input_data.size == 0 or input_data is None:
-            logger.error('Input data is empty')
-        if input_data.ndim == 3:
-            input_data = np.expand_dims(input_data, axis=0)
+        return [future.result(timeout=10) for future in self.submit(input_data)]
 
-        for frame in input_data:
-            bindings = self._create_bindings()
-            bindings.input().set_buffer(frame)
-            self.configured_infer_model.wait_for_async_ready(timeout_ms=10000)
-            job = self.configured_infer_model.run_async([bindings], partial(self.callback, bindings=bindings))
+    def open_session(self):
+        """
+        Configured infer model stays open for the lifetime of this object, nothing to do.
+        """
 
-        job.wait(10000)  # Wait for the last job
-        return self.output_results
+    def close_session(self):
+        """
+        Wait until all the submitted jobs are completed.
+        """
+        acquired = [self._in_flight.acquire(timeout=10) for _ in range(self.max_in_flight)]
+        for _ in range(sum(acquired)):
+            self._in_flight.release()
 
     def _create_bindings(self):
         """
@@ -226,13 +376,25 @@ class HailoAsyncInference:
         Returns:
             bindings: Bindings object with input and output buffers.
         """
-        output_buffers = {name: np.empty(self.infer_model.output(name).shape, dtype=np.float32)
+        output_buffers = {name: np.empty(self.infer_model.output(name).shape, dtype=OUTPUT_DTYPES[self.output_type])
                           for name in self.infer_model.output_names}
         return self.configured_infer_model.create_bindings(output_buffers=output_buffers)
 
     def release_device(self):
         """
-        Release the Hailo device.
+        Release the Hailo device, or only this model if the device is shared.
         """
+        self.close_session()
+        self.configured_infer_model.shutdown()
         del self.configured_infer_model
-        self.target.release()
+        if self.owns_target:
+            self.target.release()
+
+
+def _copy_output(output):
+    """
+    Copy an output buffer, NMS outputs come as a list of per class arrays.
+    """
+    if isinstance(output, np.ndarray):
+        return output.copy()
+    return [_copy_output(o) for o in output]
@@ -1,4 +1,6 @@
 # taken from https://github.com/hailo-ai/Hailo-Application-Code-Examples/blob/main/runtime/python/object_detection/object_detection.py
+from functools import lru_cache
+
 import numpy as np
 from PIL import ImageDraw, ImageFont
 
@@ -8,53 +10,64 @@ PADDING_COLOR = (114, 114, 114)
 COLORS = np.random.randint(0, 255, size=(100, 3), dtype=np.uint8)
 
 
-def draw_detection(labels, draw, box, cls, score, color, scale_factor):
+@lru_cache(maxsize=8)
+def get_font(size: int):
+    """
+    Label font, loaded once per size. Falls back to the PIL default font if LiberationSans is not installed.
+    """
+    try:
+        return ImageFont.truetype(LABEL_FONT, size=size)
+    except OSError:
+        try:
+            return ImageFont.load_default(size=size)
+        except TypeError:
+            # Pillow < 10.1, bitmap font of a fixed size
+            return ImageFont.load_default()
+
+
+def draw_detection(draw, box, label, score, color, font, line_width):
     """
     Draw box and label for one detection.
 
     Args:
-        labels (list): List of class labels.
         draw (ImageDraw.Draw): Draw object to draw on the image.
-        box (list): Bounding box coordinates.
-        cls (int): Class index.
-        score (float): Detection score.
+        box (list): Bounding box [ymin, xmin, ymax, xmax] in image pixels.
+        label (str): Class label.
+        score (float): Detection score, %.
         color (tuple): Color for the bounding box.
-        scale_factor (float): Scale factor for coordinates.
-
-    Returns:
-        str: Detection label.
+        font (ImageFont): Label font.
+        line_width (int): Box line width.
     """
-    label = f"{labels[cls]}: {score:.2f}%"
+    label = f"{label}: {score:.2f}%"
     ymin, xmin, ymax, xmax = box
-    font = ImageFont.truetype(LABEL_FONT, size=15)
-    draw.rectangle([(xmin * scale_factor, ymin * scale_factor), (xmax * scale_factor, ymax * scale_factor)],
-                   outline=color, width=2)
-    draw.text((xmin * scale_factor + 4, ymin * scale_factor + 4), label, fill=color, font=font)
+    draw.rectangle([(xmin, ymin), (xmax, ymax)], outline=color, width=line_width)
+    draw.text((xmin + line_width + 2, ymin + line_width + 2), label, fill=color, font=font)
 
 
-def visualize(labels, detections, image, image_path, width, height, min_score=0.45, scale_factor=1):
+def visualize(detections, image, image_path, min_score=0.45):
     """
-    Visualize detections on the image.
+    Visualize detections on the original image.
 
     Args:
-        labels (list): List of class labels.
-        detections (dict): Detection results.
-        image (PIL.Image.Image): Image to draw on.
+        detections (dict): Detection results with 'absolute_boxes' in the image pixels.
+        image (PIL.Image.Image): Original image to draw on.
         image_path (Path): Path to save the output image.
-        width (int): Image width.
-        height (int): Image height.
         min_score (float): Minimum score threshold.
-        scale_factor (float): Scale factor for coordinates.
     """
-    boxes = detections['detection_boxes']
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    boxes = np.asarray(detections['absolute_boxes']).reshape(-1, 4).tolist()
     classes = detections['detection_classes']
     scores = detections['detection_scores']
+    labels = detections['detection_labels']
     draw = ImageDraw.Draw(image)
+    # font and lines grow with the image, so labels stay readable on 4K snapshots
+    font = get_font(max(15, image.width // 80))
+    line_width = max(2, image.width // 640)
 
     for idx in range(detections['num_detections']):
         if scores[idx] >= min_score:
-            color = tuple(int(c) for c in COLORS[classes[idx]])
-            scaled_box = [x * width if i % 2 == 0 else x * height for i, x in enumerate(boxes[idx])]
-            draw_detection(labels, draw, scaled_box, classes[idx], scores[idx] * 100.0, color, scale_factor)
+            color = tuple(int(c) for c in COLORS[classes[idx] % len(COLORS)])
+            draw_detection(draw, boxes[idx], labels[idx], scores[idx] * 100.0, color, font, line_width)
 
     image.save(image_path, 'JPEG')
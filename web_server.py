@@ -1,14 +1,32 @@
+import asyncio
+import copy
+import functools
 import io
 import time
 import math
 from typing import Optional
 
-from aiohttp import web
+import numpy as np
+from PIL import UnidentifiedImageError
+from aiohttp import web, WSMsgType
 from aiohttp.web_routedef import Request
 
 from config import logger, config
-from hailo_infer import do_inference
-from inference_image import InferenceImage
+from hailo_infer import do_inference, cpu_executor, get_input_shape, visualize_detections
+from detections import filter_detections, build_predictions
+from inference_image import InferenceImage, TiledImage, RawImage, parse_zone
+import metrics
+from ingestion import (UploadBuffer, UploadTooLarge, read_part, read_stream, upload_pool, ImageArchive, ARCHIVE_TYPES,
+                       MEMBER_ERRORS)
+from result_cache import result_cache, get_confidence_bucket
+from preprocessing import make_thumbnail
+from scene_gate import scene_gate, normalize_thumbnail, get_camera_id
+from output_store import output_store
+from admission import admission, Rejected, get_deadline, get_priority
+from batcher import DeadlineExceeded
+from responses import new_response, build_detection_response, encode, json_response
+import startup
+from startup import readiness
 
 routes = web.RouteTableDef()
 
@@ -23,20 +41,78 @@ def html_response(document):
 
 
 class DetectRequest:
+    # form fields (and query parameters of batch requests) besides the image
+    options = ('min_confidence', 'camera_id', 'tiled', 'zone')
+
     def __init__(self):
         self.min_confidence: Optional[float] = None
+        self.camera_id: Optional[str] = None
+        self.tiled: Optional[bool] = None
+        self.zone: Optional[np.ndarray] = None
         self.filename: Optional[str] = None
-        self.file_content: Optional[bytearray] = None
+        self.file_content: Optional[UploadBuffer] = None
+        self.raw_size: Optional[tuple] = None  # (width, height) of a raw RGB frame, None for encoded images
+        self.keep_content = False  # the upload is still read by an inference that outlives the request
+
+    def set_option(self, name: str, value: str):
+        """
+        Raises:
+            ValueError: The value is invalid.
+        """
+        if name == 'min_confidence':
+            self.min_confidence = float(value)
+        elif name == 'camera_id':
+            self.camera_id = value
+        elif name == 'tiled':
+            self.tiled = parse_flag(value)
+        elif name == 'zone':
+            self.zone = parse_zone(value)
+
+    def set_query_options(self, query):
+        for name in self.options:
+            if name in query:
+                self.set_option(name, query[name])
+
+    def for_image(self, filename: str, file_content: UploadBuffer) -> 'DetectRequest':
+        # an image of a batch request, with the options set so far
+        dr = copy.copy(self)
+        dr.filename = filename
+        dr.file_content = file_content
+        return dr
 
     def is_valid(self):
-        return (self.filename is not None
+        return ((self.raw_size is not None or (self.filename is not None and len(self.filename) > 0))
                 and self.file_content is not None
-                and len(self.filename) > 0
                 and len(self.file_content) > 0)
 
     def get_confidence_score(self):
         return self.min_confidence if self.min_confidence else config.default_confidence_score
 
+    def is_tiled(self, model_name: str):
+        return self.tiled if self.tiled is not None else model_name in config.tiled_models
+
+    def get_zone(self) -> Optional[np.ndarray]:
+        if self.zone is not None:
+            return self.zone
+        zone = config.camera_zones.get(self.camera_id or self.filename)
+        return parse_zone(zone) if zone is not None else None
+
+    def create_image(self, model_name: str) -> InferenceImage:
+        if self.raw_size is not None:
+            # raw frames are never tiled, they are usually of the model input size already
+            return RawImage(self.file_content.view(), *self.raw_size, self.get_zone())
+        # PIL reads straight from the upload buffer, no copy of the whole body
+        image_class = TiledImage if self.is_tiled(model_name) else InferenceImage
+        return image_class(self.file_content.reader(), self.get_zone())
+
+    def release(self):
+        if self.file_content is not None and not self.keep_content:
+            self.file_content.release()
+
+
+def parse_flag(value: str) -> bool:
+    return value.strip().lower() in ('1', 'true', 'yes')
+
 
 def log_request(request: Request):
     logger.debug(request)
@@ -64,6 +140,20 @@ async def ping_handler(request):
     return web.json_response(response_json)
 
 
+@routes.get('/v1/server/status/ready')
+async def ready_handler(request):
+    # unlike ping, 200 only once the cards are open and the preloaded models are warmed up, for health checks
+    response_json = {"code": 200 if readiness.is_ready else 503,
+                     "success": readiness.is_ready,
+                     "status": readiness.status,
+                     "warmedUpModels": readiness.warmed_up_models}
+    if readiness.startup_s is not None:
+        response_json["startupMs"] = int(readiness.startup_s * 1000)
+    if readiness.error:
+        response_json["error"] = readiness.error
+    return web.json_response(response_json, status=response_json["code"])
+
+
 @routes.get('/v1/status/updateavailable')
 async def ping_handler(request):
     # this endpoint is needed for BlueIris
@@ -90,7 +180,7 @@ async def ping_handler(request):
 @routes.post('/v1/vision/custom/list')
 async def list_custom_handler(request):
     start_time = time.perf_counter()
-    response_json = config.get_common_response()
+    response_json = new_response()
     print(response_json)
     response_json.update({"code": 200,
                           "success": True,
@@ -100,95 +190,264 @@ async def list_custom_handler(request):
                           "analysisRoundTripMs": math.ceil((time.perf_counter() - start_time) * 1000),
                           "timestampUTC": get_gmt_timestamp()})
     print(response_json)
-    return web.json_response(response_json)
+    return json_response(response_json)
+
+
+def get_raw_size(query) -> tuple:
+    """
+    Raises:
+        ValueError: No or invalid 'width' and 'height' query parameters.
+    """
+    if 'width' not in query or 'height' not in query:
+        raise ValueError('raw RGB frames need width and height query parameters')
+    return int(query['width']), int(query['height'])
+
+
+async def read_option(part) -> str:
+    if part.name == 'min_confidence':
+        return (await part.form())[0][0]
+    return await part.text()
+
+
+async def parse_raw_request(request: Request) -> DetectRequest:
+    # the body is a raw RGB frame, the options are query parameters
+    dr = DetectRequest()
+    dr.set_query_options(request.query)
+    dr.raw_size = get_raw_size(request.query)
+    dr.file_content = await read_stream(request.content, config.max_upload_bytes)
+    width, height = dr.raw_size
+    if len(dr.file_content) != width * height * 3:
+        dr.release()
+        raise ValueError(f'raw frame of {len(dr.file_content)} bytes is not a {width}x{height} RGB frame')
+    return dr
 
 
 async def parse_detection_request(request: Request) -> DetectRequest:
+    if request.content_length is not None and request.content_length > config.max_upload_bytes:
+        raise UploadTooLarge(config.max_upload_bytes)
+    if request.content_type == RAW_CONTENT_TYPE:
+        return await parse_raw_request(request)
     dr = DetectRequest()
     m_p = await request.multipart()
-    m_p_next = await m_p.next()
-    while m_p_next:
-        if m_p_next.name == 'min_confidence':
-            m_c = await m_p_next.form()
-            dr.min_confidence = float(m_c[0][0])
-        if m_p_next.name == 'image':
-            dr.filename = m_p_next.filename
-            dr.file_content = await m_p_next.read()
+    try:
         m_p_next = await m_p.next()
-    await m_p.release()
+        while m_p_next:
+            if m_p_next.name in DetectRequest.options:
+                dr.set_option(m_p_next.name, await read_option(m_p_next))
+            if m_p_next.name == 'image':
+                dr.filename = m_p_next.filename
+                if dr.file_content is not None:
+                    dr.file_content.release()
+                dr.file_content = await read_part(m_p_next)
+            m_p_next = await m_p.next()
+        await m_p.release()
+    except BaseException:
+        dr.release()
+        raise
     return dr
 
 
-def format_detection_response(detection: dict, response_dict: dict = config.get_common_response()):
-    num_detections = detection['num_detections']
-    labels = detection["detection_labels"]
-    detection_scores = detection["detection_scores"]
-    detection_boxes = detection["absolute_boxes"]
-    response_dict.update({"command": "detect",
-                          "count": num_detections,
-                          'inferenceMs': detection['inferenceMs'],
-                          'processMs': detection['processMs']})
-    if detection.get('success'):
-        response_dict.update({'success': detection.get('success')})
-    if detection.get('error'):
-        response_dict.update({'error': detection.get('error')})
-    if detection.get('imagePath'):
-        response_dict.update({'imagePath': detection.get('imagePath')})
-    if num_detections == 0:
-        message = 'No objects found'
+RAW_CONTENT_TYPE = 'application/octet-stream'
+
+
+def get_endpoint(request: Request) -> str:
+    # route template, e.g. /v1/vision/custom/{model_name}, so metrics are not split by model in the path
+    resource = request.match_info.route.resource
+    return resource.canonical if resource else request.path
+
+
+def reject_request(endpoint: str, reason: str, text: str, status: int, headers: Optional[dict] = None):
+    metrics.rejected.inc(endpoint, reason)
+    metrics.requests_total.inc(endpoint, str(status))
+    return web.Response(text=text, status=status, content_type='text/html', headers=headers)
+
+
+def reject_overloaded(endpoint: str, reason: str, text: str):
+    # fast 503, so the client retries later or elsewhere instead of waiting for a stale result
+    return reject_request(endpoint, reason, text, 503, headers={'Retry-After': str(config.retry_after_s)})
+
+
+def get_result_model(image: InferenceImage, model_name: str) -> str:
+    # e.g. tiled and whole frame results of the same model are cached and gated apart
+    return model_name + image.get_variant()
+
+
+async def get_cached_detections(dr: DetectRequest, image: InferenceImage, model_name: str, endpoint: str,
+                                deadline: Optional[float] = None) -> dict:
+    """
+    Detections from the result cache, inference runs only for the first of identical uploads.
+
+    Args:
+        dr (DetectRequest): Parsed request, the upload bytes are the cache key.
+        image (InferenceImage): Image to run inference on if the result is not cached.
+        model_name (str): Model name.
+        endpoint (str): Route of the request, for metrics.
+        deadline (float): time.perf_counter() time, passed to do_inference.
+
+    Returns:
+        dict: Detections filtered to the requested min_confidence, as returned by do_inference.
+    """
+    start_time = time.perf_counter()
+    confidence_score = dr.get_confidence_score()
+    confidence_bucket = get_confidence_bucket(confidence_score)
+    with dr.file_content.view() as content:
+        key = result_cache.make_key(content, get_result_model(image, model_name), confidence_bucket)
+
+    def compute():
+        # the inference is shared with identical uploads and goes on if this client goes away, so it releases
+        # the upload it reads from itself; kept from here on, before this request can be cancelled and release it
+        dr.keep_content = True
+        return run_inference()
+
+    async def run_inference():
+        try:
+            return await do_inference(image, confidence_score=confidence_bucket, model_name=model_name,
+                                      endpoint=endpoint, deadline=deadline)
+        finally:
+            dr.keep_content = False
+            dr.release()
+
+    detections, result = await result_cache.get_or_compute(key, compute)
+    detections = filter_detections(detections, confidence_score)
+    if result != 'miss':
+        # the device was not used for this request, the stages it did run (e.g. multipart_parse) are recorded here
+        detections.update({'processMs': int((time.perf_counter() - start_time) * 1000), 'inferenceMs': 0})
+        metrics.observe_stages(image.timings, model_name, endpoint)
+    return detections
+
+
+async def get_gated_detections(dr: DetectRequest, image: InferenceImage, camera_id: str, model_name: str,
+                               endpoint: str, deadline: Optional[float] = None) -> dict:
+    """
+    Detections of the camera's last inferred frame if the scene has not changed, otherwise inference as usual.
+
+    Args:
+        dr (DetectRequest): Parsed request.
+        image (InferenceImage): Image to run inference on if the scene has changed.
+        camera_id (str): Camera id or uploaded file name.
+        model_name (str): Model name.
+        endpoint (str): Route of the request, for metrics.
+        deadline (float): time.perf_counter() time, passed to do_inference.
+
+    Returns:
+        dict: Detections as returned by do_inference, with 'sceneGate' info.
+    """
+    start_time = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    confidence_score = dr.get_confidence_score()
+    thumbnail, (img_w, img_h) = await loop.run_in_executor(cpu_executor, make_thumbnail,
+                                                           dr.file_content.reader(), config.scene_gate_thumb_size)
+    thumbnail = normalize_thumbnail(thumbnail)
+    image.timings['scene_gate'] = time.perf_counter() - start_time
+    state, difference = scene_gate.check(camera_id, get_result_model(image, model_name), thumbnail, confidence_score)
+    if state is not None:
+        # boxes are normalized to the letterboxed model input, so they are re-scaled to this frame's size
+        model_h, model_w, _ = await get_input_shape(model_name)
+        image.set_model_input_size(model_w, model_h)
+        image.set_geometry(img_w, img_h)
+        detections = dict(state.detections)
+        image.postprocess(detections)
+        detections = filter_detections(detections, confidence_score)
+        detections.update({'processMs': int((time.perf_counter() - start_time) * 1000), 'inferenceMs': 0})
+        metrics.observe_stages(image.timings, model_name, endpoint)
+        skips = state.skips
     else:
-        deduped_labels = list(set(labels))
-        if len(deduped_labels) == 1:
-            message = f'Found {deduped_labels[0]}'
+        if config.result_cache:
+            detections = await get_cached_detections(dr, image, model_name, endpoint, deadline)
         else:
-            message = f'Found {", ".join(deduped_labels)}'
-            message = message[:config.detect_msg_len]
-            comma_ind = message.rfind(',')
-            if comma_ind > config.detect_msg_len - 3:
-                message = message[:comma_ind]
-                comma_ind = message.rfind(',')
-                message = f'{message[:comma_ind]}...'
-    predictions = []
-    for i in range(num_detections):
-        prediction = {"confidence": float(detection_scores[i]),
-                      "label": labels[i],
-                      "x_min": detection_boxes[i][1],
-                      "y_min": detection_boxes[i][0],
-                      "x_max": detection_boxes[i][3],
-                      "y_max": detection_boxes[i][2]
-                      }
-        predictions.append(prediction)
-    response_dict.update({'message': message, 'predictions': predictions})
-
-    return response_dict
+            detections = await do_inference(image, confidence_score=confidence_score, model_name=model_name,
+                                            endpoint=endpoint, deadline=deadline)
+        scene_gate.update(camera_id, get_result_model(image, model_name), thumbnail, detections, confidence_score)
+        detections = dict(detections)
+        skips = 0
+    detections['sceneGate'] = {'skipped': state is not None,
+                               'difference': None if difference is None else round(difference, 2),
+                               'skips': skips}
+    return detections
+
+
+async def get_detections(dr: DetectRequest, image: InferenceImage, model_name: str, endpoint: str,
+                         deadline: float, camera_id: Optional[str] = None, use_cache: bool = True) -> dict:
+    """
+    Detections through the scene gate if camera_id is set, otherwise through the result cache if use_cache,
+    otherwise straight from do_inference.
+    """
+    if camera_id:
+        return await get_gated_detections(dr, image, camera_id, model_name, endpoint, deadline)
+    if config.result_cache and use_cache:
+        return await get_cached_detections(dr, image, model_name, endpoint, deadline)
+    return await do_inference(image, confidence_score=dr.get_confidence_score(), model_name=model_name,
+                              endpoint=endpoint, deadline=deadline)
 
 
 async def handle_detection_request(request: Request,
                                    model_name: Optional[str] = None,
                                    do_visualization: Optional[bool] = None):
     start_time = time.perf_counter()
-    web_response = config.get_common_response()
+    endpoint = get_endpoint(request)
+    # raw RGB frames are not images that can be drawn on
+    if request.content_type != 'multipart/form-data' and (request.content_type != RAW_CONTENT_TYPE
+                                                          or do_visualization):
+        return reject_request(endpoint, 'content_type', f'{request.content_type} is not supported', 400)
+
+    # the body is not read until the request is admitted, waiting requests hold no buffers
+    deadline = get_deadline(request.headers, start_time)
+    # right after a restart requests wait for the warm-up instead of getting a cold server
+    if not readiness.is_ready and not await readiness.wait(deadline):
+        return reject_overloaded(endpoint, 'not_ready', f'Server is not ready: {readiness.status}')
+    try:
+        async with admission.slot(get_priority(endpoint), deadline):
+            return await process_detection_request(request, endpoint, model_name, do_visualization,
+                                                   start_time, deadline)
+    except Rejected as e:
+        return reject_overloaded(endpoint, e.reason, str(e))
+
+
+async def process_detection_request(request: Request,
+                                    endpoint: str,
+                                    model_name: Optional[str],
+                                    do_visualization: Optional[bool],
+                                    start_time: float,
+                                    deadline: float):
     if not model_name:
         model_name = config.get_current_model_name()
-    if request.content_type != 'multipart/form-data':
-        return web.Response(text=f'{request.content_type} is not supported', status=400, content_type='text/html')
-
-    dr: DetectRequest = await parse_detection_request(request)
-    if not dr.is_valid():
-        return web.Response(text='Submitted form is invalid', status=400, content_type='text/html')
-
-    logger.debug('Got image stream')
-    image = InferenceImage(io.BytesIO(dr.file_content))
-    logger.debug('Processed image stream')
-    infer_result = await do_inference(image,
-                                      confidence_score=dr.get_confidence_score(),
-                                      model_name=model_name,
-                                      image_uuid=web_response['requestId'] if do_visualization else None)
-    if model_name:
-        updated_response_new_model = config.get_common_response()
-        web_response['moduleId'] = updated_response_new_model['moduleId']
-        web_response['moduleName'] = updated_response_new_model['moduleName']
-    detection_result = format_detection_response(infer_result, web_response)
+    web_response = new_response(model_name)
+    try:
+        dr: DetectRequest = await parse_detection_request(request)
+    except UploadTooLarge as e:
+        return reject_request(endpoint, 'too_large', str(e), 413)
+    except ValueError as e:
+        return reject_request(endpoint, 'invalid_form', f'Submitted form is invalid: {e}', 400)
+    parsed_time = time.perf_counter()
+    try:
+        if not dr.is_valid():
+            return reject_request(endpoint, 'invalid_form', 'Submitted form is invalid', 400)
+
+        logger.debug('Got image stream')
+        image = dr.create_image(model_name)
+        image.timings['multipart_parse'] = parsed_time - start_time
+        logger.debug('Processed image stream')
+        # the scene gate decodes a thumbnail of the upload, raw frames skip it
+        camera_id = (get_camera_id(dr.camera_id, dr.filename)
+                     if config.scene_gate and not do_visualization and dr.raw_size is None else None)
+        infer_result = await get_detections(dr, image, model_name, endpoint, deadline, camera_id,
+                                            use_cache=not do_visualization)
+        if do_visualization:
+            # rendered in the background on the original image, the response does not wait for it
+            image_id = f"{web_response['requestId']}_{model_name}"
+            image_path = output_store.submit(image_id, functools.partial(
+                visualize_detections, bytes(dr.file_content.view()), infer_result, model_name, endpoint))
+            infer_result.update({'imagePath': image_path,
+                                 'imageStatusPath': f'/v1/visualization/status/{image_id}'})
+    except DeadlineExceeded:
+        return reject_overloaded(endpoint, 'deadline', 'Request deadline passed before inference')
+    except Exception:
+        metrics.errors.inc(endpoint)
+        metrics.requests_total.inc(endpoint, '500')
+        raise
+    finally:
+        dr.release()
+    detection_result = build_detection_response(infer_result, web_response)
     logger.debug(f'Detection result: %s', detection_result)
 
     code = 400 if detection_result.get('error') or not detection_result.get('success') else 200
@@ -200,7 +459,11 @@ async def handle_detection_request(request: Request,
                 detection_result['message'],
                 detection_result['analysisRoundTripMs'],
                 detection_result['inferenceMs'])
-    return web.json_response(detection_result)
+    with metrics.stage_duration.time('json_encoding', model_name, endpoint):
+        body = encode(detection_result)
+    metrics.request_duration.observe(time.perf_counter() - start_time, model_name, endpoint)
+    metrics.requests_total.inc(endpoint, str(code))
+    return web.Response(body=body, content_type='application/json')
 
 
 @routes.post('/v1/vision/detection')
@@ -216,18 +479,409 @@ async def custom_model_detection_response(request):
     return await handle_detection_request(request, model_name=model_name)
 
 
+async def detect_batch_image(request: Request, dr: DetectRequest, index: int, model_name: str,
+                             endpoint: str) -> dict:
+    """
+    Detection response of one image of a batch request, errors are returned as responses too.
+
+    Args:
+        request (Request): Batch request, its deadline header applies to each image.
+        dr (DetectRequest): Image with its options, released here.
+        index (int): Position of the image in the request.
+        model_name (str): Model name.
+        endpoint (str): Route of the request, for metrics and priority.
+
+    Returns:
+        dict: Same fields as a single image detection response, with 'index' and 'filename'.
+    """
+    start_time = time.perf_counter()
+    deadline = get_deadline(request.headers, start_time)
+    web_response = new_response(model_name)
+    web_response.update({'index': index, 'filename': dr.filename})
+    try:
+        # the scene gate is not used, frames of a batch complete in any order
+        async with admission.slot(get_priority(endpoint), deadline):
+            infer_result = await get_detections(dr, dr.create_image(model_name), model_name, endpoint, deadline)
+        detection_result = build_detection_response(infer_result, web_response)
+        code = 400 if detection_result.get('error') or not detection_result.get('success') else 200
+    except (Rejected, DeadlineExceeded) as e:
+        metrics.rejected.inc(endpoint, e.reason if isinstance(e, Rejected) else 'deadline')
+        detection_result, code = web_response, 503
+        detection_result.update({'success': False, 'error': str(e) or 'Request deadline passed before inference'})
+    except UnidentifiedImageError as e:
+        detection_result, code = web_response, 400
+        detection_result.update({'success': False, 'error': str(e)})
+    except Exception as e:
+        logger.exception('Batch image %d failed', index)
+        metrics.errors.inc(endpoint)
+        detection_result, code = web_response, 500
+        detection_result.update({'success': False, 'error': f'{type(e).__name__}: {e}'})
+    finally:
+        dr.release()
+    detection_result.update({"code": code,
+                             "analysisRoundTripMs": math.ceil((time.perf_counter() - start_time) * 1000)})
+    metrics.request_duration.observe(time.perf_counter() - start_time, model_name, endpoint)
+    metrics.requests_total.inc(endpoint, str(code))
+    return detection_result
+
+
+async def read_multipart_images(request: Request, dr: DetectRequest):
+    # image parts one at a time, form fields before an image apply to it and to the following ones
+    m_p = await request.multipart()
+    m_p_next = await m_p.next()
+    while m_p_next:
+        if m_p_next.name in DetectRequest.options:
+            dr.set_option(m_p_next.name, await read_option(m_p_next))
+        elif m_p_next.name == 'image':
+            yield m_p_next.filename, await read_part(m_p_next)
+        m_p_next = await m_p.next()
+    await m_p.release()
+
+
+async def read_archive_images(archive: ImageArchive):
+    # (name, buffer) of each image, (name, exception) of members that can not be read
+    loop = asyncio.get_running_loop()
+    for name, member in archive.members:
+        # members are read one after another, a tar stream can not be read from several threads
+        try:
+            content = await loop.run_in_executor(cpu_executor, archive.read, member)
+        except MEMBER_ERRORS as e:
+            yield name, e
+            continue
+        buffer = upload_pool.acquire()
+        buffer.write(content)
+        yield name, buffer
+
+
+def build_batch_error(model_name: str, index: int, error: Exception, filename: Optional[str] = None) -> dict:
+    error_response = new_response(model_name)
+    error_response.update({'index': index, 'filename': filename, 'success': False,
+                           'error': str(error) or type(error).__name__,
+                           'code': 413 if isinstance(error, UploadTooLarge) else 400})
+    return error_response
+
+
+async def open_archive(request: Request, kind: str) -> ImageArchive:
+    # archives are far bigger than images, their buffer is not pooled
+    buffer = await read_stream(request.content, config.batch_max_upload_bytes, pooled=False,
+                               size_hint=request.content_length)
+    # the whole archive is listed here, e.g. a gzipped tar is decompressed once to find its members
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, ImageArchive, buffer, kind)
+
+
+async def handle_batch_request(request: Request, model_name: Optional[str] = None):
+    """
+    Detections of many images: 'image' parts of a multipart form, or a zip or tar archive body. Images are decoded,
+    preprocessed and inferred up to config.batch_max_in_flight at a time, so they reach the device in batches,
+    and a detection response per image is streamed back as a line of NDJSON as soon as it is ready.
+    Options are taken from the query string and, for multipart forms, from form fields before the images.
+    """
+    endpoint = get_endpoint(request)
+    if not model_name:
+        model_name = config.get_current_model_name()
+    archive_kind = ARCHIVE_TYPES.get(request.content_type)
+    if request.content_type != 'multipart/form-data' and archive_kind is None:
+        return reject_request(endpoint, 'content_type', f'{request.content_type} is not supported', 400)
+    if not readiness.is_ready and not await readiness.wait(get_deadline(request.headers, time.perf_counter())):
+        return reject_overloaded(endpoint, 'not_ready', f'Server is not ready: {readiness.status}')
+    dr = DetectRequest()
+    try:
+        dr.set_query_options(request.query)
+    except ValueError as e:
+        return reject_request(endpoint, 'invalid_form', f'Submitted options are invalid: {e}', 400)
+    archive: Optional[ImageArchive] = None
+    if archive_kind is None:
+        images = read_multipart_images(request, dr)
+    else:
+        if request.content_length is not None and request.content_length > config.batch_max_upload_bytes:
+            return reject_request(endpoint, 'too_large', str(UploadTooLarge(config.batch_max_upload_bytes)), 413)
+        try:
+            archive = await open_archive(request, archive_kind)
+        except UploadTooLarge as e:
+            return reject_request(endpoint, 'too_large', str(e), 413)
+        except Exception as e:
+            return reject_request(endpoint, 'invalid_archive', f'Submitted archive is invalid: {e}', 400)
+        images = read_archive_images(archive)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    write_lock = asyncio.Lock()
+    in_flight = asyncio.Semaphore(config.batch_max_in_flight)
+    tasks = []
+
+    async def write_line(detection_result: dict):
+        async with write_lock:
+            await response.write(encode(detection_result) + b'\n')
+
+    async def process_image(image_dr: DetectRequest, index: int):
+        try:
+            await write_line(await detect_batch_image(request, image_dr, index, model_name, endpoint))
+        finally:
+            in_flight.release()
+
+    index = 0
+    try:
+        await response.prepare(request)
+        while True:
+            await in_flight.acquire()
+            try:
+                filename, file_content = await images.__anext__()
+            except StopAsyncIteration:
+                in_flight.release()
+                break
+            except (UploadTooLarge, ValueError) as e:
+                # the rest of the body can not be read, images read so far are still answered
+                in_flight.release()
+                await write_line(build_batch_error(model_name, index, e))
+                break
+            if isinstance(file_content, Exception):
+                # an archive member that can not be read fails alone, the batch goes on
+                in_flight.release()
+                error_response = build_batch_error(model_name, index, file_content, filename)
+                metrics.requests_total.inc(endpoint, str(error_response['code']))
+                await write_line(error_response)
+                index += 1
+                continue
+            tasks.append(asyncio.create_task(process_image(dr.for_image(filename, file_content), index)))
+            index += 1
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # e.g. the client went away
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        await images.aclose()
+        if archive is not None:
+            archive.close()
+    logger.info('Batch of %d images done', index)
+    await response.write_eof()
+    return response
+
+
+@routes.post('/v1/vision/detection/batch')
+async def vision_detection_batch_handler(request):
+    return await handle_batch_request(request)
+
+
+@routes.post('/v1/vision/custom/{model_name}/batch')
+async def custom_model_detection_batch_handler(request):
+    model_name = request.match_info['model_name']
+    if model_name not in config.get_model_list():
+        return web.Response(status=404, text=f'Model {model_name} is not available')
+    return await handle_batch_request(request, model_name=model_name)
+
+
+class DetectionStream:
+    """
+    Frames of one WebSocket connection, numbered from 0 in the order they are received. Up to
+    config.stream_max_in_flight frames are decoded, inferred and postprocessed at the same time, so one frame is
+    on the device while the next one is decoded; a compact message with the frame's 'seq' is sent for each of them
+    as soon as it is ready. When all of them are busy, a new frame waits, so the client is slowed down by the socket,
+    or, with dropping, replaces the frame that waits: only the latest frame is inferred next.
+    """
+    def __init__(self, request: Request, ws: web.WebSocketResponse, options: DetectRequest, model_name: str,
+                 endpoint: str, raw_size: Optional[tuple], drop: bool):
+        self.request = request
+        self.ws = ws
+        self.confidence_score = options.get_confidence_score()
+        self.tiled = options.is_tiled(model_name)
+        self.zone = options.get_zone()
+        self.model_name = model_name
+        self.endpoint = endpoint
+        self.raw_size = raw_size  # (width, height) of raw RGB frames, None for encoded images
+        self.drop = drop
+        self.active = 0
+        self.waiting: Optional[tuple] = None  # (seq, frame) of the frame waiting for its turn, when dropping
+        self.slot_freed = asyncio.Event()
+        self.send_lock = asyncio.Lock()
+        self.tasks = set()
+        self.closing = False
+
+    def create_image(self, frame: bytes) -> InferenceImage:
+        if self.raw_size is not None:
+            return RawImage(frame, *self.raw_size, self.zone)
+        image_class = TiledImage if self.tiled else InferenceImage
+        return image_class(io.BytesIO(frame), self.zone)
+
+    async def send(self, message: dict):
+        async with self.send_lock:
+            if self.ws.closed:
+                return
+            try:
+                await self.ws.send_str(encode(message).decode())
+            except (ConnectionError, RuntimeError):
+                # the socket is closing (ClientConnectionResetError is a ConnectionError, older aiohttp raises
+                # RuntimeError), the client does not get this message
+                pass
+
+    async def push(self, seq: int, frame: bytes):
+        if self.active >= config.stream_max_in_flight:
+            if self.drop:
+                if self.waiting is not None:
+                    metrics.rejected.inc(self.endpoint, 'dropped')
+                    await self.send({'seq': self.waiting[0], 'code': 503, 'dropped': True})
+                self.waiting = (seq, frame)
+                return
+            while self.active >= config.stream_max_in_flight:
+                self.slot_freed.clear()
+                await self.slot_freed.wait()
+        self.start(seq, frame)
+
+    def start(self, seq: int, frame: bytes):
+        self.active += 1
+        task = asyncio.create_task(self.process(seq, frame))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def process(self, seq: int, frame: bytes):
+        try:
+            await self.send(await self.detect(seq, frame))
+        finally:
+            self.active -= 1
+            if self.waiting is not None and not self.closing:
+                self.start(*self.waiting)
+                self.waiting = None
+            self.slot_freed.set()
+
+    async def detect(self, seq: int, frame: bytes) -> dict:
+        """
+        Returns:
+            dict: Message with 'seq', 'code' and the predictions in the format of a detection response,
+                or an 'error'.
+        """
+        start_time = time.perf_counter()
+        deadline = get_deadline(self.request.headers, start_time)
+        message = {'seq': seq}
+        try:
+            image = self.create_image(frame)
+            async with admission.slot(get_priority(self.endpoint), deadline):
+                detections = await do_inference(image, confidence_score=self.confidence_score,
+                                                model_name=self.model_name, endpoint=self.endpoint,
+                                                deadline=deadline)
+            message.update({'code': 200,
+                            'count': detections['num_detections'],
+                            'inferenceMs': detections['inferenceMs'],
+                            'processMs': detections['processMs'],
+                            'predictions': build_predictions(detections)})
+        except (Rejected, DeadlineExceeded) as e:
+            metrics.rejected.inc(self.endpoint, e.reason if isinstance(e, Rejected) else 'deadline')
+            message.update({'code': 503, 'error': str(e) or 'Request deadline passed before inference'})
+        except (UnidentifiedImageError, ValueError) as e:
+            message.update({'code': 400, 'error': str(e)})
+        except Exception as e:
+            logger.exception('Stream frame %d failed', seq)
+            metrics.errors.inc(self.endpoint)
+            message.update({'code': 500, 'error': f'{type(e).__name__}: {e}'})
+        metrics.request_duration.observe(time.perf_counter() - start_time, self.model_name, self.endpoint)
+        metrics.requests_total.inc(self.endpoint, str(message['code']))
+        return message
+
+    async def close(self):
+        self.closing = True
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+
+async def handle_stream_request(request: Request, model_name: Optional[str] = None):
+    """
+    Continuous detection over a WebSocket, e.g. one connection per camera: every binary message is a frame,
+    a JPEG (or any format PIL opens) or, with 'format=rgb', 'width' and 'height' query parameters, raw RGB bytes.
+    Options are query parameters: 'min_confidence', 'camera_id' (for its zone), 'tiled', 'zone' and 'drop'.
+    """
+    endpoint = get_endpoint(request)
+    if not model_name:
+        model_name = config.get_current_model_name()
+    options = DetectRequest()
+    try:
+        options.set_query_options(request.query)
+        raw_size = get_raw_size(request.query) if request.query.get('format', 'jpeg') == 'rgb' else None
+        drop = parse_flag(request.query['drop']) if 'drop' in request.query else config.stream_drop_frames
+    except ValueError as e:
+        return reject_request(endpoint, 'invalid_form', f'Stream options are invalid: {e}', 400)
+    if not readiness.is_ready and not await readiness.wait(get_deadline(request.headers, time.perf_counter())):
+        return reject_overloaded(endpoint, 'not_ready', f'Server is not ready: {readiness.status}')
+
+    ws = web.WebSocketResponse(max_msg_size=config.max_upload_bytes)
+    await ws.prepare(request)
+    stream = DetectionStream(request, ws, options, model_name, endpoint, raw_size, drop)
+    seq = 0
+    try:
+        async for msg in ws:
+            if msg.type == WSMsgType.BINARY:
+                await stream.push(seq, msg.data)
+                seq += 1
+            elif msg.type == WSMsgType.TEXT:
+                await stream.send({'code': 400, 'error': 'Frames must be sent as binary messages'})
+    finally:
+        await stream.close()
+    logger.info('Stream of %d frames closed', seq)
+    return ws
+
+
+@routes.get('/v1/vision/detection/stream')
+async def vision_detection_stream_handler(request):
+    return await handle_stream_request(request)
+
+
+@routes.get('/v1/vision/custom/{model_name}/stream')
+async def custom_model_detection_stream_handler(request):
+    model_name = request.match_info['model_name']
+    if model_name not in config.get_model_list():
+        return web.Response(status=404, text=f'Model {model_name} is not available')
+    return await handle_stream_request(request, model_name=model_name)
+
+
 @routes.post('/v1/visualization/custom/{model_name}')
 async def visualization_response(request):
     model_name = request.match_info['model_name']
     if model_name not in config.get_model_list():
         return web.Response(status=404, text=f'Model {model_name} is not available')
+    if output_store.is_full():
+        return reject_overloaded(get_endpoint(request), 'visualization_queue_full',
+                                 'Too many visualizations are being rendered')
     return await handle_detection_request(request, model_name=model_name, do_visualization=True)
 
 
-def run_server():
-    logger.info('Starting Web Server')
-    app = web.Application()
+@routes.get('/v1/visualization/status/{image_id}')
+async def visualization_status_response(request):
+    image_id = request.match_info['image_id']
+    entry = output_store.get(image_id)
+    image_path = output_store.find_path(image_id) if entry is None else None
+    if image_path is not None:
+        # rendered by another front-end worker process, see prefork.py
+        return web.json_response({"code": 200,
+                                  "success": True,
+                                  "imageId": image_id,
+                                  "status": "ready",
+                                  "imagePath": image_path})
+    if entry is None:
+        return web.json_response({"code": 404, "success": False, "imageId": image_id, "status": "unknown"},
+                                 status=404)
+    return web.json_response({"code": 200,
+                              "success": True,
+                              "imageId": image_id,
+                              "status": entry.status,
+                              "imagePath": entry.path})
+
+
+@routes.get('/metrics')
+async def metrics_handler(request):
+    # Prometheus text exposition format
+    return web.Response(text=metrics.registry.render(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+def create_app(owns_devices: bool = True):
+    app = web.Application(client_max_size=config.max_upload_bytes)
+    startup.setup(app, owns_devices)
     app.add_routes(routes)
     app.add_routes([web.static('/', './web'),
                     web.static('/output_images', './output_images')])
-    web.run_app(app, access_log=logger)
+    return app
+
+
+def run_server():
+    logger.info('Starting Web Server')
+    web.run_app(create_app(), port=config.server_port, access_log=logger)